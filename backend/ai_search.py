@@ -1,32 +1,317 @@
 import os
+import asyncio
+import random
+import threading
+import time
 from google import genai
-from google.genai import types
+from google.genai import types, errors
 import logging
+from search_cache import get_default_cache, make_key, SingleFlight
+from bark_sender import send_bark_notification
+import metrics
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_MODEL = "gemini-2.5-flash"
+# 每分钟允许的请求数（按 API 配额设置）及允许的突发请求数
+RATE_LIMIT_PER_MINUTE = float(os.environ.get('GEMINI_RATE_LIMIT', '60'))
+RATE_LIMIT_BURST = int(os.environ.get('GEMINI_RATE_BURST', '5'))
+# 429/5xx/超时后的最大重试次数
+MAX_RETRIES = 3
+# 单个查询的超时时间（秒）
+DEFAULT_TIMEOUT = 60
+RETRYABLE_CODES = (429, 500, 502, 503, 504)
+# 推送摘要时在这些字符处截断，保证句子完整
+SENTENCE_ENDINGS = '。！？!?\n'
+
+class TokenBucket:
+    """令牌桶限流，线程安全，可同时用于同步和异步调用"""
+    def __init__(self, rate_per_minute, capacity):
+        self.rate = rate_per_minute / 60
+        self.capacity = max(capacity, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """预留一个令牌，返回需要等待的秒数"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0 or self.rate <= 0:
+                return 0
+            return -self.tokens / self.rate
+
+# 同一进程内相同查询的并发请求只调用一次 API
+_inflight = SingleFlight()
+_limiter = TokenBucket(RATE_LIMIT_PER_MINUTE, RATE_LIMIT_BURST)
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(api_key):
+    """获取进程内共享的 Gemini 客户端"""
+    with _clients_lock:
+        if api_key not in _clients:
+            _clients[api_key] = genai.Client(api_key=api_key)
+        return _clients[api_key]
+
+_loop = None
+_loop_lock = threading.Lock()
+
+def _get_loop():
+    """search_many 使用的后台事件循环，异步客户端的连接在多次调用间复用"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='ai-search-loop', daemon=True).start()
+        return _loop
+
+def _is_retryable(error):
+    if isinstance(error, errors.APIError):
+        return error.code in RETRYABLE_CODES
+    return isinstance(error, (asyncio.TimeoutError, TimeoutError))
+
+def _backoff(attempt):
+    """带随机抖动的指数退避"""
+    return random.uniform(0, min(30, 2 ** attempt))
+
 class AISearcher:
-    def __init__(self, api_key=None):
+    def __init__(self, api_key=None, cache=None):
+        """
+        Args:
+            api_key: Gemini API Key，默认读取环境变量 GEMINI_API_KEY
+            cache: 结果缓存（search_cache.SearchCache），默认按环境变量 SEARCH_CACHE 创建，传 False 关闭缓存
+        """
         self.api_key = api_key or os.environ.get('GEMINI_API_KEY')
-        self.client = genai.Client(api_key=self.api_key)
+        self.client = get_client(self.api_key)
         self.grounding_tool = types.Tool(google_search=types.GoogleSearch())
         self.config = types.GenerateContentConfig(tools=[self.grounding_tool])
-    
-    def search(self, query, model="gemini-2.5-flash"):
+        self.cache = get_default_cache() if cache is None else (cache or None)
+
+    def search(self, query, model=DEFAULT_MODEL, use_cache=True):
         """执行AI搜索"""
+        if not use_cache or self.cache is None:
+            return self._search(query, model)
+
+        key = self.cache_key(query, model)
+        cached = self.cache.get(key)
+        if cached is not None:
+            logger.info(f"AI搜索命中缓存: {query[:30]}")
+            return cached
+        return _inflight.do(key, lambda: self._search_and_store(key, query, model))
+
+    def cache_key(self, query, model):
+        """缓存键：模型 + 归一化查询 + 生成配置"""
+        config = self.config.model_dump(mode='json', exclude_none=True)
+        return make_key(model, query, config)
+
+    def _search_and_store(self, key, query, model):
+        claimed = self.cache.claim(key)
+        if not claimed:
+            # 其他脚本进程正在查询同一问题，等待其结果
+            result = self.cache.wait(key)
+            if result is not None:
+                return result
+        try:
+            result = self._search(query, model)
+            if result is not None:
+                self.cache.set(key, result)
+            return result
+        finally:
+            if claimed:
+                self.cache.release(key)
+
+    def _search(self, query, model):
+        for attempt in range(MAX_RETRIES + 1):
+            time.sleep(_limiter.reserve())
+            try:
+                with metrics.GEMINI_LATENCY.time(model=model):
+                    response = self.client.models.generate_content(
+                        model=model,
+                        contents=query,
+                        config=self.config,
+                    )
+                return response.text
+            except Exception as e:
+                if attempt < MAX_RETRIES and _is_retryable(e):
+                    delay = _backoff(attempt)
+                    logger.warning(f"AI搜索失败，{delay:.1f}秒后重试: {e}")
+                    time.sleep(delay)
+                    continue
+                logger.error(f"AI搜索失败: {e}")
+                return None
+
+    async def asearch(self, query, model=DEFAULT_MODEL, use_cache=True, timeout=DEFAULT_TIMEOUT):
+        """异步执行AI搜索（使用 google-genai 的异步客户端）"""
+        key = None
+        if use_cache and self.cache is not None:
+            key = self.cache_key(query, model)
+            cached = self.cache.get(key)
+            if cached is not None:
+                logger.info(f"AI搜索命中缓存: {query[:30]}")
+                return cached
+
+        result = await self._asearch(query, model, timeout)
+        if key is not None and result is not None:
+            self.cache.set(key, result)
+        return result
+
+    async def _asearch(self, query, model, timeout):
+        for attempt in range(MAX_RETRIES + 1):
+            await asyncio.sleep(_limiter.reserve())
+            try:
+                with metrics.GEMINI_LATENCY.time(model=model):
+                    response = await asyncio.wait_for(
+                        self.client.aio.models.generate_content(
+                            model=model,
+                            contents=query,
+                            config=self.config,
+                        ),
+                        timeout
+                    )
+                return response.text
+            except Exception as e:
+                if attempt < MAX_RETRIES and _is_retryable(e):
+                    delay = _backoff(attempt)
+                    logger.warning(f"AI搜索失败，{delay:.1f}秒后重试: {str(e) or '请求超时'}")
+                    await asyncio.sleep(delay)
+                    continue
+                logger.error(f"AI搜索失败: {str(e) or '请求超时'}")
+                return None
+
+    async def asearch_many(self, queries, model=DEFAULT_MODEL, max_concurrency=5, use_cache=True,
+                           timeout=DEFAULT_TIMEOUT):
+        """并发执行多个查询，返回与 queries 顺序一致的结果列表（失败的为 None）"""
+        semaphore = asyncio.Semaphore(max(max_concurrency, 1))
+
+        async def run(query):
+            async with semaphore:
+                return await self.asearch(query, model, use_cache=use_cache, timeout=timeout)
+
+        # 相同的查询只请求一次
+        tasks = {}
+        for query in queries:
+            key = self.cache_key(query, model)
+            if key not in tasks:
+                tasks[key] = asyncio.ensure_future(run(query))
+        await asyncio.gather(*tasks.values())
+        return [tasks[self.cache_key(query, model)].result() for query in queries]
+
+    def search_many(self, queries, model=DEFAULT_MODEL, max_concurrency=5, use_cache=True,
+                    timeout=DEFAULT_TIMEOUT):
+        """同步接口：并发执行多个查询，总耗时接近最慢的单个查询
+
+        例如 results = searcher.search_many([f"今天关于{t}的新闻" for t in topics])
+        """
+        future = asyncio.run_coroutine_threadsafe(
+            self.asearch_many(queries, model, max_concurrency, use_cache, timeout),
+            _get_loop()
+        )
+        return future.result()
+
+    def search_stream(self, query, model=DEFAULT_MODEL, max_chars=None, max_output_tokens=None, use_cache=True):
+        """流式执行AI搜索，文本块生成后立即返回
+
+        Args:
+            max_chars: 累计字符数达到上限后立即停止生成，最后一块按上限截断
+            max_output_tokens: 模型输出的 token 上限（gemini-2.5 系列包含思考 token）
+        """
+        key = None
+        if use_cache and self.cache is not None and not max_output_tokens:
+            key = self.cache_key(query, model)
+            cached = self.cache.get(key)
+            if cached is not None:
+                logger.info(f"AI搜索命中缓存: {query[:30]}")
+                yield cached[:max_chars] if max_chars else cached
+                return
+
+        config = self.config
+        if max_output_tokens:
+            config = config.model_copy(update={'max_output_tokens': max_output_tokens})
+
+        received = []
+        length = 0
+        stream = self._stream(query, model, config)
         try:
-            response = self.client.models.generate_content(
-                model=model,
-                contents=query,
-                config=self.config,
-            )
-            return response.text
+            for text in stream:
+                if max_chars and length + len(text) >= max_chars:
+                    yield text[:max_chars - length]
+                    logger.info(f"AI搜索达到 {max_chars} 字符上限，停止生成")
+                    return
+                received.append(text)
+                length += len(text)
+                yield text
         except Exception as e:
             logger.error(f"AI搜索失败: {e}")
-            return None
+            return
+        finally:
+            # 提前结束时关闭 HTTP 流，服务端随之停止生成
+            stream.close()
+
+        # 只缓存完整生成的结果
+        if key is not None and received:
+            self.cache.set(key, ''.join(received))
+
+    def _stream(self, query, model, config):
+        for attempt in range(MAX_RETRIES + 1):
+            time.sleep(_limiter.reserve())
+            started = False
+            try:
+                # 耗时统计到流结束（或被调用方提前关闭）为止
+                with metrics.GEMINI_LATENCY.time(model=model):
+                    for chunk in self.client.models.generate_content_stream(
+                        model=model,
+                        contents=query,
+                        config=config,
+                    ):
+                        if chunk.text:
+                            started = True
+                            yield chunk.text
+                return
+            except Exception as e:
+                # 已经输出过内容时不能重试，否则会重复
+                if started or attempt >= MAX_RETRIES or not _is_retryable(e):
+                    raise
+                delay = _backoff(attempt)
+                logger.warning(f"AI搜索失败，{delay:.1f}秒后重试: {e}")
+                time.sleep(delay)
+
+def trim_to_sentence(text):
+    """截掉末尾不完整的句子（完整部分不足一半时保留原文）"""
+    index = max(text.rfind(ch) for ch in SENTENCE_ENDINGS)
+    if index + 1 < len(text) // 2:
+        return text
+    return text[:index + 1].rstrip()
+
+def search_and_push(query, device_key=None, title=None, group='AI搜索', max_chars=1000,
+                    model=DEFAULT_MODEL, searcher=None, **kwargs):
+    """流式搜索，摘要达到字数上限或生成结束后立即推送到 Bark
+
+    Returns:
+        tuple: (是否推送成功, Bark 返回结果, 推送的文本)
+    """
+    searcher = searcher or AISearcher()
+    text = ''.join(searcher.search_stream(query, model, max_chars=max_chars))
+    if max_chars and len(text) >= max_chars:
+        text = trim_to_sentence(text)
+    if not text:
+        return False, {'error': '没有获取到搜索结果'}, None
+
+    success, result = send_bark_notification(
+        device_key=device_key or os.environ.get('BARK_DEVICE_KEY'),
+        title=title or f"AI搜索: {query[:20]}...",
+        body=text,
+        group=group,
+        **kwargs
+    )
+    return success, result, text
 
 # 使用示例
 if __name__ == "__main__":
     searcher = AISearcher()
     result = searcher.search("今天的科技新闻")
-    print(result)
\ No newline at end of file
+    print(result)
@@ -1,82 +1,210 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Blueprint, current_app, request, jsonify, send_from_directory, Response, stream_with_context
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime, timezone
+from sqlalchemy import select, func, or_, and_, case, text
+from sqlalchemy.orm import defer, load_only
+from datetime import datetime, timezone, timedelta
 import os
 import json
-import subprocess
-import sys
-from scheduler import TaskScheduler
-from models import db, Script, ScriptRun
+import threading
+import time
+from scheduler import TaskScheduler, OVERLAP_POLICIES
+from run_queue import RunQueue
+from inprocess import EXECUTION_MODES
+from worker_pool import MIN_MEMORY_MB
+from executor import executor
+from events import EventHub
+from outbox import OutboxWorker
+from models import db, Script, ScriptRun, RunDailyStat, Notification, OutputBlob
 from templates import get_templates
-import pytz
+from migrate_db import upgrade_schema
+from database import configure_database
+import retention
+import cron
+import metrics
 
-app = Flask(__name__)
-CORS(app)
-
-# 配置 - 将数据库位置修改到专门的 data 目录
+# 项目根目录，在容器内为 /app，数据库默认放在其中的 data 目录
 project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-# 在容器内，这将是 /app/data 目录
-data_dir = os.path.join(project_root, 'data') 
-# 确保目录存在
-os.makedirs(data_dir, exist_ok=True) 
-db_path = os.path.join(data_dir, 'scripts.db')
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', f'sqlite:///{db_path}')
 
-# 初始化数据库
-db.init_app(app)
+bp = Blueprint('main', __name__)
+
+# POST /api/cron/parse 一次最多解析的表达式数
+CRON_BATCH_LIMIT = 500
+# 运行输出流的最长连接时间（秒），超过后断开，运行仍未结束时页面需重新打开
+STREAM_MAX_SECONDS = int(os.environ.get('RUN_STREAM_MAX_SECONDS', '3600'))
+# 每个进程同时打开的 SSE 连接（事件推送和运行输出流）上限，默认为线程数的一半：
+# 每个连接在整个连接期间占用一个 gthread 线程，超过上限时返回 503，其余线程留给普通 API 请求
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS') or max(int(os.environ.get('WEB_THREADS', '32')) // 2, 1))
+_stream_slots = threading.BoundedSemaphore(SSE_MAX_STREAMS)
 
-# 初始化调度器
+# 调度器（多进程部署时只有选举出的主节点运行定时任务，由 create_app 绑定到应用）和立即运行队列
 scheduler = TaskScheduler()
+run_queue = RunQueue()
+
+# 运行和脚本变更事件，通过 /api/events 推送给页面
+events = EventHub()
+executor.add_listener(events.on_run_event)
+
+# 脚本写入发件箱的 Bark 推送由后台线程投递
+outbox = OutboxWorker()
+
+def create_app():
+    """创建 Flask 应用（gunicorn 通过 wsgi.py 调用），不访问数据库，也不启动后台线程"""
+    app = Flask(__name__)
+    CORS(app)
+    
+    data_dir = os.path.join(project_root, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+    db_path = os.path.join(data_dir, 'scripts.db')
+    app.config['DATABASE_PATH'] = db_path
+    # SQLite 连接会自动启用 WAL 等并发参数；设置 DATABASE_URL 可切换到 PostgreSQL
+    configure_database(app, db_path)
+    
+    db.init_app(app)
+    executor.init_app(app)
+    scheduler.init_app(app)
+    events.init_app(app)
+    outbox.init_app(app)
+    app.register_blueprint(bp)
+    return app
+
+def init_database(app):
+    """创建数据表并补齐新增字段（多进程部署时由 gunicorn 主进程在启动 worker 前执行一次）"""
+    with app.app_context():
+        db.create_all()
+        upgrade_schema(db.engine)
+
+def start_services(app):
+    """启动后台服务：事件推送、推送投递、维护任务和调度器，定时任务在后台线程中批量恢复，不阻塞请求处理"""
+    # 结束上次退出时遗留的排队中和运行中的记录
+    executor.recover()
+    metrics.start_sharing()
+    events.start()
+    outbox.start()
+    # 运行历史清理任务（与定时任务一样只在主节点执行）
+    if retention.is_enabled():
+        scheduler.add_maintenance_job('run-retention', lambda: retention.run_retention(app), retention.RETENTION_CRON)
+    scheduler.start()
 
 # 静态文件路由
-@app.route('/')
+@bp.route('/')
 def index():
     return send_from_directory('../frontend', 'index.html')
 
-@app.route('/<path:path>')
+@bp.route('/<path:path>')
 def serve_static(path):
     return send_from_directory('../frontend', path)
 
 # API路由
-@app.route('/api/scripts', methods=['GET'])
+@bp.route('/api/scripts', methods=['GET'])
 def get_scripts():
-    """获取所有脚本"""
-    scripts = Script.query.all()
+    """获取所有脚本（不含代码），附带最近一次运行和下次运行时间
+    
+    支持 ETag / If-None-Match，列表未变化时返回 304
+    """
+    # 每个脚本最近一次运行，走 (script_id, created_at) 索引
+    latest_run_id = (
+        select(ScriptRun.id)
+        .where(ScriptRun.script_id == Script.id)
+        .order_by(ScriptRun.created_at.desc(), ScriptRun.id.desc())
+        .limit(1)
+        .correlate(Script)
+        .scalar_subquery()
+    )
+    rows = db.session.execute(
+        select(Script, ScriptRun.id, ScriptRun.status, ScriptRun.created_at, ScriptRun.completed_at)
+        .options(defer(Script.code))
+        .outerjoin(ScriptRun, ScriptRun.id == latest_run_id)
+        .order_by(Script.id)
+    ).all()
+    next_run_times = scheduler.get_next_run_times()
+    
     scripts_data = []
-    for script in scripts:
-        script_dict = script.to_dict()
+    for script, run_id, run_status, run_created_at, run_completed_at in rows:
+        script_dict = script.to_summary()
+        script_dict['last_run'] = {
+            'id': run_id,
+            'status': run_status,
+            'created_at': run_created_at.isoformat(),
+            'completed_at': run_completed_at.isoformat() if run_completed_at else None
+        } if run_id else None
         # 获取下次运行时间
         if script.is_active and script.cron_expression:
-            next_run = scheduler.get_next_run_time(script.id)
-            script_dict['next_run_time'] = next_run
+            script_dict['next_run_time'] = next_run_times.get(script.id) or cron.next_fire_time(script.cron_expression, script.schedule_offset())
         scripts_data.append(script_dict)
-    return jsonify(scripts_data)
+    
+    response = jsonify(scripts_data)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.add_etag()
+    return response.make_conditional(request)
+
+@bp.route('/api/scripts/<int:script_id>', methods=['GET'])
+def get_script(script_id):
+    """获取单个脚本（含代码）"""
+    script = Script.query.get_or_404(script_id)
+    return jsonify(script.to_dict())
+
+def validate_schedule_options(data):
+    """校验cron表达式、调度并发和资源限制参数，返回错误信息或 None"""
+    if data.get('cron_expression') not in (None, ''):
+        error = cron.parse(data['cron_expression']).error
+        if error:
+            return error.message
+    if 'overlap_policy' in data and data['overlap_policy'] not in OVERLAP_POLICIES:
+        return f"overlap_policy 必须是 {', '.join(OVERLAP_POLICIES)} 之一"
+    if 'execution_mode' in data and data['execution_mode'] not in EXECUTION_MODES:
+        return f"execution_mode 必须是 {', '.join(EXECUTION_MODES)} 之一"
+    for field, minimum in (('max_instances', 1), ('misfire_grace_time', 0), ('jitter_seconds', 0),
+                           ('timeout_seconds', 1), ('memory_limit_mb', MIN_MEMORY_MB), ('cpu_limit_seconds', 1),
+                           ('max_output_bytes', 1)):
+        if field in data and data[field] is not None:
+            value = data[field]
+            if not isinstance(value, int) or isinstance(value, bool) or value < minimum:
+                return f"{field} 必须是不小于 {minimum} 的整数"
+    return None
 
-@app.route('/api/scripts', methods=['POST'])
+@bp.route('/api/scripts', methods=['POST'])
 def create_script():
     """创建新脚本"""
     data = request.json
+    error = validate_schedule_options(data)
+    if error:
+        return jsonify({'message': error}), 400
+    
     script = Script(
         name=data['name'],
         description=data.get('description', ''),
         code=data['code'],
         cron_expression=data.get('cron_expression', ''),
-        is_active=data.get('is_active', False)
+        is_active=data.get('is_active', False),
+        max_instances=data.get('max_instances', 1),
+        overlap_policy=data.get('overlap_policy', 'skip'),
+        coalesce=data.get('coalesce', True),
+        misfire_grace_time=data.get('misfire_grace_time', 60),
+        jitter_seconds=data.get('jitter_seconds'),
+        execution_mode=data.get('execution_mode', 'subprocess'),
+        timeout_seconds=data.get('timeout_seconds', 300),
+        memory_limit_mb=data.get('memory_limit_mb'),
+        cpu_limit_seconds=data.get('cpu_limit_seconds'),
+        max_output_bytes=data.get('max_output_bytes')
     )
     db.session.add(script)
     db.session.commit()
     
     if script.is_active and script.cron_expression:
-        scheduler.add_job(script.id, script.cron_expression)
+        scheduler.add_job(script.id, script.cron_expression, **script.schedule_options())
     
+    publish_script_event('created', script)
     return jsonify(script.to_dict()), 201
 
-@app.route('/api/scripts/<int:script_id>', methods=['PUT'])
+@bp.route('/api/scripts/<int:script_id>', methods=['PUT'])
 def update_script(script_id):
     """更新脚本"""
     script = Script.query.get_or_404(script_id)
     data = request.json
+    error = validate_schedule_options(data)
+    if error:
+        return jsonify({'message': error}), 400
     
     # 如果调度状态改变，更新调度器
     old_active = script.is_active
@@ -87,6 +215,16 @@ def update_script(script_id):
     script.code = data.get('code', script.code)
     script.cron_expression = data.get('cron_expression', script.cron_expression)
     script.is_active = data.get('is_active', script.is_active)
+    script.max_instances = data.get('max_instances', script.max_instances)
+    script.overlap_policy = data.get('overlap_policy', script.overlap_policy)
+    script.coalesce = data.get('coalesce', script.coalesce)
+    script.misfire_grace_time = data.get('misfire_grace_time', script.misfire_grace_time)
+    script.jitter_seconds = data.get('jitter_seconds', script.jitter_seconds)
+    script.execution_mode = data.get('execution_mode', script.execution_mode)
+    script.timeout_seconds = data.get('timeout_seconds', script.timeout_seconds)
+    script.memory_limit_mb = data.get('memory_limit_mb', script.memory_limit_mb)
+    script.cpu_limit_seconds = data.get('cpu_limit_seconds', script.cpu_limit_seconds)
+    script.max_output_bytes = data.get('max_output_bytes', script.max_output_bytes)
     script.updated_at = datetime.now(timezone.utc)
     
     db.session.commit()
@@ -96,17 +234,18 @@ def update_script(script_id):
         scheduler.remove_job(script_id)
     
     if script.is_active and script.cron_expression:
-        scheduler.add_job(script_id, script.cron_expression)
+        scheduler.add_job(script_id, script.cron_expression, **script.schedule_options())
     
     # 获取更新后的数据，包括下次运行时间
     script_dict = script.to_dict()
     if script.is_active and script.cron_expression:
-        next_run = scheduler.get_next_run_time(script.id)
+        next_run = scheduler.get_next_run_time(script.id, script.cron_expression, script.schedule_offset())
         script_dict['next_run_time'] = next_run
     
+    publish_script_event('updated', script, script_dict.get('next_run_time'))
     return jsonify(script_dict)
 
-@app.route('/api/scripts/<int:script_id>', methods=['DELETE'])
+@bp.route('/api/scripts/<int:script_id>', methods=['DELETE'])
 def delete_script(script_id):
     """删除脚本"""
     script = Script.query.get_or_404(script_id)
@@ -116,207 +255,376 @@ def delete_script(script_id):
     
     db.session.delete(script)
     db.session.commit()
+    events.publish('script', {'event': 'deleted', 'script_id': script_id})
     return '', 204
 
-@app.route('/api/scripts/<int:script_id>/run', methods=['POST'])
+def publish_script_event(event, script, next_run_time=None):
+    """推送脚本的新增或修改（不含代码）"""
+    data = script.to_summary()
+    if script.is_active and script.cron_expression:
+        data['next_run_time'] = next_run_time or scheduler.get_next_run_time(script.id, script.cron_expression, script.schedule_offset())
+    events.publish('script', {'event': event, 'script': data})
+
+@bp.route('/api/scripts/<int:script_id>/run', methods=['POST'])
 def run_script(script_id):
-    """立即运行脚本"""
-    script = Script.query.get_or_404(script_id)
+    """立即运行脚本（加入运行队列，立即返回运行记录）"""
+    Script.query.get_or_404(script_id)
     
     # 创建运行记录
-    run = ScriptRun(script_id=script_id)
-    db.session.add(run)
-    db.session.commit()
+    run = executor.enqueue(script_id, trigger='manual')
+    run_queue.submit(executor.execute, run.id, 'manual')
+    
+    return jsonify(run.to_dict()), 202
+
+@bp.route('/api/runs/<int:run_id>', methods=['GET'])
+def get_run(run_id):
+    """获取单条运行记录的完整内容（含输出）"""
+    run = ScriptRun.query.get_or_404(run_id)
+    return jsonify(run.to_dict())
+
+@bp.route('/api/runs/<int:run_id>/stream', methods=['GET'])
+def stream_run(run_id):
+    """以 SSE 推送运行中产生的新输出，运行结束后发送 end 事件"""
+    ScriptRun.query.get_or_404(run_id)
+    if not _stream_slots.acquire(blocking=False):
+        return _streams_exhausted()
     
+    # 运行结束时输出可能已改为引用共享内容（见 dedup.store_output）
+    columns = {'output': func.coalesce(ScriptRun.output, OutputBlob.content), 'error': ScriptRun.error}
+    
+    def generate():
+        offsets = {'output': 0, 'error': 0}
+        idle = 0
+        deadline = time.monotonic() + STREAM_MAX_SECONDS
+        while time.monotonic() < deadline:
+            row = db.session.execute(
+                select(ScriptRun.status, func.length(columns['output']), func.length(columns['error']))
+                .outerjoin(OutputBlob, OutputBlob.hash == ScriptRun.output_hash)
+                .where(ScriptRun.id == run_id)
+            ).one_or_none()
+            if row is None:
+                break
+            status, lengths = row[0], {'output': row[1] or 0, 'error': row[2] or 0}
+            
+            sent = False
+            for column, event in (('output', 'stdout'), ('error', 'stderr')):
+                if lengths[column] > offsets[column]:
+                    # 只读取上次推送之后新增的部分
+                    text = db.session.execute(
+                        select(func.substr(columns[column], offsets[column] + 1))
+                        .outerjoin(OutputBlob, OutputBlob.hash == ScriptRun.output_hash)
+                        .where(ScriptRun.id == run_id)
+                    ).scalar() or ''
+                    offsets[column] += len(text)
+                    sent = True
+                    yield f"event: {event}\ndata: {json.dumps({'text': text}, ensure_ascii=False)}\n\n"
+            db.session.rollback()
+            
+            if status not in ('queued', 'running'):
+                yield f"event: end\ndata: {json.dumps({'status': status})}\n\n"
+                break
+            
+            idle = 0 if sent else idle + 1
+            if idle and idle % 15 == 0:
+                yield ": keepalive\n\n"
+            time.sleep(1)
+    
+    return _event_stream(stream_with_context(generate()))
+
+def _event_stream(body):
+    """SSE 响应，连接关闭时归还占用的连接数"""
+    response = Response(
+        body,
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    response.call_on_close(_stream_slots.release)
+    return response
+
+def _streams_exhausted():
+    response = jsonify({'message': f'实时推送连接数已达上限（{SSE_MAX_STREAMS}），请稍后重试'})
+    response.headers['Retry-After'] = '10'
+    return response, 503
+
+@bp.route('/api/events', methods=['GET'])
+def stream_events():
+    """以 SSE 推送运行事件（run：queued / started / finished）和脚本变更（script：created / updated / deleted）
+    
+    浏览器断线重连时带上 Last-Event-ID，补发期间错过的事件
+    """
+    if not _stream_slots.acquire(blocking=False):
+        return _streams_exhausted()
     try:
-        # 获取当前项目目录
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        
-        # 构建包含导入路径的脚本
-        script_with_imports = f"""
-import sys
-import os
+        subscription = events.subscribe(request.headers.get('Last-Event-ID', type=int))
+    except Exception:
+        _stream_slots.release()
+        raise
+    
+    def generate():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                item = subscription.get(timeout=15)
+                if item is None:
+                    if subscription.closed:
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                event_id, kind, data = item
+                yield f"id: {event_id}\nevent: {kind}\ndata: {data}\n\n"
+        finally:
+            events.unsubscribe(subscription)
+    
+    return _event_stream(generate())
+
+@bp.route('/api/scripts/<int:script_id>/runs', methods=['GET'])
+def get_script_runs(script_id):
+    """获取脚本运行历史（按时间倒序分页，不含输出内容）
+    
+    查询参数:
+        before: 上一页最后一条运行记录的ID
+        limit: 每页数量，默认20，最大100
+    """
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    before = request.args.get('before', type=int)
+    
+    query = ScriptRun.query.options(
+        defer(ScriptRun.output), defer(ScriptRun.error)
+    ).filter(ScriptRun.script_id == script_id)
+    
+    if before is not None:
+        cursor = db.session.execute(
+            select(ScriptRun.created_at).where(ScriptRun.id == before, ScriptRun.script_id == script_id)
+        ).scalar()
+        if cursor is None:
+            return jsonify({'message': '无效的分页游标'}), 400
+        query = query.filter(or_(
+            ScriptRun.created_at < cursor,
+            and_(ScriptRun.created_at == cursor, ScriptRun.id < before)
+        ))
+    
+    runs = query.order_by(ScriptRun.created_at.desc(), ScriptRun.id.desc()).limit(limit + 1).all()
+    has_more = len(runs) > limit
+    runs = runs[:limit]
+    
+    return jsonify({
+        'runs': [run.to_summary() for run in runs],
+        'next_before': runs[-1].id if has_more else None
+    })
+
+@bp.route('/api/scripts/<int:script_id>/stats/daily', methods=['GET'])
+def get_script_daily_stats(script_id):
+    """获取已汇总的按天运行统计（来自清理后的历史记录）"""
+    Script.query.get_or_404(script_id)
+    days = min(max(request.args.get('days', 30, type=int), 1), 366)
+    stats = RunDailyStat.query.filter_by(script_id=script_id).order_by(RunDailyStat.day.desc()).limit(days).all()
+    return jsonify([stat.to_dict() for stat in stats])
+
+# /api/stats/scripts 支持的排序指标
+SCRIPT_STAT_SORTS = ('cpu', 'duration', 'rss', 'bytes', 'runs')
 
-# 添加项目目录到Python路径
-sys.path.insert(0, r'{current_dir}')
-
-# 设置环境变量（如果脚本中使用了）
-os.environ['GEMINI_API_KEY'] = os.environ.get('GEMINI_API_KEY', '')
-os.environ['BARK_DEVICE_KEY'] = os.environ.get('BARK_DEVICE_KEY', '')
-os.environ['BARK_API_SERVER'] = os.environ.get('BARK_API_SERVER', '')
-
-# 执行用户脚本
-{script.code}
-"""
-        
-        # 执行脚本
-        result = subprocess.run(
-            [sys.executable, '-c', script_with_imports],
-            capture_output=True,
-            text=True,
-            timeout=300,  # 5分钟超时
-            env=os.environ.copy()  # 传递环境变量
+@bp.route('/api/stats/scripts', methods=['GET'])
+def get_script_stats():
+    """按资源消耗对脚本排名（统计最近 days 天内已结束的运行）"""
+    days = min(max(request.args.get('days', 7, type=int), 1), 366)
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 200)
+    sort = request.args.get('sort', 'cpu')
+    if sort not in SCRIPT_STAT_SORTS:
+        return jsonify({'message': f"sort 必须是 {', '.join(SCRIPT_STAT_SORTS)} 之一"}), 400
+    
+    since = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=days)
+    cpu = func.coalesce(ScriptRun.cpu_user, 0) + func.coalesce(ScriptRun.cpu_system, 0)
+    output_bytes = func.coalesce(ScriptRun.stdout_bytes, 0) + func.coalesce(ScriptRun.stderr_bytes, 0)
+    aggregates = {
+        'runs': func.count(ScriptRun.id),
+        'cpu': func.sum(cpu),
+        'duration': func.sum(ScriptRun.duration),
+        'rss': func.max(ScriptRun.max_rss_kb),
+        'bytes': func.sum(output_bytes),
+    }
+    rows = db.session.execute(
+        select(
+            Script.id,
+            Script.name,
+            aggregates['runs'].label('runs'),
+            func.sum(case((ScriptRun.status == 'success', 0), else_=1)).label('failed'),
+            aggregates['cpu'].label('cpu'),
+            aggregates['duration'].label('duration'),
+            func.max(ScriptRun.duration).label('max_duration'),
+            aggregates['rss'].label('rss'),
+            aggregates['bytes'].label('bytes'),
         )
-        
-        run.output = result.stdout
-        run.error = result.stderr
-        run.status = 'success' if result.returncode == 0 else 'failed'
-        run.completed_at = datetime.now(timezone.utc)
-        
-    except subprocess.TimeoutExpired:
-        run.error = "Script execution timeout"
-        run.status = 'failed'
-        run.completed_at = datetime.now(timezone.utc)
-    except Exception as e:
-        run.error = str(e)
-        run.status = 'failed'
-        run.completed_at = datetime.now(timezone.utc)
+        .join(ScriptRun, ScriptRun.script_id == Script.id)
+        .where(ScriptRun.created_at >= since, ScriptRun.completed_at.isnot(None))
+        .group_by(Script.id, Script.name)
+        .order_by(aggregates[sort].desc().nulls_last())
+        .limit(limit)
+    ).all()
     
-    db.session.commit()
-    return jsonify(run.to_dict())
+    def rounded(value):
+        return round(value, 3) if value is not None else None
+    
+    return jsonify({
+        'days': days,
+        'sort': sort,
+        'scripts': [{
+            'script_id': row.id,
+            'name': row.name,
+            'runs': row.runs,
+            'failed': row.failed,
+            'cpu_seconds': rounded(row.cpu),
+            'avg_cpu_seconds': rounded(row.cpu / row.runs),
+            'wall_seconds': rounded(row.duration),
+            'avg_duration': rounded(row.duration / row.runs if row.duration is not None else None),
+            'max_duration': rounded(row.max_duration),
+            'max_rss_kb': row.rss,
+            'output_bytes': row.bytes,
+        } for row in rows]
+    })
 
-@app.route('/api/scripts/<int:script_id>/runs', methods=['GET'])
-def get_script_runs(script_id):
-    """获取脚本运行历史"""
-    runs = ScriptRun.query.filter_by(script_id=script_id).order_by(ScriptRun.created_at.desc()).limit(20).all()
-    return jsonify([run.to_dict() for run in runs])
+@bp.route('/api/notifications', methods=['GET'])
+def get_notifications():
+    """发件箱中的推送（按ID倒序），可按状态筛选
+    
+    查询参数:
+        status: pending / sending / sent / failed
+        before: 上一页最后一条的ID
+        limit: 每页数量，默认50，最大200
+    """
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    query = select(Notification).order_by(Notification.id.desc()).limit(limit)
+    status = request.args.get('status')
+    if status:
+        query = query.where(Notification.status == status)
+    before = request.args.get('before', type=int)
+    if before is not None:
+        query = query.where(Notification.id < before)
+    notifications = db.session.execute(query).scalars().all()
+    return jsonify([notification.to_dict() for notification in notifications])
 
-@app.route('/api/templates', methods=['GET'])
+@bp.route('/healthz', methods=['GET'])
+def healthz():
+    """就绪探针：数据库可访问即返回 200，不等待定时任务恢复完成"""
+    try:
+        db.session.execute(text('SELECT 1'))
+    except Exception as e:
+        return jsonify({'status': 'unavailable', 'error': str(e)}), 503
+    return jsonify({'status': 'ok', 'scheduler': scheduler.status()})
+
+@bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus 格式的运行指标"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@bp.route('/api/templates', methods=['GET'])
 def api_get_templates():
     """获取脚本模板"""
     return jsonify(get_templates())
 
-@app.route('/api/config', methods=['GET'])
+@bp.route('/api/config', methods=['GET'])
 def get_config():
     """获取配置信息"""
     config = {
-        'database_location': os.path.abspath(db_path),
+        'database_location': os.path.abspath(current_app.config['DATABASE_PATH']),
         'project_directory': os.path.dirname(os.path.abspath(__file__)),
         'environment_vars': {
             'GEMINI_API_KEY': '已设置' if os.environ.get('GEMINI_API_KEY') else '未设置',
             'BARK_DEVICE_KEY': '已设置' if os.environ.get('BARK_DEVICE_KEY') else '未设置',
             'BARK_API_SERVER': os.environ.get('BARK_API_SERVER', '未设置')
+        },
+        'scheduler': {
+            **scheduler.status(),
+            'lease': scheduler.elector.current() if scheduler.elector else None
         }
     }
     return jsonify(config)
 
-@app.route('/api/cron/parse', methods=['POST'])
+@bp.route('/api/cron/parse', methods=['POST'])
 def parse_cron():
-    """解析cron表达式，返回描述"""
+    """解析cron表达式，返回描述、接下来几次运行时间和结构化的错误
+    
+    请求体为 {"cron_expression": "...", "count": 5, "offset": 0}，offset 为错峰推迟的秒数；
+    也可以是列表（批量解析，脚本列表一次获取所有脚本的后续运行时间），元素为表达式字符串或
+    {"cron_expression": "...", "offset": 0}，按顺序返回结果列表，此时次数由查询参数 count 指定
+    """
     data = request.json
-    cron_expression = data.get('cron_expression', '').strip()
-    
-    if not cron_expression:
-        return jsonify({'description': '未设置定时任务', 'valid': False})
-    
-    parts = cron_expression.split()
-    if len(parts) != 5:
-        return jsonify({'description': '无效的cron表达式，需要5个部分', 'valid': False})
-    
-    minute, hour, day, month, dow = parts
-    
-    # 生成描述
-    descriptions = []
-    
-    # 分钟
-    if minute == '*':
-        descriptions.append('每分钟')
-    elif '/' in minute:
-        interval = minute.split('/')[1]
-        descriptions.append(f'每{interval}分钟')
-    elif ',' in minute:
-        descriptions.append(f'在{minute}分')
-    else:
-        descriptions.append(f'在第{minute}分钟')
-    
-    # 小时
-    if hour != '*':
-        if ',' in hour:
-            descriptions.append(f'的{hour}点')
-        else:
-            descriptions.append(f'的{hour}点')
-    
-    # 日期
-    if day != '*':
-        if ',' in day:
-            descriptions.append(f'每月{day}日')
-        else:
-            descriptions.append(f'每月{day}日')
-    
-    # 月份
-    if month != '*':
-        if ',' in month:
-            descriptions.append(f'在{month}月')
-        else:
-            descriptions.append(f'在{month}月')
-    
-    # 星期
-    if dow != '*':
-        dow_names = {
-            '0': '周日', '1': '周一', '2': '周二', '3': '周三',
-            '4': '周四', '5': '周五', '6': '周六', '7': '周日'
-        }
-        if ',' in dow:
-            days = [dow_names.get(d, d) for d in dow.split(',')]
-            descriptions.append(f'在{",".join(days)}')
-        else:
-            descriptions.append(f'在{dow_names.get(dow, dow)}')
-    
-    # 组合描述
-    if minute == '0' and hour != '*' and day == '*' and month == '*' and dow == '*':
-        description = f'每天{hour}点执行'
-    elif minute != '*' and hour != '*' and day == '*' and month == '*' and dow == '*':
-        description = f'每天{hour}:{minute.zfill(2)}执行'
-    elif minute == '0' and hour == '0' and day != '*' and month == '*' and dow == '*':
-        description = f'每月{day}日0点执行'
-    elif dow != '*' and day == '*':
-        dow_names = {
-            '0': '周日', '1': '周一', '2': '周二', '3': '周三',
-            '4': '周四', '5': '周五', '6': '周六', '7': '周日'
-        }
-        if ',' in dow:
-            days = [dow_names.get(d, d) for d in dow.split(',')]
-            description = f'每{",".join(days)}{hour}:{minute.zfill(2)}执行'
-        else:
-            description = f'每{dow_names.get(dow, dow)}{hour}:{minute.zfill(2)}执行'
-    else:
-        description = ' '.join(descriptions)
-    
-    # 尝试获取下次运行时间
-    try:
-        from apscheduler.triggers.cron import CronTrigger
-        trigger = CronTrigger(
-            minute=minute, hour=hour, day=day, month=month, day_of_week=dow,
-            timezone='Asia/Shanghai'
-        )
-        next_time = trigger.get_next_fire_time(None, datetime.now(pytz.timezone('Asia/Shanghai')))
-        if next_time:
-            next_run = next_time.strftime('%Y-%m-%d %H:%M:%S')
-            description += f'（下次运行：{next_run}）'
-    except:
-        pass
+    if data is None:
+        data = {}
+    elif not isinstance(data, (dict, list)):
+        return jsonify({'message': '请求体必须是对象或列表'}), 400
+    if isinstance(data, list):
+        if len(data) > CRON_BATCH_LIMIT:
+            return jsonify({'message': f'一次最多解析 {CRON_BATCH_LIMIT} 个表达式'}), 400
+        count = max(request.args.get('count', 5, type=int), 0)
+        results = []
+        for item in data:
+            item = item if isinstance(item, dict) else {'cron_expression': item}
+            offset = item.get('offset') or 0
+            results.append(cron.preview(item.get('cron_expression'), count, offset if _is_count(offset) else 0))
+        return jsonify(results)
     
-    return jsonify({'description': description, 'valid': True})
+    cron_expression = data.get('cron_expression')
+    if not isinstance(cron_expression, (str, type(None))):
+        error = cron.CronError('cron表达式必须是字符串', value=cron_expression)
+        return jsonify(cron.invalid_preview(cron_expression, error)), 400
+    count = data.get('count', 5)
+    offset = data.get('offset') or 0
+    if not _is_count(count) or not _is_count(offset):
+        return jsonify({'message': 'count 和 offset 必须是非负整数'}), 400
+    return jsonify(cron.preview(cron_expression, count, offset))
 
-if __name__ == '__main__':
-    with app.app_context():
-        db.create_all()
+def _is_count(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+@bp.route('/api/schedule/histogram', methods=['GET'])
+def schedule_histogram():
+    """所有启用的定时脚本在接下来一段时间内每个时间段的预计触发次数，用于发现并错开集中触发的时间点
     
-    # 启动调度器
-    scheduler.start()
+    查询参数:
+        hours: 统计时长（小时），默认24，最大168
+        bucket: 每段的分钟数，默认1，最大60
+        top: 返回触发最多的时间段数，默认10
+    """
+    hours = min(max(request.args.get('hours', 24, type=int), 1), 168)
+    bucket = min(max(request.args.get('bucket', 1, type=int), 1), 60)
+    top = min(max(request.args.get('top', 10, type=int), 0), 100)
     
-    # 恢复已激活的定时任务
-    with app.app_context():
-        active_scripts = Script.query.filter_by(is_active=True).all()
-        for script in active_scripts:
-            if script.cron_expression:
-                scheduler.add_job(script.id, script.cron_expression)
+    scripts = db.session.execute(
+        select(Script)
+        .options(load_only(Script.id, Script.cron_expression, Script.jitter_seconds))
+        .where(Script.is_active == True, Script.cron_expression != '')
+    ).scalars().all()
+    start, counts, script_ids = cron.fire_histogram(
+        [(script.id, script.cron_expression, script.schedule_offset()) for script in scripts],
+        hours=hours, bucket_minutes=bucket
+    )
+    
+    hotspots = sorted((index for index, count in enumerate(counts) if count), key=lambda i: (-counts[i], i))[:top]
+    return jsonify({
+        'start': start.strftime('%Y-%m-%d %H:%M'),
+        'hours': hours,
+        'bucket_minutes': bucket,
+        'total': sum(counts),
+        'max': max(counts, default=0),
+        'counts': counts,
+        'hotspots': [{
+            'time': (start + timedelta(minutes=index * bucket)).strftime('%Y-%m-%d %H:%M'),
+            'count': counts[index],
+            'script_ids': sorted(set(script_ids[index]))
+        } for index in hotspots]
+    })
+
+if __name__ == '__main__':
+    # 本地开发使用 Flask 自带服务器，生产环境使用 gunicorn（见 gunicorn.conf.py）
+    app = create_app()
+    init_database(app)
+    start_services(app)
     
     # 打印配置信息
     print(f"\n{'='*50}")
     print("🚀 AI搜索与Bark推送管理系统已启动")
     print(f"{'='*50}")
-    print(f"📁 数据库位置: {os.path.abspath(db_path)}")
+    print(f"📁 数据库位置: {os.path.abspath(app.config['DATABASE_PATH'])}")
     print(f"📂 项目目录: {os.path.dirname(os.path.abspath(__file__))}")
     print(f"🌐 访问地址: http://localhost:5000")
     print(f"{'='*50}")
@@ -326,4 +634,4 @@ if __name__ == '__main__':
     print(f"  BARK_API_SERVER: {os.environ.get('BARK_API_SERVER', '使用默认服务器')}")
     print(f"{'='*50}\n")
     
-    app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
\ No newline at end of file
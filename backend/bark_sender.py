@@ -1,37 +1,131 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3 import exceptions as urllib3_exceptions
+from concurrent.futures import ThreadPoolExecutor
 import json
 import logging # 添加日志记录
 import os
+import threading
+import time
+import metrics
 
 logger = logging.getLogger(__name__) # 获取 logger 实例
 
-def send_bark_notification(device_key, body, title="", sound="", icon="", group="", url="", copy_text="", is_archive="0", level=""):
+DEFAULT_API_SERVER = "https://api.day.app" # 默认官方API
+
+class BarkClient:
     """
-    发送 Bark 推送通知。
+    可复用的 Bark 客户端。
+
+    内部使用带连接池的 requests.Session（保持长连接，省去重复的 TLS 握手），
+    遇到 5xx 和连接失败按指数退避自动重试；读取超时不重试（推送可能已经送达，重发会造成重复通知）。
 
     参数:
-    device_key (str): 你的 Bark 设备 Key。
-    body (str): 推送通知的主要内容。 (必填)
-    title (str, optional): 推送通知的标题。
-    sound (str, optional): 推送铃声。例如 "bell", "birdsong", "glass"。更多请参考 Bark App。
-    icon (str, optional): 自定义推送图标的 URL (必须是 https)。
-    group (str, optional): 推送消息分组。
-    url (str, optional): 点击推送时跳转的 URL。
-    copy_text (str, optional): 点击推送时自动复制的文本。
-    is_archive (str, optional): 设置为 "1" 时，推送会直接存为历史记录，而不会弹出提示。
-    level (str, optional): 推送级别 (iOS 15+)，可选 "active", "timeSensitive", "passive"。
+    api_server (str, optional): Bark 服务器地址，默认读取环境变量 BARK_API_SERVER，未设置时使用官方服务器。
+    timeout (float, optional): 单次请求超时秒数。
+    retries (int, optional): 5xx 或连接失败后的最大重试次数。
+    backoff (float, optional): 重试退避系数，第 n 次重试前等待 backoff * 2^(n-1) 秒。
+    pool_size (int, optional): 连接池大小，也是 send_many 的默认并发数。
     """
-    api_url = "https://api.day.app/push" # 默认官方API
 
-    # 允许通过环境变量覆盖 Bark API 地址
-    bark_api_server = os.environ.get('BARK_API_SERVER', '').strip()
-    if bark_api_server:
-        if bark_api_server.endswith('/'): # 移除末尾的 /
-            bark_api_server = bark_api_server[:-1]
-        api_url = f"{bark_api_server}/push"
-        logger.info(f"使用自定义 Bark API 服务器: {api_url}")
+    def __init__(self, api_server=None, timeout=10, retries=2, backoff=0.5, pool_size=10):
+        if api_server is None:
+            api_server = os.environ.get('BARK_API_SERVER', '').strip()
+        self.api_url = f"{(api_server or DEFAULT_API_SERVER).rstrip('/')}/push"
+        if api_server:
+            logger.info(f"使用自定义 Bark API 服务器: {self.api_url}")
+
+        self.timeout = timeout
+        self.pool_size = pool_size
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset({'POST'}),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            "Content-Type": "application/json; charset=utf-8"
+        })
+
+    def send(self, device_key, body, title="", sound="", icon="", group="", url="", copy_text="", is_archive="0", level=""):
+        """发送一条推送，参数与返回值同 send_bark_notification"""
+        return self.send_payload(build_payload(device_key, body, title, sound, icon, group, url, copy_text, is_archive, level))
+
+    def send_payload(self, payload):
+        """发送已构造好的请求体（见 build_payload）"""
+        title = payload.get('title', '')
+
+        # 记录将要发送的payload (不记录device_key)
+        if logger.isEnabledFor(logging.DEBUG):
+            log_payload = payload.copy()
+            log_payload['device_key'] = '***REDACTED***'
+            logger.debug(f"发送 Bark 请求到 {self.api_url}，Payload: {log_payload}")
+
+        started = time.perf_counter()
+        success, result = self._post(payload, title)
+        metrics.BARK_LATENCY.observe(time.perf_counter() - started, outcome='success' if success else 'error')
+        return success, result
+
+    def _post(self, payload, title):
+        try:
+            response = self.session.post(self.api_url, data=json.dumps(payload), timeout=self.timeout)
+            response_json = response.json()
+
+            if response.status_code == 200 and response_json.get("code") == 200:
+                logger.info(f"Bark 通知发送成功！消息 ID: {response_json.get('messageid', 'N/A')}, Title: {title[:30]}")
+                return True, response_json
+            else:
+                logger.error(f"Bark 通知发送失败。状态码: {response.status_code}, 错误: {response_json.get('message', '未知错误')}, Title: {title[:30]}")
+                return False, response_json
+        except json.JSONDecodeError:
+            logger.error(f"解析 Bark API ({self.api_url}) 响应时发生错误。响应内容: {response.text}, Title: {title[:30]}")
+            return False, {"error": "JSONDecodeError", "response_text": response.text}
+        except requests.exceptions.RequestException as e:
+            if _is_timeout(e):
+                logger.error(f"请求 Bark API ({self.api_url}) 超时。Title: {title[:30]}")
+                return False, {"error": "Request Timeout", "message": f"请求 Bark API ({self.api_url}) 超时"}
+            logger.error(f"请求 Bark API ({self.api_url}) 时发生错误: {e}, Title: {title[:30]}")
+            return False, {"error": str(e)}
+
+    def send_many(self, messages, max_workers=None):
+        """
+        并发发送多条推送。
+
+        参数:
+        messages (list[dict]): 每条消息为 send() 的关键字参数，例如
+            [{"device_key": key, "title": "日报", "body": text} for key in team_keys]
+        max_workers (int, optional): 最大并发数，默认等于连接池大小。
+
+        返回:
+        list[tuple]: 与 messages 顺序一致的 (success, result) 列表。
+        """
+        if not messages:
+            return []
+        workers = min(max_workers or self.pool_size, len(messages))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(lambda message: self.send(**message), messages))
 
+    def close(self):
+        self.session.close()
 
+def _is_timeout(error):
+    """重试耗尽后超时会被包装成 ConnectionError，这里一并识别"""
+    if isinstance(error, requests.exceptions.Timeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, urllib3_exceptions.TimeoutError)
+
+def build_payload(device_key, body, title="", sound="", icon="", group="", url="", copy_text="", is_archive="0", level=""):
+    """构造 Bark 推送请求体，只包含设置了的可选字段"""
     payload = {
         "device_key": device_key,
         "body": body
@@ -53,36 +147,65 @@ def send_bark_notification(device_key, body, title="", sound="", icon="", group=
         payload["isArchive"] = "1"
     if level:
         payload["level"] = level
+    return payload
 
-    headers = {
-        "Content-Type": "application/json; charset=utf-8"
-    }
-    
-    # 记录将要发送的payload (不记录device_key)
-    log_payload = payload.copy()
-    if 'device_key' in log_payload:
-        log_payload['device_key'] = '***REDACTED***'
-    logger.debug(f"发送 Bark 请求到 {api_url}，Payload: {log_payload}")
+_default_client = None
+_default_client_lock = threading.Lock()
+
+def get_default_client():
+    """获取进程内共享的 BarkClient（首次使用时创建）"""
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = BarkClient()
+        return _default_client
+
+def send_bark_notification(device_key, body, title="", sound="", icon="", group="", url="", copy_text="", is_archive="0", level="", dedup=True):
+    """
+    发送 Bark 推送通知。
+
+    参数:
+    device_key (str): 你的 Bark 设备 Key。
+    body (str): 推送通知的主要内容。 (必填)
+    title (str, optional): 推送通知的标题。
+    sound (str, optional): 推送铃声。例如 "bell", "birdsong", "glass"。更多请参考 Bark App。
+    icon (str, optional): 自定义推送图标的 URL (必须是 https)。
+    group (str, optional): 推送消息分组。
+    url (str, optional): 点击推送时跳转的 URL。
+    copy_text (str, optional): 点击推送时自动复制的文本。
+    is_archive (str, optional): 设置为 "1" 时，推送会直接存为历史记录，而不会弹出提示。
+    level (str, optional): 推送级别 (iOS 15+)，可选 "active", "timeSensitive", "passive"。
+    dedup (bool, optional): 写入发件箱时是否跳过与最近推送重复的内容，默认 True。
+
+    在服务中运行的脚本里，推送写入通知发件箱后立即返回 (True, {"queued": True, "id": 通知ID})，
+    由服务进程在后台发送（失败自动重试，短时间内发往同一设备、同一分组的推送合并为一条）；
+    与同一脚本最近发往同一设备的推送相同或近似时不再发送，返回 (True, {"queued": False, "duplicate_of": 通知ID})；
+    设置 BARK_OUTBOX=0 或在服务之外运行时，通过进程内共享的 BarkClient 直接发送，连接会被复用。
+    """
+    payload = build_payload(device_key, body, title, sound, icon, group, url, copy_text, is_archive, level)
+    queued = _enqueue([payload], dedup=dedup)
+    if queued is not None:
+        return queued[0]
+    return get_default_client().send_payload(payload)
 
+def send_bark_notifications(messages, max_workers=None, dedup=True):
+    """发送多条推送，参数与返回值同 BarkClient.send_many；在服务中运行时写入通知发件箱（重复的推送被跳过）"""
+    queued = _enqueue([build_payload(**message) for message in messages], dedup=dedup)
+    if queued is not None:
+        return queued
+    return get_default_client().send_many(messages, max_workers=max_workers)
+
+def _enqueue(payloads, dedup=True):
+    """写入通知发件箱，返回每条的 (True, 结果)；未启用发件箱或写入失败时返回 None，由调用方直接发送"""
+    import outbox
+    if not payloads or not outbox.is_enabled():
+        return None
     try:
-        response = requests.post(api_url, data=json.dumps(payload), headers=headers, timeout=10) # 添加超时
-        response_json = response.json()
-
-        if response.status_code == 200 and response_json.get("code") == 200:
-            logger.info(f"Bark 通知发送成功！消息 ID: {response_json.get('messageid', 'N/A')}, Title: {title[:30]}")
-            return True, response_json
-        else:
-            logger.error(f"Bark 通知发送失败。状态码: {response.status_code}, 错误: {response_json.get('message', '未知错误')}, Title: {title[:30]}")
-            return False, response_json
-    except requests.exceptions.Timeout:
-        logger.error(f"请求 Bark API ({api_url}) 超时。Title: {title[:30]}")
-        return False, {"error": "Request Timeout", "message": f"请求 Bark API ({api_url}) 超时"}
-    except requests.exceptions.RequestException as e:
-        logger.error(f"请求 Bark API ({api_url}) 时发生错误: {e}, Title: {title[:30]}")
-        return False, {"error": str(e)}
-    except json.JSONDecodeError:
-        logger.error(f"解析 Bark API ({api_url}) 响应时发生错误。响应内容: {response.text}, Title: {title[:30]}")
-        return False, {"error": "JSONDecodeError", "response_text": response.text}
+        results = outbox.enqueue(payloads, dedup=dedup)
+    except Exception as e:
+        logger.warning(f"写入通知发件箱失败，改为直接发送: {e}")
+        return None
+    return [(True, result) for result in results]
 
 if __name__ == "__main__":
     # 配置基本日志以便在直接运行时看到 bark_sender 的日志输出
@@ -132,4 +255,13 @@ if __name__ == "__main__":
             icon="https://www.python.org/static/favicon.ico", # 图标URL必须是https
             group="Python脚本"
         )
-        logger.info(f"发送结果: {'成功' if success else '失败'}, 响应: {result}")
\ No newline at end of file
+        logger.info(f"发送结果: {'成功' if success else '失败'}, 响应: {result}")
+
+        # 示例 4: 并发推送给多个设备（复用同一个连接池）
+        logger.info("\n--- 示例 4: 并发推送给多个设备 ---")
+        results = send_bark_notifications([
+            {"device_key": key, "title": "批量推送", "body": "这条消息同时发送给多个设备。"}
+            for key in [my_bark_key]
+        ])
+        for success, result in results:
+            logger.info(f"发送结果: {'成功' if success else '失败'}, 响应: {result}")
\ No newline at end of file
@@ -0,0 +1,234 @@
+"""
+cron 表达式解析
+5 段 cron 表达式（分 时 日 月 星期，北京时间）的校验、描述和触发器创建。
+解析结果按表达式缓存（LRU），编辑器预览、脚本列表和 TaskScheduler.add_job 共用同一个触发器对象；
+CronTrigger 计算触发时间时不修改自身状态，可以安全共享。
+
+整点等常用时间上集中触发的脚本可以设置错峰窗口（jitter_seconds）：每个脚本的触发时间固定推迟窗口内的一个偏移量，
+偏移量由脚本ID决定（黄金分割序列），同一窗口内的脚本尽量均匀错开，预览和负载统计也能准确计算。
+"""
+from apscheduler.triggers.base import BaseTrigger
+from apscheduler.triggers.cron import CronTrigger
+from collections import namedtuple
+from datetime import datetime, timedelta
+from functools import lru_cache
+import os
+import pytz
+
+BEIJING = pytz.timezone('Asia/Shanghai')
+FIELDS = ('minute', 'hour', 'day', 'month', 'day_of_week')
+FIELD_NAMES = {'minute': '分钟', 'hour': '小时', 'day': '日期', 'month': '月份', 'day_of_week': '星期'}
+DOW_NAMES = {
+    '0': '周日', '1': '周一', '2': '周二', '3': '周三',
+    '4': '周四', '5': '周五', '6': '周六', '7': '周日'
+}
+# 缓存的表达式数量
+CACHE_SIZE = 1024
+# 预览时最多返回的触发次数
+MAX_PREVIEW = 50
+# 未单独设置错峰窗口的脚本使用的默认窗口（秒），0 表示按 cron 表达式准时触发
+DEFAULT_JITTER = int(os.environ.get('SCHEDULER_DEFAULT_JITTER', '0'))
+GOLDEN_RATIO = 0.6180339887498949
+
+class CronError(ValueError):
+    """无效的 cron 表达式，field 为出错的字段（段数不对时为 None）"""
+    def __init__(self, message, field=None, value=None):
+        super().__init__(message)
+        self.message = message
+        self.field = field
+        self.value = value
+
+    def to_dict(self):
+        return {'message': self.message, 'field': self.field, 'value': self.value}
+
+Parsed = namedtuple('Parsed', ['expression', 'trigger', 'description', 'error'])
+
+def parse(cron_expression):
+    """解析表达式，返回 Parsed（无效或不是字符串时 trigger 为 None，error 为 CronError）"""
+    if cron_expression is not None and not isinstance(cron_expression, str):
+        return Parsed(cron_expression, None, None, CronError('cron表达式必须是字符串', value=cron_expression))
+    return _parse(' '.join((cron_expression or '').split()))
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _parse(expression):
+    parts = expression.split()
+    if len(parts) != 5:
+        return Parsed(expression, None, None, CronError('无效的cron表达式，需要5个部分'))
+    fields = dict(zip(FIELDS, parts))
+    try:
+        trigger = CronTrigger(**fields, timezone=BEIJING)
+    except ValueError as e:
+        return Parsed(expression, None, None, _field_error(fields, e))
+    return Parsed(expression, trigger, describe(*parts), None)
+
+def _field_error(fields, error):
+    """逐个字段校验，找出出错的字段"""
+    for field, value in fields.items():
+        try:
+            CronTrigger(**{field: value}, timezone=BEIJING)
+        except ValueError as e:
+            return CronError(f'{FIELD_NAMES[field]}字段无效: {e}', field, value)
+    return CronError(f'无效的cron表达式: {error}')
+
+class OffsetTrigger(BaseTrigger):
+    """在 cron 触发器的每次触发时间上固定推迟 offset 秒"""
+    def __init__(self, trigger, offset):
+        self.trigger = trigger
+        self.offset = offset
+
+    def get_next_fire_time(self, previous_fire_time, now):
+        delta = timedelta(seconds=self.offset)
+        if previous_fire_time is not None:
+            previous_fire_time -= delta
+        fire_time = self.trigger.get_next_fire_time(previous_fire_time, now - delta)
+        return fire_time + delta if fire_time else None
+
+    def __str__(self):
+        return f'{self.trigger} +{self.offset}s'
+
+    def __repr__(self):
+        return f'<OffsetTrigger ({self.trigger!r}, offset={self.offset})>'
+
+def spread_offset(script_id, window):
+    """脚本在错峰窗口（秒）内固定推迟的秒数"""
+    if not window or not script_id:
+        return 0
+    return int((script_id * GOLDEN_RATIO) % 1 * window)
+
+def get_trigger(cron_expression, offset=0):
+    """返回北京时间的触发器（cron 部分缓存），offset 为推迟的秒数，表达式无效时抛出 CronError"""
+    parsed = parse(cron_expression)
+    if parsed.error:
+        raise parsed.error
+    return OffsetTrigger(parsed.trigger, offset) if offset else parsed.trigger
+
+def next_fire_times(cron_expression, count=1, now=None, offset=0):
+    """接下来 count 次触发时间（带时区的 datetime），表达式无效时抛出 CronError"""
+    trigger = get_trigger(cron_expression, offset)
+    times = []
+    fire_time = trigger.get_next_fire_time(None, now or datetime.now(BEIJING))
+    while fire_time is not None and len(times) < min(count, MAX_PREVIEW):
+        times.append(fire_time)
+        fire_time = trigger.get_next_fire_time(fire_time, fire_time + timedelta(seconds=1))
+    return times
+
+def next_fire_time(cron_expression, offset=0):
+    """按 cron 表达式计算下次运行时间，表达式为空或无效时返回 None"""
+    if not cron_expression:
+        return None
+    try:
+        times = next_fire_times(cron_expression, offset=offset)
+    except CronError:
+        return None
+    return times[0].strftime('%Y-%m-%d %H:%M:%S') if times else None
+
+def preview(cron_expression, count=5, offset=0):
+    """编辑器和脚本列表使用的解析结果：是否有效、描述、接下来几次触发时间和结构化的错误"""
+    parsed = parse(cron_expression)
+    if parsed.expression == '':
+        return {'cron_expression': parsed.expression, 'valid': False, 'description': '未设置定时任务',
+                'next_runs': [], 'error': None}
+    if parsed.error:
+        return invalid_preview(parsed.expression, parsed.error)
+    times = next_fire_times(parsed.expression, count, offset=offset)
+    description = parsed.description
+    if offset:
+        description += f'，错峰推迟{offset}秒'
+    return {
+        'cron_expression': parsed.expression,
+        'valid': True,
+        'description': description,
+        'next_runs': [time.strftime('%Y-%m-%d %H:%M:%S') for time in times],
+        'error': None
+    }
+
+def invalid_preview(cron_expression, error):
+    """无效表达式的 preview 结果"""
+    return {'cron_expression': cron_expression, 'valid': False, 'description': error.message,
+            'next_runs': [], 'error': error.to_dict()}
+
+def fire_histogram(schedules, hours=24, bucket_minutes=1, now=None):
+    """统计接下来 hours 小时内每个时间段的预计触发次数
+
+    Args:
+        schedules: (script_id, cron_expression, offset) 列表，无效的表达式会被跳过
+    Returns:
+        (起始时间, 每段的触发次数列表, 每段触发的脚本ID列表)
+    """
+    now = now or datetime.now(BEIJING)
+    # 时间段从当天零点起按 bucket_minutes 对齐，只统计当前时间之后的触发
+    minutes = now.hour * 60 + now.minute
+    start = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(minutes=minutes - minutes % bucket_minutes)
+    end = now + timedelta(hours=hours)
+    size = bucket_minutes * 60
+    counts = [0] * -(-int((end - start).total_seconds()) // size)
+    script_ids = [[] for _ in counts]
+
+    # 相同表达式的脚本只计算一次 cron 触发时间，再分别加上各自的偏移
+    by_expression = {}
+    for script_id, cron_expression, offset in schedules:
+        parsed = parse(cron_expression)
+        if parsed.trigger is not None:
+            by_expression.setdefault(parsed.expression, []).append((script_id, offset))
+    for expression, members in by_expression.items():
+        earliest = now - timedelta(seconds=max(offset for _, offset in members))
+        trigger = parse(expression).trigger
+        fire_times = []
+        fire_time = trigger.get_next_fire_time(None, earliest)
+        while fire_time is not None and fire_time < end:
+            fire_times.append(fire_time)
+            fire_time = trigger.get_next_fire_time(fire_time, fire_time + timedelta(seconds=1))
+        for script_id, offset in members:
+            for fire_time in fire_times:
+                fire_time += timedelta(seconds=offset)
+                if fire_time < now or fire_time >= end:
+                    continue
+                index = int((fire_time - start).total_seconds() // size)
+                if index < len(counts):
+                    counts[index] += 1
+                    script_ids[index].append(script_id)
+    return start, counts, script_ids
+
+def describe(minute, hour, day, month, dow):
+    """生成表达式的中文描述"""
+    descriptions = []
+
+    # 分钟
+    if minute == '*':
+        descriptions.append('每分钟')
+    elif '/' in minute:
+        interval = minute.split('/')[1]
+        descriptions.append(f'每{interval}分钟')
+    elif ',' in minute:
+        descriptions.append(f'在{minute}分')
+    else:
+        descriptions.append(f'在第{minute}分钟')
+
+    # 小时
+    if hour != '*':
+        descriptions.append(f'的{hour}点')
+
+    # 日期
+    if day != '*':
+        descriptions.append(f'每月{day}日')
+
+    # 月份
+    if month != '*':
+        descriptions.append(f'在{month}月')
+
+    # 星期
+    if dow != '*':
+        days = [DOW_NAMES.get(d, d) for d in dow.split(',')]
+        descriptions.append(f'在{",".join(days)}')
+
+    # 组合描述
+    if minute == '0' and hour != '*' and day == '*' and month == '*' and dow == '*':
+        return f'每天{hour}点执行'
+    if minute != '*' and hour != '*' and day == '*' and month == '*' and dow == '*':
+        return f'每天{hour}:{minute.zfill(2)}执行'
+    if minute == '0' and hour == '0' and day != '*' and month == '*' and dow == '*':
+        return f'每月{day}日0点执行'
+    if dow != '*' and day == '*':
+        days = [DOW_NAMES.get(d, d) for d in dow.split(',')]
+        return f'每{",".join(days)}{hour}:{minute.zfill(2)}执行'
+    return ' '.join(descriptions)
@@ -0,0 +1,81 @@
+"""
+数据库连接配置
+默认使用 data 目录下的 SQLite，并在每个连接建立时应用适合多线程并发写入的参数
+（WAL 日志、synchronous=NORMAL、忙等待超时）；设置 DATABASE_URL 即可切换到 PostgreSQL
+"""
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+import os
+import sqlite3
+import time
+import metrics
+
+# 写锁被占用时等待的时间（毫秒）
+BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '15000'))
+# 连接池大小：请求线程、立即运行队列、定时任务线程和输出写入线程共用
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '10'))
+POOL_MAX_OVERFLOW = int(os.environ.get('DB_POOL_MAX_OVERFLOW', '20'))
+
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),  # 读写互不阻塞
+    ('synchronous', 'NORMAL'),  # WAL 模式下可保证一致性，减少 fsync
+    ('busy_timeout', BUSY_TIMEOUT_MS),
+)
+
+def database_url(default_path):
+    """返回数据库连接地址，优先使用环境变量 DATABASE_URL"""
+    url = os.environ.get('DATABASE_URL', f'sqlite:///{default_path}')
+    # 兼容部分平台提供的 postgres:// 写法
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+def engine_options(url):
+    """按数据库类型返回 SQLAlchemy 引擎参数"""
+    if url.startswith('sqlite'):
+        if ':memory:' in url or url.rstrip('/') == 'sqlite:':
+            return {}
+        return {
+            'connect_args': {
+                'timeout': BUSY_TIMEOUT_MS / 1000,
+                'check_same_thread': False,
+            },
+            'pool_size': POOL_SIZE,
+            'max_overflow': POOL_MAX_OVERFLOW,
+            'pool_timeout': 30,
+        }
+    return {
+        'pool_size': POOL_SIZE,
+        'max_overflow': POOL_MAX_OVERFLOW,
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+    }
+
+def configure_database(app, default_path):
+    """写入 Flask-SQLAlchemy 配置，需在 db.init_app 之前调用"""
+    url = database_url(default_path)
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(url)
+    return url
+
+@event.listens_for(Engine, 'connect')
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """每个新建的 SQLite 连接都应用性能参数"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS:
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+@event.listens_for(Session, 'before_commit')
+def _commit_started(session):
+    session.info['commit_started'] = time.perf_counter()
+
+@event.listens_for(Session, 'after_commit')
+def _commit_finished(session):
+    """记录事务提交耗时"""
+    started = session.info.pop('commit_started', None)
+    if started is not None:
+        metrics.DB_COMMIT_LATENCY.observe(time.perf_counter() - started)
@@ -0,0 +1,117 @@
+"""
+输出和推送的内容去重
+定时运行的 AI 搜索脚本经常一次又一次地产生相同或几乎相同的摘要：
+- 推送写入发件箱前，与同一脚本发往同一设备的最近推送比较指纹（标题和正文的 SHA-256 完全相同，
+  或正文的 64 位 simhash 汉明距离不超过 SIMHASH_DISTANCE），重复的推送直接跳过；
+- 运行结束时，标准输出与同一脚本之前的某次输出（或已共享保存的内容）完全相同（SHA-256）时，内容只在 output_blob 表中保存一份，
+  运行记录只保存哈希。清理运行记录后删除不再被引用的内容。
+"""
+from datetime import timedelta
+from collections import Counter
+from sqlalchemy import select, update, delete, or_
+import hashlib
+import logging
+import os
+from models import db, Notification, ScriptRun, OutputBlob
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 推送去重的时间窗口（小时），0 表示不对推送去重
+PUSH_WINDOW_HOURS = float(os.environ.get('DEDUP_PUSH_WINDOW_HOURS', '24'))
+# 正文 simhash 的汉明距离不超过该值视为近似重复，小于0时只跳过完全相同的推送
+SIMHASH_DISTANCE = int(os.environ.get('DEDUP_SIMHASH_DISTANCE', '3'))
+# 参与近似比较的最短正文长度（字符），过短的文本 simhash 不稳定
+SIMHASH_MIN_CHARS = 100
+# 每次比较的最近推送数
+INDEX_SIZE = 20
+# 达到该大小（字节）的运行输出才去重，0 表示不对输出去重
+OUTPUT_MIN_BYTES = int(os.environ.get('DEDUP_OUTPUT_MIN_BYTES', '1024'))
+
+def content_hash(*parts):
+    return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+def simhash(text):
+    """文本的 64 位 simhash（以有符号整数表示，便于存入数据库），特征为去掉空白后的相邻两个字符"""
+    text = ''.join(text.lower().split())
+    features = Counter(text[i:i + 2] for i in range(max(len(text) - 1, 1)))
+    weights = [0] * 64
+    for feature, count in features.items():
+        value = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'big')
+        for bit in range(64):
+            weights[bit] += count if value >> bit & 1 else -count
+    result = sum(1 << bit for bit in range(64) if weights[bit] > 0)
+    return result - (1 << 64) if result >= 1 << 63 else result
+
+def hamming(a, b):
+    return bin((a ^ b) & ((1 << 64) - 1)).count('1')
+
+def push_fingerprint(payload):
+    """推送的 (内容哈希, 正文 simhash)"""
+    body = payload.get('body', '')
+    return content_hash(payload.get('title', ''), body), simhash(body) if len(body) >= SIMHASH_MIN_CHARS else None
+
+def find_duplicate_push(conn, script_id, payload, fingerprint, now):
+    """在最近的推送中查找与 payload 重复的一条，返回 (通知ID, 'exact' 或 'near')，没有时返回 None
+
+    conn 为发件箱写入所用的连接，同一批中先写入的推送也参与比较
+    """
+    if PUSH_WINDOW_HOURS <= 0:
+        return None
+    digest, fingerprint_simhash = fingerprint
+    rows = conn.execute(
+        select(Notification.id, Notification.content_hash, Notification.simhash)
+        .where(
+            Notification.device_key == payload['device_key'],
+            Notification.script_id.is_(None) if script_id is None else Notification.script_id == script_id,
+            Notification.status != 'failed',
+            Notification.created_at >= now - timedelta(hours=PUSH_WINDOW_HOURS)
+        )
+        .order_by(Notification.id.desc())
+        .limit(INDEX_SIZE)
+    ).all()
+    for row in rows:
+        if row.content_hash == digest:
+            return row.id, 'exact'
+    if fingerprint_simhash is None or SIMHASH_DISTANCE < 0:
+        return None
+    for row in rows:
+        if row.simhash is not None and hamming(row.simhash, fingerprint_simhash) <= SIMHASH_DISTANCE:
+            return row.id, 'near'
+    return None
+
+def store_output(run, output_hash, size):
+    """运行结束时调用（需在应用上下文中，随运行记录一起提交）：与之前的输出相同时改为引用"""
+    if not OUTPUT_MIN_BYTES or output_hash is None or size < OUTPUT_MIN_BYTES:
+        return
+    run.output_hash = output_hash
+    if db.session.get(OutputBlob, output_hash) is None:
+        previous = db.session.execute(
+            select(ScriptRun.id)
+            .where(ScriptRun.script_id == run.script_id, ScriptRun.output_hash == output_hash,
+                   ScriptRun.id != run.id, ScriptRun.output.isnot(None))
+            .limit(1)
+        ).scalar()
+        if previous is None:
+            # 第一次出现，仍保存在运行记录中
+            return
+        content = db.session.execute(select(ScriptRun.output).where(ScriptRun.id == run.id)).scalar()
+        if content is None or content_hash(content) != output_hash:
+            # 有输出块写入失败，保存的内容与哈希不一致
+            return
+        db.session.add(OutputBlob(hash=output_hash, content=content, size=size))
+    # 输出由 RunOutputWriter 直接写入数据库，这里同样直接更新；之前相同输出的副本也改为引用
+    db.session.execute(
+        update(ScriptRun)
+        .where(or_(ScriptRun.id == run.id, ScriptRun.output_hash == output_hash))
+        .values(output=None, output_hash=output_hash),
+        execution_options={'synchronize_session': False}
+    )
+    metrics.DEDUP_SKIPPED.inc(kind='output', match='exact')
+
+def collect_garbage():
+    """删除不再被运行记录引用的输出内容，返回删除的数量"""
+    referenced = select(ScriptRun.output_hash).where(ScriptRun.output_hash.isnot(None))
+    result = db.session.execute(delete(OutputBlob).where(OutputBlob.hash.notin_(referenced)))
+    db.session.commit()
+    return result.rowcount
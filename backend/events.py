@@ -0,0 +1,144 @@
+"""
+运行状态事件推送
+执行引擎的运行事件（queued / started / finished）和脚本的增删改写入 event_log 表，
+每个服务进程有一个后台线程按 ID 顺序读取新事件，分发给本进程的 SSE 订阅者（GET /api/events）。
+多 worker / 多节点部署时，任意进程产生的事件都能推送到连接在其他进程上的页面；
+断线重连时按 Last-Event-ID 补发错过的事件。
+"""
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import select, delete, func
+import json
+import logging
+import queue
+import threading
+import time
+from models import db, EventLog
+
+logger = logging.getLogger(__name__)
+
+# 没有新事件时读取事件表的间隔（秒），本进程发布事件时立即读取
+POLL_INTERVAL = 1.0
+# 事件保留时间（秒），断线超过这段时间的页面需要重新加载列表
+KEEP_SECONDS = 3600
+# 清理过期事件的间隔（秒）
+PRUNE_INTERVAL = 600
+# 每个订阅者最多积压的事件数，超出后断开连接，由浏览器重连补发
+SUBSCRIBER_QUEUE_SIZE = 1000
+BATCH_SIZE = 500
+
+class Subscription:
+    def __init__(self, cursor):
+        self.cursor = cursor  # 已发送给该订阅者的最大事件 ID
+        self.queue = queue.Queue(SUBSCRIBER_QUEUE_SIZE)
+        self.closed = False
+
+    def get(self, timeout=None):
+        """返回 (id, kind, data)；超时返回 None"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+class EventHub:
+    def __init__(self, app=None):
+        self.app = app
+        self.subscribers = set()
+        self.cursor = None  # 已从事件表读取到的最大 ID，没有订阅者时为 None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def init_app(self, app):
+        self.app = app
+
+    def start(self):
+        """启动读取事件表的后台线程"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._loop, name='event-hub', daemon=True)
+            self.thread.start()
+
+    def publish(self, kind, data):
+        """记录一条事件（run 或 script），所有进程上的订阅者都会收到"""
+        try:
+            with self.app.app_context():
+                db.session.add(EventLog(kind=kind, payload=json.dumps(data, ensure_ascii=False)))
+                db.session.commit()
+        except Exception as e:
+            logger.error(f"记录推送事件失败: {e}")
+            return
+        self.wakeup.set()
+
+    def on_run_event(self, event):
+        """执行引擎的事件监听函数"""
+        self.publish('run', event)
+
+    def subscribe(self, last_id=None):
+        """订阅事件；last_id 为浏览器重连时带上的 Last-Event-ID，从其后补发"""
+        if last_id is None:
+            with self.app.app_context():
+                last_id = db.session.execute(select(func.max(EventLog.id))).scalar() or 0
+        subscription = Subscription(last_id)
+        with self.lock:
+            self.subscribers.add(subscription)
+            self.cursor = last_id if self.cursor is None else min(self.cursor, last_id)
+        self.wakeup.set()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+            if not self.subscribers:
+                self.cursor = None
+
+    def _loop(self):
+        pruned_at = 0
+        while True:
+            self.wakeup.wait(POLL_INTERVAL)
+            self.wakeup.clear()
+            try:
+                if time.monotonic() - pruned_at > PRUNE_INTERVAL:
+                    self._prune()
+                    pruned_at = time.monotonic()
+                self._dispatch()
+            except Exception as e:
+                logger.error(f"读取推送事件失败: {e}")
+
+    def _dispatch(self):
+        with self.lock:
+            cursor = self.cursor
+        if cursor is None:
+            return
+
+        with self.app.app_context():
+            rows = db.session.execute(
+                select(EventLog.id, EventLog.kind, EventLog.payload)
+                .where(EventLog.id > cursor)
+                .order_by(EventLog.id)
+                .limit(BATCH_SIZE)
+            ).all()
+        if not rows:
+            return
+
+        with self.lock:
+            for subscription in list(self.subscribers):
+                for row in rows:
+                    if row.id <= subscription.cursor:
+                        continue
+                    try:
+                        subscription.queue.put_nowait((row.id, row.kind, row.payload))
+                        subscription.cursor = row.id
+                    except queue.Full:
+                        # 页面处理不过来，断开后由浏览器重连补发
+                        subscription.closed = True
+                        self.subscribers.discard(subscription)
+                        break
+            # 重连的订阅者可能还需要补发更早的事件
+            self.cursor = min((subscription.cursor for subscription in self.subscribers), default=None)
+        if len(rows) == BATCH_SIZE:
+            self.wakeup.set()
+
+    def _prune(self):
+        cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=KEEP_SECONDS)
+        with self.app.app_context():
+            db.session.execute(delete(EventLog).where(EventLog.created_at < cutoff))
+            db.session.commit()
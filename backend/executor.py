@@ -0,0 +1,359 @@
+"""
+统一的脚本执行引擎
+立即运行（HTTP）和定时运行（调度器）都经过这里：创建运行记录、按脚本的执行方式选择执行后端、
+边运行边保存输出、按状态机推进 ScriptRun.status，并在排队、开始、结束时发出带耗时的事件。
+
+运行状态:
+    queued -> running -> success / failed / cancelled
+                         killed_timeout（超过运行超时或 CPU 时间上限）
+                         killed_oom（超过内存上限或被系统 OOM 杀掉）
+                         truncated（输出超过上限，运行被停止）
+    queued -> cancelled
+
+服务重启或 worker 崩溃时，进程内排队和运行中的记录不会再被执行，启动时由 recover 结束这些运行。
+"""
+from datetime import datetime, timedelta, timezone
+import json
+import logging
+import os
+import signal
+import subprocess
+import threading
+from sqlalchemy import select
+from sqlalchemy.orm import defer
+from models import db, Script, ScriptRun
+from leader import node_id
+from run_output import RunOutputWriter
+from worker_pool import run_subprocess, get_pool, is_supported, RunCancelled
+from inprocess import run_inprocess
+import dedup
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 单次运行的超时时间（秒）
+DEFAULT_TIMEOUT = 300
+# 排队或运行超过该时间（小时）的记录，无论属于哪个进程，启动时都视为遗留的运行
+STALE_HOURS = float(os.environ.get('RUN_STALE_HOURS', '24'))
+
+# 每个状态允许转换到的状态
+TRANSITIONS = {
+    'queued': ('running', 'cancelled'),
+    'running': ('success', 'failed', 'cancelled', 'killed_oom', 'killed_timeout', 'truncated'),
+}
+
+class InvalidTransition(Exception):
+    """不允许的运行状态转换"""
+
+def transition(run, status):
+    """推进运行状态，不合法的转换抛出 InvalidTransition"""
+    if status not in TRANSITIONS.get(run.status, ()):
+        raise InvalidTransition(f"运行ID={run.id} 的状态不能从 {run.status} 变为 {status}")
+    run.status = status
+
+def wrap_script(code):
+    """在独立进程中运行时，在脚本前加上导入路径和环境变量设置"""
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    return f"""
+import sys
+import os
+
+# 添加项目目录到Python路径
+sys.path.insert(0, r'{current_dir}')
+
+# 设置环境变量（如果脚本中使用了）
+os.environ['GEMINI_API_KEY'] = os.environ.get('GEMINI_API_KEY', '')
+os.environ['BARK_DEVICE_KEY'] = os.environ.get('BARK_DEVICE_KEY', '')
+os.environ['BARK_API_SERVER'] = os.environ.get('BARK_API_SERVER', '')
+
+# 执行用户脚本
+{code}
+"""
+
+def script_env(script):
+    """独立进程中运行的脚本的环境变量，SCRIPT_ID 用于推送去重（进程内运行时见 InprocessBackend）"""
+    return dict(os.environ, SCRIPT_ID=str(script.id))
+
+class Backend:
+    """执行后端接口
+
+    run 返回 subprocess.CompletedProcess；超时抛出 subprocess.TimeoutExpired，
+    cancel 被设置后抛出 RunCancelled；输出通过 on_output(stream, text) 回调实时传出。
+    子进程类后端应遵守 script.resource_limits() 中的内存和 CPU 上限
+    """
+    def run(self, script, timeout=None, cancel=None, on_output=None):
+        raise NotImplementedError
+
+class SubprocessBackend(Backend):
+    """每次运行启动新的 Python 解释器"""
+    def run(self, script, timeout=None, cancel=None, on_output=None):
+        return run_subprocess(wrap_script(script.code), timeout=timeout, env=script_env(script),
+                              cancel=cancel, on_output=on_output, limits=script.resource_limits())
+
+class PoolBackend(Backend):
+    """由预热的 fork server 创建子进程执行"""
+    def run(self, script, timeout=None, cancel=None, on_output=None):
+        return get_pool().run(wrap_script(script.code), timeout=timeout, env=script_env(script),
+                              cancel=cancel, on_output=on_output, limits=script.resource_limits())
+
+class InprocessBackend(Backend):
+    """在服务进程的线程中执行（仅限受信任脚本），不支持内存和 CPU 上限"""
+    def run(self, script, timeout=None, cancel=None, on_output=None):
+        return run_inprocess(script.code, timeout=timeout, cancel=cancel, on_output=on_output,
+                             version=script.updated_at, filename=f'<script {script.id}>',
+                             env={'SCRIPT_ID': str(script.id)})
+
+BACKENDS = {
+    'subprocess': SubprocessBackend(),
+    'pool': PoolBackend(),
+    'inprocess': InprocessBackend(),
+}
+
+def register_backend(name, backend):
+    """注册或替换执行后端"""
+    BACKENDS[name] = backend
+
+def resolve_backend(script):
+    """按脚本的执行方式选择后端；独立进程方式默认使用预热进程池（SCRIPT_EXECUTOR=subprocess 时关闭）"""
+    mode = script.execution_mode or 'subprocess'
+    if mode == 'subprocess' and os.environ.get('SCRIPT_EXECUTOR', 'pool') == 'pool' and is_supported():
+        mode = 'pool'
+    return BACKENDS[mode]
+
+class Executor:
+    def __init__(self, app=None, timeout=DEFAULT_TIMEOUT):
+        self.app = app
+        self.timeout = timeout
+        self.listeners = []
+
+    def init_app(self, app):
+        self.app = app
+
+    def add_listener(self, func):
+        """注册运行事件监听函数，参数为事件字典（run 为运行记录摘要）"""
+        self.listeners.append(func)
+
+    def enqueue(self, script_id, trigger='manual'):
+        """创建排队中的运行记录（需在应用上下文中调用）"""
+        run = ScriptRun(script_id=script_id, status='queued', owner=node_id())
+        db.session.add(run)
+        db.session.commit()
+        self._emit('queued', run, trigger)
+        return run
+
+    def recover(self):
+        """结束服务重启或 worker 崩溃后遗留的排队中（记为 cancelled）和运行中（记为 failed）的运行，返回处理的数量
+        
+        需在本进程开始执行运行之前调用。只处理本机上所属进程已退出（或进程号已被复用）的运行、
+        没有记录所属进程的旧运行和超过 STALE_HOURS 的运行，其他存活进程中的运行不受影响
+        """
+        host = node_id().rpartition(':')[0]
+        now = datetime.now(timezone.utc)
+        cutoff = now - timedelta(hours=STALE_HOURS)
+        with self.app.app_context():
+            runs = db.session.execute(
+                select(ScriptRun)
+                .options(defer(ScriptRun.output))
+                .where(ScriptRun.status.in_(('queued', 'running')))
+            ).scalars().all()
+            stale = [run for run in runs if _is_stale(run, host, cutoff)]
+            for run in stale:
+                transition(run, 'cancelled' if run.status == 'queued' else 'failed')
+                run.completed_at = now
+                run.duration = _seconds(run.started_at, run.completed_at)
+                run.error = (run.error or '') + ('\n' if run.error else '') + "Run interrupted by a service restart"
+            db.session.commit()
+            for run in stale:
+                self._emit('finished', run, 'recovery')
+        if stale:
+            logger.warning(f"已结束服务重启前遗留的运行 {len(stale)} 条")
+        return len(stale)
+    
+    def run_script(self, script_id, trigger='schedule', cancel=None):
+        """创建运行记录并在当前线程中执行"""
+        with self.app.app_context():
+            if db.session.get(Script, script_id) is None:
+                logger.error(f"脚本不存在: ID={script_id}")
+                return None
+            run_id = self.enqueue(script_id, trigger).id
+        return self.execute(run_id, trigger, cancel)
+
+    def execute(self, run_id, trigger='manual', cancel=None):
+        """执行一条排队中的运行记录，返回最终状态"""
+        with self.app.app_context():
+            run = db.session.get(ScriptRun, run_id)
+            if run is None:
+                return None
+            script = run.script
+
+            transition(run, 'running')
+            run.started_at = datetime.now(timezone.utc)
+            db.session.commit()
+            wait = _seconds(run.created_at, run.started_at)
+            self._emit('started', run, trigger, wait=wait)
+            logger.info(f"开始执行脚本: {script.name}")
+            metrics.RUN_QUEUE_WAIT.observe(max(wait or 0, 0), trigger=trigger)
+            metrics.RUNS_IN_FLIGHT.inc(trigger=trigger)
+
+            # 输出边运行边写入数据库；超过全局上限只截断保存的输出，脚本单独设置了上限时停止运行
+            stop = _StopSignal(cancel)
+            writer = RunOutputWriter(run.id, max_bytes=script.max_output_bytes,
+                                     on_truncate=stop.set if script.max_output_bytes else None)
+            status = 'failed'
+            usage = None
+            try:
+                result = resolve_backend(script).run(
+                    script,
+                    timeout=script.timeout_seconds or self.timeout,
+                    cancel=stop,
+                    on_output=writer.write
+                )
+                usage = getattr(result, 'usage', None)
+                metrics.merge(getattr(result, 'metrics', None))
+                status = _exit_status(result.returncode, script, writer, usage)
+                if status == 'killed_oom':
+                    writer.note("Script exceeded memory limit")
+                elif status == 'killed_timeout':
+                    writer.note("Script exceeded CPU time limit")
+                logger.info(f"脚本执行完成: {script.name}, 状态={status}")
+            except subprocess.TimeoutExpired as e:
+                usage = getattr(e, 'usage', None)
+                metrics.merge(getattr(e, 'metrics', None))
+                writer.note("Script execution timeout")
+                status = 'killed_timeout'
+                logger.error(f"脚本执行超时: {script.name}")
+            except RunCancelled as e:
+                usage = getattr(e, 'usage', None)
+                metrics.merge(getattr(e, 'metrics', None))
+                if stop.is_set() and not (cancel is not None and cancel.is_set()):
+                    writer.note("Script output exceeded limit, execution stopped")
+                    status = 'truncated'
+                    logger.warning(f"脚本输出超过上限，已停止: {script.name}")
+                else:
+                    writer.note("Script execution replaced by a newer run")
+                    status = 'cancelled'
+                    logger.warning(f"脚本执行被替换: {script.name}")
+            except Exception as e:
+                writer.note(str(e))
+                logger.error(f"脚本执行错误: {script.name}, 错误={str(e)}")
+            finally:
+                writer.close()
+                metrics.RUNS_IN_FLIGHT.dec(trigger=trigger)
+
+            transition(run, status)
+            run.completed_at = datetime.now(timezone.utc)
+            run.duration = _seconds(run.started_at, run.completed_at)
+            run.stdout_bytes = writer.received['stdout']
+            run.stderr_bytes = writer.received['stderr']
+            for field, value in (usage or {}).items():
+                setattr(run, field, value)
+            try:
+                with db.session.begin_nested():
+                    dedup.store_output(run, writer.output_hash, writer.written['stdout'])
+            except Exception as e:
+                logger.warning(f"运行输出去重失败: 运行ID={run.id}, 错误={e}")
+            db.session.commit()
+            metrics.RUN_DURATION.observe(run.duration or 0, script_id=script.id)
+            metrics.RUNS.inc(script_id=script.id, status=status)
+            self._emit('finished', run, trigger,
+                       duration=run.duration,
+                       bytes_out=writer.bytes_out,
+                       cpu=_total(run.cpu_user, run.cpu_system),
+                       max_rss_kb=run.max_rss_kb)
+            return status
+
+    def _emit(self, event, run, trigger, **fields):
+        payload = {
+            'event': event,
+            'run_id': run.id,
+            'script_id': run.script_id,
+            'trigger': trigger,
+            'status': run.status,
+            'at': datetime.now(timezone.utc).isoformat(),
+            **fields,
+        }
+        logger.info(f"运行事件: {json.dumps(payload, ensure_ascii=False)}")
+        if not self.listeners:
+            return
+        event = dict(payload, run=run.to_summary())
+        for listener in self.listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                logger.error(f"运行事件处理失败: {e}")
+
+class _StopSignal:
+    """合并调用方的取消标志和执行引擎自身的停止标志（如输出超限），供后端轮询"""
+    def __init__(self, cancel=None):
+        self.cancel = cancel
+        self.event = threading.Event()
+
+    def set(self):
+        self.event.set()
+
+    def is_set(self):
+        return self.event.is_set() or (self.cancel is not None and self.cancel.is_set())
+
+def _exit_status(returncode, script, writer, usage):
+    """根据退出码判断运行结果"""
+    if returncode == 0:
+        return 'success'
+    if returncode == -signal.SIGXCPU:
+        return 'killed_timeout'
+    if returncode == -signal.SIGKILL:
+        # 引擎自己杀进程时会抛出异常，这里的 SIGKILL 来自 CPU 硬上限或系统 OOM
+        cpu = _total((usage or {}).get('cpu_user'), (usage or {}).get('cpu_system'))
+        if script.cpu_limit_seconds and cpu is not None and cpu >= script.cpu_limit_seconds:
+            return 'killed_timeout'
+        return 'killed_oom'
+    lines = writer.stderr_tail.strip().splitlines()
+    if lines and lines[-1].startswith('MemoryError'):
+        return 'killed_oom'
+    return 'failed'
+
+def _is_stale(run, host, cutoff):
+    """运行是否已没有进程在执行"""
+    created_at = run.created_at.replace(tzinfo=timezone.utc) if run.created_at.tzinfo is None else run.created_at
+    if run.owner is None or created_at < cutoff:
+        return True
+    owner_host, _, pid = run.owner.rpartition(':')
+    if owner_host != host or not pid.isdigit():
+        # 其他节点上的运行由该节点自己清理
+        return False
+    pid = int(pid)
+    return pid == os.getpid() or not _process_alive(pid, created_at)
+
+def _process_alive(pid, since):
+    """进程是否存在且在 since 之前已经启动（之后启动的是复用了进程号的其他进程）"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            start_ticks = int(f.read().rpartition(')')[2].split()[19])
+        with open('/proc/stat') as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith('btime'))
+    except (OSError, ValueError, IndexError, StopIteration):
+        # 无法取得进程启动时间（非 Linux），按存活处理
+        return True
+    started = boot_time + start_ticks / os.sysconf('SC_CLK_TCK')
+    return started <= since.timestamp() + 1
+
+def _total(*values):
+    values = [value for value in values if value is not None]
+    return round(sum(values), 3) if values else None
+
+def _seconds(start, end):
+    # SQLite 取回的时间不带时区，按 UTC 处理
+    if start is None or end is None:
+        return None
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    if end.tzinfo is None:
+        end = end.replace(tzinfo=timezone.utc)
+    return round((end - start).total_seconds(), 3)
+
+executor = Executor()
@@ -0,0 +1,62 @@
+"""
+gunicorn 配置
+主进程在启动 worker 之前建表和补齐字段；每个 worker 启动后参与调度主节点选举，
+只有一个 worker 运行定时任务，其余 worker 只处理 API 请求。
+
+环境变量:
+    PORT: 监听端口（默认5000）
+    WEB_CONCURRENCY: worker 进程数（默认2）
+    WEB_THREADS: 每个 worker 的线程数（默认32，SSE 连接会长期占用一个线程，最多占用一半，见 SSE_MAX_STREAMS）
+    METRICS_DIR: 各 worker 共享指标的目录（默认为临时目录下按主进程号创建的目录，停止时删除）
+"""
+import os
+import shutil
+import tempfile
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', '32'))
+# gthread worker 的超时针对 worker 心跳而不是单个请求，长时间的 SSE 连接不受影响
+timeout = 60
+graceful_timeout = 30
+accesslog = '-'
+
+# 由本配置创建的指标目录，主进程退出时删除
+_metrics_dir = None
+
+def on_starting(server):
+    global _metrics_dir
+    # /metrics 汇总所有 worker 的指标，见 metrics.py
+    if not os.environ.get('METRICS_DIR'):
+        _metrics_dir = os.path.join(tempfile.gettempdir(), f'topic_tracker_metrics_{os.getpid()}')
+        os.environ['METRICS_DIR'] = _metrics_dir
+    import metrics
+    metrics.clear_shared()
+    from app import create_app, init_database
+    from models import db
+    app = create_app()
+    init_database(app)
+    # 关闭主进程中打开的数据库连接，fork 出的 worker 不会继承共享的连接
+    with app.app_context():
+        db.engine.dispose()
+
+def post_worker_init(worker):
+    from app import start_services
+    start_services(worker.wsgi)
+
+def worker_exit(server, worker):
+    # 主动释放调度租约，其他 worker 无需等待租约过期即可接管
+    from app import scheduler
+    import metrics
+    scheduler.stop()
+    metrics.write_shared(alive=False)
+
+def child_exit(server, worker):
+    # worker 异常退出时不会调用 worker_exit，由主进程标记，之后汇总时不再计入它的仪表
+    import metrics
+    metrics.mark_process_dead(worker.pid)
+
+def on_exit(server):
+    if _metrics_dir:
+        shutil.rmtree(_metrics_dir, ignore_errors=True)
@@ -0,0 +1,183 @@
+"""
+受信任脚本的进程内执行
+脚本在服务进程的线程中运行，省去启动解释器和编译源码的开销，编译结果按（代码哈希, 更新时间）缓存；
+print 等输出按线程重定向到本次运行。超时和取消是协作式的：在脚本线程中异步抛出异常，
+脚本阻塞在网络或 sleep 等调用中时，要等该调用返回后才会生效。
+脚本与服务共享内存、已导入的模块和环境变量，只应用于审核过的脚本。
+"""
+from collections import OrderedDict
+import builtins
+import ctypes
+import hashlib
+import linecache
+import os
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from worker_pool import RunCancelled, CANCEL_POLL_INTERVAL
+
+# Script.execution_mode 的可选值：subprocess 在独立进程中运行（默认），inprocess 在服务进程的线程中运行
+EXECUTION_MODES = ('subprocess', 'inprocess')
+# 编译结果缓存的最大条目数
+CODE_CACHE_SIZE = 128
+# 发出停止信号后等待脚本线程退出的时间（秒）
+STOP_GRACE = 5
+
+# 按线程覆盖的环境变量：进程内运行的脚本共享 os.environ，SCRIPT_ID 等按运行设置在脚本线程上
+_thread_env = threading.local()
+
+def getenv(name, default=None):
+    """读取环境变量，在进程内运行的脚本线程中优先返回本次运行设置的值"""
+    overrides = getattr(_thread_env, 'values', None)
+    if overrides and name in overrides:
+        return overrides[name]
+    return os.environ.get(name, default)
+
+class _Interrupted(BaseException):
+    """注入脚本线程的停止信号，继承 BaseException 以免被脚本的 except Exception 吞掉"""
+
+class _ThreadStream:
+    """按线程分发写入：正在运行脚本的线程写入该次运行，其他线程写入原始流"""
+    def __init__(self, name, original):
+        self.name = name
+        self.original = original
+        self.local = threading.local()
+
+    def write(self, text):
+        target = getattr(self.local, 'target', None)
+        if target is None:
+            return self.original.write(text)
+        target(self.name, text)
+        return len(text)
+
+    def flush(self):
+        if getattr(self.local, 'target', None) is None:
+            self.original.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.original, name)
+
+_streams = None
+_streams_lock = threading.Lock()
+
+def _install_streams():
+    """首次使用时替换 sys.stdout / sys.stderr"""
+    global _streams
+    with _streams_lock:
+        if _streams is None:
+            _streams = {
+                'stdout': _ThreadStream('stdout', sys.stdout),
+                'stderr': _ThreadStream('stderr', sys.stderr),
+            }
+            sys.stdout = _streams['stdout']
+            sys.stderr = _streams['stderr']
+        return _streams
+
+_code_cache = OrderedDict()
+_code_cache_lock = threading.Lock()
+
+def compile_script(code, version=None, filename='<script>'):
+    """编译脚本，相同代码和版本只编译一次"""
+    key = (hashlib.sha256(code.encode('utf-8')).hexdigest(), str(version), filename)
+    with _code_cache_lock:
+        compiled = _code_cache.get(key)
+        if compiled is not None:
+            _code_cache.move_to_end(key)
+            return compiled
+
+    compiled = compile(code, filename, 'exec')
+    # 让异常栈中能显示脚本源码
+    linecache.cache[filename] = (len(code), None, code.splitlines(True), filename)
+    with _code_cache_lock:
+        _code_cache[key] = compiled
+        while len(_code_cache) > CODE_CACHE_SIZE:
+            _code_cache.popitem(last=False)
+    return compiled
+
+def _interrupt(thread):
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread.ident), ctypes.py_object(_Interrupted))
+
+def run_inprocess(code, timeout=None, cancel=None, on_output=None, version=None, filename='<script>', env=None):
+    """在当前进程的新线程中执行脚本
+
+    参数和返回值（含 usage 属性）与 worker_pool.run_code 一致；version 为脚本的更新时间，用作编译缓存键的一部分；
+    env 为只对本次运行的脚本线程生效的环境变量（通过 getenv 读取，不修改 os.environ）
+    """
+    args = ['<inprocess>', filename]
+    collected = {'stdout': [], 'stderr': []}
+    emit = on_output or (lambda stream, text: collected[stream].append(text))
+
+    def value(stream):
+        return None if on_output else ''.join(collected[stream])
+
+    try:
+        compiled = compile_script(code, version, filename)
+    except SyntaxError as e:
+        emit('stderr', ''.join(traceback.format_exception_only(type(e), e)))
+        return subprocess.CompletedProcess(args, 1, value('stdout'), value('stderr'))
+
+    streams = _install_streams()
+    result = {'returncode': 1, 'cpu': None}
+
+    def target():
+        for stream in streams.values():
+            stream.local.target = emit
+        _thread_env.values = env
+        started = time.thread_time()
+        try:
+            exec(compiled, {'__name__': '__main__', '__builtins__': builtins})
+            result['returncode'] = 0
+        except SystemExit as e:
+            if e.code is None:
+                result['returncode'] = 0
+            elif isinstance(e.code, int):
+                result['returncode'] = e.code
+            else:
+                print(e.code, file=sys.stderr)
+        except _Interrupted:
+            pass
+        except BaseException as e:
+            traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+        finally:
+            result['cpu'] = round(time.thread_time() - started, 3)
+            _thread_env.values = None
+            for stream in streams.values():
+                stream.local.target = None
+
+    thread = threading.Thread(target=target, name=f'inprocess-{filename}', daemon=True)
+    thread.start()
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    reason = None
+    while thread.is_alive():
+        wait = CANCEL_POLL_INTERVAL
+        if deadline is not None:
+            wait = min(wait, max(deadline - time.monotonic(), 0))
+        thread.join(wait)
+        if not thread.is_alive():
+            break
+        if cancel is not None and cancel.is_set():
+            reason = 'cancelled'
+        elif deadline is not None and time.monotonic() >= deadline:
+            reason = 'timeout'
+        if reason:
+            _interrupt(thread)
+            thread.join(STOP_GRACE)
+            if thread.is_alive():
+                emit('stderr', f'\n脚本线程在 {STOP_GRACE} 秒内未响应停止信号，已放弃等待\n')
+            break
+
+    # 线程只能统计 CPU 时间（用户态与内核态合计），内存由整个服务进程共享，无法单独统计
+    usage = {'cpu_user': result['cpu'], 'cpu_system': None, 'max_rss_kb': None}
+    if reason == 'timeout':
+        error = subprocess.TimeoutExpired(args, timeout, output=value('stdout'), stderr=value('stderr'))
+    elif reason == 'cancelled':
+        error = RunCancelled(output=value('stdout'), stderr=value('stderr'))
+    else:
+        completed = subprocess.CompletedProcess(args, result['returncode'], value('stdout'), value('stderr'))
+        completed.usage = usage
+        return completed
+    error.usage = usage
+    raise error
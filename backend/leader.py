@@ -0,0 +1,155 @@
+"""
+调度主节点选举
+
+多个服务进程（gunicorn 的多个 worker 或多台机器）共享同一个数据库时，只有持有租约的进程运行定时任务，
+其余进程只提供 API。租约保存在 scheduler_lease 表中，持有者每隔 TTL/3 续约一次；
+持有者正常退出时主动释放，崩溃后租约在 TTL 秒后过期，由其他进程接管。各节点的系统时钟需要大致同步。
+"""
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import update, or_, case
+from sqlalchemy.exc import IntegrityError
+import atexit
+import logging
+import os
+import socket
+import threading
+import time
+from models import db, SchedulerLease
+
+logger = logging.getLogger(__name__)
+
+# 租约有效期（秒）
+LEASE_TTL = int(os.environ.get('SCHEDULER_LEASE_TTL', '30'))
+
+def node_id():
+    """当前进程的标识：节点名（SCHEDULER_NODE_ID，默认主机名）:进程号"""
+    return f"{os.environ.get('SCHEDULER_NODE_ID') or socket.gethostname()}:{os.getpid()}"
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+class LeaderElector:
+    def __init__(self, app=None, name='scheduler', ttl=LEASE_TTL, on_elected=None, on_revoked=None, on_tick=None):
+        """
+        Args:
+            on_elected / on_revoked: 成为主节点、失去主节点身份时调用
+            on_tick: 作为主节点时每次续约成功后调用
+        """
+        self.app = app
+        self.name = name
+        self.ttl = max(ttl, 3)
+        self.interval = self.ttl / 3
+        self.on_elected = on_elected
+        self.on_revoked = on_revoked
+        self.on_tick = on_tick
+        self.identity = None
+        self.is_leader = False
+        self.deadline = 0  # 本地认为租约仍然有效的最后时刻（monotonic）
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """启动选举线程（进程号在 fork 之后才确定，所以在这里生成标识）"""
+        self.identity = node_id()
+        self.thread = threading.Thread(target=self._loop, name='leader-election', daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+        logger.info(f"参与调度主节点选举: {self.identity}")
+
+    def stop(self):
+        """停止选举，持有租约时立即释放，其他进程无需等待过期即可接管"""
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            # 等待进行中的续约结束，以免释放后又被续上
+            self.thread.join(self.interval)
+        if self.is_leader:
+            self._set_leader(False)
+            try:
+                self.release()
+            except Exception as e:
+                logger.warning(f"释放调度租约失败: {e}")
+
+    def try_acquire(self):
+        """获取或续约租约，返回是否持有"""
+        now = _utcnow()
+        expires_at = now + timedelta(seconds=self.ttl)
+        with self.app.app_context():
+            try:
+                result = db.session.execute(
+                    update(SchedulerLease)
+                    .where(
+                        SchedulerLease.name == self.name,
+                        or_(SchedulerLease.holder == self.identity, SchedulerLease.expires_at < now)
+                    )
+                    .values(
+                        acquired_at=case((SchedulerLease.holder == self.identity, SchedulerLease.acquired_at), else_=now),
+                        holder=self.identity,
+                        expires_at=expires_at
+                    )
+                )
+                if result.rowcount == 0:
+                    if db.session.get(SchedulerLease, self.name) is not None:
+                        # 租约由其他进程持有且未过期
+                        db.session.rollback()
+                        return False
+                    db.session.add(SchedulerLease(name=self.name, holder=self.identity,
+                                                  acquired_at=now, expires_at=expires_at))
+                db.session.commit()
+                return True
+            except IntegrityError:
+                # 其他进程同时创建了租约
+                db.session.rollback()
+                return False
+            except Exception:
+                db.session.rollback()
+                raise
+
+    def release(self):
+        with self.app.app_context():
+            db.session.execute(
+                update(SchedulerLease)
+                .where(SchedulerLease.name == self.name, SchedulerLease.holder == self.identity)
+                .values(expires_at=_utcnow())
+            )
+            db.session.commit()
+
+    def current(self):
+        """当前的租约信息"""
+        with self.app.app_context():
+            lease = db.session.get(SchedulerLease, self.name)
+            return lease.to_dict() if lease else None
+
+    def _loop(self):
+        while not self.stopped.is_set():
+            try:
+                held = self.try_acquire()
+                if held:
+                    # 留出一个续约周期的余量，避免本地时钟误差导致两个主节点同时运行
+                    self.deadline = time.monotonic() + self.ttl - self.interval
+            except Exception as e:
+                logger.error(f"续约调度租约失败: {e}")
+                # 数据库暂时不可用时，租约到期前仍保持主节点身份
+                held = self.is_leader and time.monotonic() < self.deadline
+
+            if self.stopped.is_set():
+                break
+            if held != self.is_leader:
+                self._set_leader(held)
+            if held and self.on_tick:
+                try:
+                    self.on_tick()
+                except Exception as e:
+                    logger.error(f"主节点定时任务同步失败: {e}")
+            self.stopped.wait(self.interval)
+
+    def _set_leader(self, value):
+        self.is_leader = value
+        callback = self.on_elected if value else self.on_revoked
+        logger.info(f"{self.identity} {'成为' if value else '不再是'}调度主节点")
+        if callback:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"调度主节点切换处理失败: {e}")
@@ -0,0 +1,347 @@
+"""
+Prometheus 文本格式的运行指标
+
+指标保存在进程内。脚本子进程（预热进程池或 subprocess）中记录的指标（如 Gemini、Bark 的调用耗时）
+在子进程退出时写入环境变量 METRICS_FD 指定的管道，由执行引擎合并到服务进程，再通过 /metrics 暴露。
+计数器和直方图可以跨进程累加；仪表（Gauge）只反映当前进程的状态，不会回传。
+
+gunicorn 多 worker 部署时设置 METRICS_DIR（gunicorn.conf.py 默认设置）：每个服务进程定期把指标写入该目录下的
+<进程号>.json，/metrics 汇总所有进程的计数器和直方图（包括已退出的 worker，保证计数单调递增），
+仪表只累加仍在运行的进程。
+"""
+import atexit
+import glob
+import json
+import math
+import os
+import threading
+import time
+
+# 默认的耗时直方图分桶（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# 共享目录的环境变量和写入间隔（秒）
+METRICS_DIR_ENV = 'METRICS_DIR'
+SHARE_INTERVAL = 5
+
+REGISTRY = {}
+_lock = threading.Lock()
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        REGISTRY[name] = self
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"指标 {self.name} 的标签应为 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def current(self):
+        """采集时的值 {标签元组: 值}"""
+        return self.values
+
+    def dump(self):
+        return [[list(key), value] for key, value in self.current().items()]
+
+    def load(self, data, values=None):
+        """把 dump 的结果累加到 values（默认为本进程的值）"""
+        values = self.values if values is None else values
+        for key, value in data:
+            key = tuple(key)
+            values[key] = self._add(values.get(key), value)
+
+    @staticmethod
+    def _add(current, value):
+        return (current or 0) + value
+
+    def samples(self, values=None):
+        raise NotImplementedError
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self, values=None):
+        for key, value in (self.current() if values is None else values).items():
+            yield self.name + '_total', self._labels(key), value
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        """function: 可选的回调，采集时调用并返回 {标签元组: 值}"""
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def current(self):
+        return self.function() if self.function else self.values
+
+    def samples(self, values=None):
+        for key, value in (self.current() if values is None else values).items():
+            yield self.name, self._labels(key), value
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            data = self.values.get(key)
+            if data is None:
+                data = self.values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data['counts'][i] += 1
+                    break
+            data['sum'] += value
+            data['count'] += 1
+
+    def time(self, **labels):
+        """计时上下文管理器"""
+        return _Timer(self, labels)
+
+    def samples(self, values=None):
+        for key, data in (self.current() if values is None else values).items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, data['counts']):
+                cumulative += count
+                yield self.name + '_bucket', self._labels(key, ('le', _format(bound))), cumulative
+            yield self.name + '_bucket', self._labels(key, ('le', '+Inf')), data['count']
+            yield self.name + '_sum', self._labels(key), data['sum']
+            yield self.name + '_count', self._labels(key), data['count']
+
+    @staticmethod
+    def _add(current, other):
+        if current is None:
+            return {'counts': list(other['counts']), 'sum': other['sum'], 'count': other['count']}
+        return {
+            'counts': [a + b for a, b in zip(current['counts'], other['counts'])],
+            'sum': current['sum'] + other['sum'],
+            'count': current['count'] + other['count'],
+        }
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if 'outcome' in self.histogram.labelnames and 'outcome' not in self.labels:
+            # 流式调用被调用方提前关闭（GeneratorExit）不算失败
+            failed = exc_type is not None and not issubclass(exc_type, GeneratorExit)
+            self.labels['outcome'] = 'error' if failed else 'success'
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+def render():
+    """按 Prometheus 文本格式（0.0.4）输出所有指标（设置了共享目录时为所有服务进程的汇总）"""
+    lines = []
+    with _lock:
+        combined = _combine_shared()
+        for metric in REGISTRY.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples(combined.get(metric.name)):
+                lines.append(f'{name}{labels} {_format(value)}')
+    return '\n'.join(lines) + '\n'
+
+def snapshot():
+    """可跨进程累加的指标（计数器、直方图）的当前值"""
+    with _lock:
+        return {
+            metric.name: metric.dump()
+            for metric in REGISTRY.values()
+            if metric.kind in ('counter', 'histogram') and metric.values
+        }
+
+def merge(data):
+    """把子进程回传的指标累加到当前进程"""
+    if not data:
+        return
+    with _lock:
+        for name, values in data.items():
+            metric = REGISTRY.get(name)
+            if metric is not None and metric.kind in ('counter', 'histogram'):
+                metric.load(values)
+
+def export_to_parent():
+    """子进程退出时把指标写入 METRICS_FD 管道"""
+    fd = os.environ.get('METRICS_FD')
+    if not fd:
+        return
+    data = snapshot()
+    if not data:
+        return
+    try:
+        os.write(int(fd), json.dumps(data).encode('utf-8'))
+    except (OSError, ValueError):
+        pass
+
+atexit.register(export_to_parent)
+
+# ---------------------------------------------------------------------------
+# 多进程共享
+# ---------------------------------------------------------------------------
+
+_shared_pid = None  # 写入共享目录的进程，fork 出的脚本子进程不会写入
+
+def _shared_path(pid):
+    return os.path.join(os.environ[METRICS_DIR_ENV], f'{pid}.json')
+
+def clear_shared():
+    """清空共享目录（gunicorn 主进程启动 worker 前调用，计数从零开始）"""
+    directory = os.environ.get(METRICS_DIR_ENV)
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        os.remove(path)
+
+def start_sharing():
+    """设置了 METRICS_DIR 时，在后台定期把本进程的指标写入共享目录"""
+    global _shared_pid
+    if not os.environ.get(METRICS_DIR_ENV) or _shared_pid is not None:
+        return
+    os.makedirs(os.environ[METRICS_DIR_ENV], exist_ok=True)
+    # 进程号被复用时，接着之前同号进程的计数累加
+    previous = _read_shared(_shared_path(os.getpid()))
+    if previous:
+        merge(previous['metrics'])
+    _shared_pid = os.getpid()
+    threading.Thread(target=_share_loop, name='metrics-share', daemon=True).start()
+    atexit.register(write_shared, False)
+
+def _share_loop():
+    while True:
+        time.sleep(SHARE_INTERVAL)
+        write_shared()
+
+def write_shared(alive=True):
+    """把本进程的全部指标（仪表取当前值）写入共享目录；alive=False 表示进程已退出，汇总时不再计入仪表"""
+    if _shared_pid != os.getpid():
+        return
+    with _lock:
+        data = {'alive': alive, 'metrics': {metric.name: metric.dump() for metric in REGISTRY.values()}}
+    path = _shared_path(_shared_pid)
+    try:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        pass
+
+def mark_process_dead(pid):
+    """worker 退出后由 gunicorn 主进程调用，之后只汇总它的计数器和直方图"""
+    if not os.environ.get(METRICS_DIR_ENV):
+        return
+    path = _shared_path(pid)
+    data = _read_shared(path)
+    if data and data.get('alive'):
+        data['alive'] = False
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(data, f)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            pass
+
+def _read_shared(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _combine_shared():
+    """本进程的值加上共享目录中其他进程的值，返回 {指标名: {标签元组: 值}}；未共享时返回空字典（需持有 _lock）"""
+    if _shared_pid != os.getpid():
+        return {}
+    combined = {}
+    for metric in REGISTRY.values():
+        combined[metric.name] = {}
+        metric.load(metric.dump(), combined[metric.name])
+    for path in glob.glob(os.path.join(os.environ[METRICS_DIR_ENV], '*.json')):
+        if path == _shared_path(_shared_pid):
+            continue
+        data = _read_shared(path)
+        if not data:
+            continue
+        for name, values in data['metrics'].items():
+            metric = REGISTRY.get(name)
+            if metric is None or (metric.kind == 'gauge' and not data.get('alive')):
+                continue
+            metric.load(values, combined[name])
+    return combined
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+# ---------------------------------------------------------------------------
+# 指标定义
+# ---------------------------------------------------------------------------
+
+RUN_DURATION = Histogram('topic_tracker_run_duration_seconds', '脚本运行耗时', ['script_id'])
+RUN_QUEUE_WAIT = Histogram('topic_tracker_run_queue_wait_seconds', '运行从排队到开始执行的等待时间', ['trigger'])
+RUNS = Counter('topic_tracker_runs', '结束的运行次数', ['script_id', 'status'])
+RUNS_IN_FLIGHT = Gauge('topic_tracker_runs_in_flight', '正在执行的运行数', ['trigger'])
+RUN_QUEUE_WORKERS = Gauge('topic_tracker_run_queue_workers', '立即运行队列的线程（busy 忙碌, capacity 上限, pending 等待中的任务）', ['state'])
+SCHEDULER_WORKERS = Gauge('topic_tracker_scheduler_workers', '定时任务线程池（busy 忙碌, capacity 上限, queued 排队等待的触发）', ['state'])
+SCHEDULER_LEADER = Gauge('topic_tracker_scheduler_leader', '当前进程是否为运行定时任务的调度主节点')
+SCHEDULER_MISFIRES = Counter('topic_tracker_scheduler_misfires', '错过补跑时间而未执行的定时触发', ['script_id'])
+SCHEDULER_SKIPPED = Counter('topic_tracker_scheduler_skipped', '因上一次运行未结束而跳过的定时触发', ['script_id'])
+GEMINI_LATENCY = Histogram('topic_tracker_gemini_request_seconds', 'Gemini API 调用耗时', ['model', 'outcome'])
+BARK_LATENCY = Histogram('topic_tracker_bark_push_seconds', 'Bark 推送耗时', ['outcome'])
+DB_COMMIT_LATENCY = Histogram(
+    'topic_tracker_db_commit_seconds', '数据库事务提交耗时（含 flush）',
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 15)
+)
+NOTIFICATIONS = Counter('topic_tracker_notifications', '发件箱推送的投递结果（sent 已送达, retry 稍后重试, failed 放弃）', ['outcome'])
+DEDUP_SKIPPED = Counter('topic_tracker_dedup_skipped', '因内容重复而跳过的推送（push）和改为引用保存的运行输出（output）', ['kind', 'match'])
+NOTIFICATION_DELIVERY_LATENCY = Histogram(
+    'topic_tracker_notification_delivery_seconds', '推送从写入发件箱到送达的延迟（含合并等待和重试）',
+    buckets=(1, 2.5, 5, 10, 15, 30, 60, 120, 300, 900, 3600, 14400)
+)
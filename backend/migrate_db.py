@@ -1,13 +1,84 @@
 #!/usr/bin/env python
 """
 数据库迁移脚本
-从旧的调度方式（interval_minutes和schedule_times）迁移到新的cron表达式
+从旧的调度方式（interval_minutes和schedule_times）迁移到新的cron表达式，
+并为已有数据库补齐后续版本新增的字段
 """
 
 import sqlite3
 import json
+import logging
 import os
 import sys
+from sqlalchemy import BigInteger, Boolean, DateTime, Float, Integer, String, inspect, literal, text
+
+logger = logging.getLogger(__name__)
+
+# 后续版本新增的字段：(表名, 字段名, 字段类型, 默认值)
+# db.create_all() 不会修改已存在的表，启动时由 upgrade_schema 补齐字段和索引；
+# 字段类型和默认值按数据库方言编译（SQLite 与 PostgreSQL 的类型写法不同）
+NEW_COLUMNS = [
+    ('script', 'max_instances', Integer(), 1),
+    ('script', 'overlap_policy', String(20), 'skip'),
+    ('script', 'coalesce', Boolean(), True),
+    ('script', 'misfire_grace_time', Integer(), 60),
+    ('script', 'jitter_seconds', Integer(), None),
+    ('script', 'execution_mode', String(20), 'subprocess'),
+    ('script', 'timeout_seconds', Integer(), 300),
+    ('script', 'memory_limit_mb', Integer(), None),
+    ('script', 'cpu_limit_seconds', Integer(), None),
+    ('script', 'max_output_bytes', Integer(), None),
+    ('script_run', 'started_at', DateTime(), None),
+    ('script_run', 'duration', Float(), None),
+    ('script_run', 'cpu_user', Float(), None),
+    ('script_run', 'cpu_system', Float(), None),
+    ('script_run', 'max_rss_kb', Integer(), None),
+    ('script_run', 'stdout_bytes', Integer(), None),
+    ('script_run', 'stderr_bytes', Integer(), None),
+    ('script_run', 'output_hash', String(64), None),
+    ('script_run', 'owner', String(100), None),
+    ('run_daily_stat', 'duration_count', Integer(), None),
+    ('notification', 'script_id', Integer(), None),
+    ('notification', 'content_hash', String(64), None),
+    ('notification', 'simhash', BigInteger(), None),
+]
+
+# 后续版本新增的索引：(索引名, 表名, 字段列表)
+NEW_INDEXES = [
+    ('ix_script_run_script_created', 'script_run', ['script_id', 'created_at']),
+    ('ix_script_run_output_hash', 'script_run', ['output_hash']),
+    ('ix_notification_device_created', 'notification', ['device_key', 'created_at']),
+]
+
+def upgrade_schema(engine):
+    """为已存在的表补齐缺失的字段和索引，返回新增的字段/索引列表"""
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    existing = {table: {c['name'] for c in inspector.get_columns(table)} for table in tables}
+    
+    added = []
+    with engine.begin() as conn:
+        for table, column, column_type, default in NEW_COLUMNS:
+            if table in tables and column not in existing[table]:
+                ddl = _column_ddl(engine.dialect, column, column_type, default)
+                conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {ddl}'))
+                added.append(f'{table}.{column}')
+        for name, table, columns in NEW_INDEXES:
+            if table in tables and name not in {i['name'] for i in inspector.get_indexes(table)}:
+                conn.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({", ".join(columns)})'))
+                added.append(name)
+    
+    if added:
+        logger.info(f"已添加字段/索引: {', '.join(added)}")
+    return added
+
+def _column_ddl(dialect, column, column_type, default):
+    """按数据库方言生成 ADD COLUMN 的字段定义"""
+    ddl = f'{dialect.identifier_preparer.quote_identifier(column)} {column_type.compile(dialect=dialect)}'
+    if default is not None:
+        value = literal(default, column_type).compile(dialect=dialect, compile_kwargs={'literal_binds': True})
+        ddl += f' DEFAULT {value}'
+    return ddl
 
 def migrate_database(db_path):
     """执行数据库迁移"""
@@ -83,15 +154,24 @@ def migrate_database(db_path):
         # cursor.execute("ALTER TABLE script DROP COLUMN schedule_type")
         
         conn.commit()
-        print("数据库迁移完成！")
-        return True
-        
     except Exception as e:
         print(f"迁移失败: {e}")
         conn.rollback()
         return False
     finally:
         conn.close()
+    
+    try:
+        from sqlalchemy import create_engine
+        added = upgrade_schema(create_engine(f'sqlite:///{os.path.abspath(db_path)}'))
+        if added:
+            print(f"已添加字段/索引: {', '.join(added)}")
+    except Exception as e:
+        print(f"补齐新字段失败: {e}")
+        return False
+    
+    print("数据库迁移完成！")
+    return True
 
 if __name__ == "__main__":
     # 获取数据库路径
@@ -1,5 +1,7 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime, timezone
+import json
+import cron
 
 db = SQLAlchemy()
 
@@ -10,39 +12,234 @@ class Script(db.Model):
     code = db.Column(db.Text, nullable=False)
     cron_expression = db.Column(db.String(100))  # cron表达式，如 "0 9 * * *" 表示每天9点
     is_active = db.Column(db.Boolean, default=False)
+    # 调度并发控制
+    max_instances = db.Column(db.Integer, default=1)  # 同一脚本同时运行的最大实例数
+    overlap_policy = db.Column(db.String(20), default='skip')  # 上一次运行未结束时：skip 跳过, queue 排队, replace 替换
+    coalesce = db.Column(db.Boolean, default=True)  # 错过的多次触发是否合并为一次
+    misfire_grace_time = db.Column(db.Integer, default=60)  # 错过触发后仍允许补跑的秒数
+    jitter_seconds = db.Column(db.Integer)  # 错峰窗口（秒），触发时间固定推迟窗口内的一个偏移量，为空时使用全局默认值
+    execution_mode = db.Column(db.String(20), default='subprocess')  # subprocess 独立进程, inprocess 服务进程内（仅限受信任脚本）
+    # 资源限制，为空时使用全局默认值或不限制
+    timeout_seconds = db.Column(db.Integer, default=300)  # 运行超时（秒）
+    memory_limit_mb = db.Column(db.Integer)  # 内存（地址空间）上限（MB）
+    cpu_limit_seconds = db.Column(db.Integer)  # CPU 时间上限（秒）
+    max_output_bytes = db.Column(db.Integer)  # 每路输出上限（字节），超出后停止运行
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     
     runs = db.relationship('ScriptRun', backref='script', lazy=True, cascade='all, delete-orphan')
+    daily_stats = db.relationship('RunDailyStat', lazy=True, cascade='all, delete-orphan')
     
     def to_dict(self):
+        data = self.to_summary()
+        data['code'] = self.code
+        return data
+    
+    def to_summary(self):
+        """脚本列表使用的精简字段，不含代码"""
         return {
             'id': self.id,
             'name': self.name,
             'description': self.description,
-            'code': self.code,
             'cron_expression': self.cron_expression,
             'is_active': self.is_active,
+            'max_instances': self.max_instances,
+            'overlap_policy': self.overlap_policy,
+            'coalesce': self.coalesce,
+            'misfire_grace_time': self.misfire_grace_time,
+            'jitter_seconds': self.jitter_seconds,
+            'schedule_offset': self.schedule_offset(),
+            'execution_mode': self.execution_mode or 'subprocess',
+            'timeout_seconds': self.timeout_seconds,
+            'memory_limit_mb': self.memory_limit_mb,
+            'cpu_limit_seconds': self.cpu_limit_seconds,
+            'max_output_bytes': self.max_output_bytes,
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat()
         }
+    
+    def schedule_options(self):
+        """传给 TaskScheduler.add_job 的调度参数"""
+        options = {
+            'max_instances': self.max_instances or 1,
+            'overlap_policy': self.overlap_policy or 'skip',
+            'coalesce': True if self.coalesce is None else self.coalesce,
+            'misfire_grace_time': self.misfire_grace_time,
+        }
+        jitter = self.effective_jitter()
+        if jitter:
+            # 未设置错峰时不加入该参数，已保存的任务不需要重新创建
+            options['jitter_seconds'] = jitter
+        return options
+    
+    def effective_jitter(self):
+        return cron.DEFAULT_JITTER if self.jitter_seconds is None else self.jitter_seconds
+    
+    def schedule_offset(self):
+        """定时触发相对 cron 时间推迟的秒数"""
+        return cron.spread_offset(self.id, self.effective_jitter())
+    
+    def resource_limits(self):
+        """传给执行后端的子进程资源上限"""
+        return {
+            'memory_mb': self.memory_limit_mb,
+            'cpu_seconds': self.cpu_limit_seconds,
+        }
 
 class ScriptRun(db.Model):
+    __table_args__ = (
+        # 按脚本分页查询运行历史
+        db.Index('ix_script_run_script_created', 'script_id', 'created_at'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     script_id = db.Column(db.Integer, db.ForeignKey('script.id'), nullable=False)
-    status = db.Column(db.String(20), default='running')  # running, success, failed
+    status = db.Column(db.String(20), default='running')  # queued, running, success, failed, cancelled, killed_oom, killed_timeout, truncated
     output = db.Column(db.Text)
     error = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    started_at = db.Column(db.DateTime)
     completed_at = db.Column(db.DateTime)
+    # 资源占用
+    duration = db.Column(db.Float)  # 运行耗时（秒）
+    cpu_user = db.Column(db.Float)  # 用户态 CPU 时间（秒）
+    cpu_system = db.Column(db.Float)  # 内核态 CPU 时间（秒）
+    max_rss_kb = db.Column(db.Integer)  # 峰值常驻内存（KB）
+    stdout_bytes = db.Column(db.Integer)  # 标准输出字节数（含被截断的部分）
+    stderr_bytes = db.Column(db.Integer)  # 错误输出字节数
+    owner = db.Column(db.String(100))  # 执行该运行的进程（节点名:进程号），服务启动时据此清理遗留的运行
+    # 与之前的运行输出完全相同时，output 为空，内容保存在 output_blob 中按哈希共享
+    output_hash = db.Column(db.String(64), index=True)
+    
+    def to_summary(self):
+        """运行历史列表使用的精简字段，不含输出内容"""
+        return {
+            'id': self.id,
+            'script_id': self.script_id,
+            'status': self.status,
+            'created_at': self.created_at.isoformat(),
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'completed_at': self.completed_at.isoformat() if self.completed_at else None,
+            'duration': self.duration,
+            'cpu_user': self.cpu_user,
+            'cpu_system': self.cpu_system,
+            'max_rss_kb': self.max_rss_kb,
+            'stdout_bytes': self.stdout_bytes,
+            'stderr_bytes': self.stderr_bytes
+        }
+    
+    def to_dict(self):
+        data = self.to_summary()
+        data['output'] = self.full_output()
+        data['error'] = self.error
+        return data
+    
+    def full_output(self):
+        """标准输出内容（去重后保存为引用的从 output_blob 读取）"""
+        if self.output is None and self.output_hash:
+            blob = db.session.get(OutputBlob, self.output_hash)
+            return blob.content if blob else None
+        return self.output
+
+class OutputBlob(db.Model):
+    """按 SHA-256 共享的运行输出，同一脚本重复产生的相同输出只保存一份"""
+    __tablename__ = 'output_blob'
+    
+    hash = db.Column(db.String(64), primary_key=True)
+    content = db.Column(db.Text, nullable=False)
+    size = db.Column(db.Integer)  # 字节数
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+class RunDailyStat(db.Model):
+    """清理旧运行记录时按脚本、按天（北京时间）汇总的统计"""
+    __table_args__ = (
+        db.UniqueConstraint('script_id', 'day', name='uq_run_daily_stat_script_day'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    script_id = db.Column(db.Integer, db.ForeignKey('script.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    total = db.Column(db.Integer, default=0)
+    success = db.Column(db.Integer, default=0)
+    failed = db.Column(db.Integer, default=0)
+    p50_duration = db.Column(db.Float)  # 秒
+    p95_duration = db.Column(db.Float)  # 秒
+    duration_count = db.Column(db.Integer, default=0)  # 有耗时的运行数，分位数按它加权合并
+    
+    def to_dict(self):
+        return {
+            'script_id': self.script_id,
+            'day': self.day.isoformat(),
+            'total': self.total,
+            'success': self.success,
+            'failed': self.failed,
+            'success_rate': round(self.success / self.total, 4) if self.total else None,
+            'p50_duration': self.p50_duration,
+            'p95_duration': self.p95_duration
+        }
+
+class SchedulerLease(db.Model):
+    """调度主节点租约，同一时刻只有持有者运行定时任务（时间为不带时区的 UTC）"""
+    __tablename__ = 'scheduler_lease'
+    
+    name = db.Column(db.String(50), primary_key=True)
+    holder = db.Column(db.String(200), nullable=False)  # 持有者标识，主机名:进程号
+    acquired_at = db.Column(db.DateTime)
+    expires_at = db.Column(db.DateTime, nullable=False)
     
     def to_dict(self):
+        return {
+            'holder': self.holder,
+            'acquired_at': self.acquired_at.isoformat() if self.acquired_at else None,
+            'expires_at': self.expires_at.isoformat()
+        }
+
+class EventLog(db.Model):
+    """推送给前端的运行和脚本变更事件，各服务进程从这里读取其他进程产生的事件"""
+    __tablename__ = 'event_log'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # run, script
+    payload = db.Column(db.Text, nullable=False)  # JSON
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), index=True)
+
+class Notification(db.Model):
+    """Bark 推送发件箱：脚本写入后立即返回，由后台投递线程发送（时间为不带时区的 UTC）"""
+    __tablename__ = 'notification'
+    __table_args__ = (
+        db.Index('ix_notification_status_next', 'status', 'next_attempt_at'),
+        db.Index('ix_notification_device_created', 'device_key', 'created_at'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    script_id = db.Column(db.Integer)  # 发出推送的脚本（进程内执行的脚本为空）
+    device_key = db.Column(db.String(200), nullable=False)
+    group_name = db.Column(db.String(100), default='')  # 同一设备、同一分组的推送会合并发送
+    payload = db.Column(db.Text, nullable=False)  # Bark 请求体（JSON）
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, sending, sent, failed
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False)  # 下次投递时间；sending 状态下为认领过期时间
+    claim = db.Column(db.String(100))  # 正在投递的进程和批次
+    last_error = db.Column(db.Text)
+    # 内容指纹：标题和正文的 SHA-256，正文的 64 位 simhash，用于跳过重复的推送
+    content_hash = db.Column(db.String(64))
+    simhash = db.Column(db.BigInteger)
+    created_at = db.Column(db.DateTime, nullable=False)
+    sent_at = db.Column(db.DateTime)
+    
+    def to_dict(self):
+        payload = json.loads(self.payload)
         return {
             'id': self.id,
             'script_id': self.script_id,
+            'device_key': f'...{self.device_key[-4:]}',
+            'group': self.group_name,
+            'title': payload.get('title', ''),
+            'body': payload.get('body', ''),
             'status': self.status,
-            'output': self.output,
-            'error': self.error,
+            'attempts': self.attempts,
+            'next_attempt_at': self.next_attempt_at.isoformat() if self.status == 'pending' else None,
+            'last_error': self.last_error,
             'created_at': self.created_at.isoformat(),
-            'completed_at': self.completed_at.isoformat() if self.completed_at else None
-        }
\ No newline at end of file
+            'sent_at': self.sent_at.isoformat() if self.sent_at else None
+        }
@@ -0,0 +1,266 @@
+"""
+Bark 推送发件箱
+脚本中的 send_bark_notification 把推送写入 notification 表后立即返回，不再占用脚本的运行时间；
+每个服务进程有一个后台线程投递到期的推送：先认领（status=sending）再发送，认领在 CLAIM_TTL 秒后过期，
+投递中的进程崩溃后由其他进程重新发送。失败按指数退避重试，
+同一设备、同一分组在 DIGEST_WINDOW 秒内的多条推送合并成一条摘要发送。
+"""
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine, select, update, delete, insert, and_, or_
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from models import db, Notification
+from database import engine_options
+from bark_sender import BarkClient
+from leader import node_id
+from inprocess import getenv
+from dedup import push_fingerprint, find_duplicate_push
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 合并窗口（秒）：推送入队后最多等待这么久，与同一设备、同一分组的其他推送合并发送，0 表示不等待
+DIGEST_WINDOW = float(os.environ.get('OUTBOX_DIGEST_WINDOW', '10'))
+# 一条摘要最多包含的推送数和正文字数，超出后拆成多条
+DIGEST_MAX_ITEMS = 10
+DIGEST_MAX_CHARS = 3000
+# 最多投递次数，之后标记为 failed
+MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '10'))
+# 第 n 次失败后等待 RETRY_BACKOFF * 2^(n-1) 秒再重试，最长 MAX_RETRY_DELAY 秒
+RETRY_BACKOFF = float(os.environ.get('OUTBOX_RETRY_BACKOFF', '10'))
+MAX_RETRY_DELAY = 3600
+# 认领后多久未完成视为投递进程已退出（秒），需大于一次发送（含重试）的最长耗时
+CLAIM_TTL = 120
+POLL_INTERVAL = 2.0
+BATCH_SIZE = 200
+# 已发送和已失败的推送保留天数
+KEEP_DAYS = int(os.environ.get('OUTBOX_KEEP_DAYS', '7'))
+PRUNE_INTERVAL = 3600
+
+# 服务进程在 init_app 时写入，脚本子进程继承后即可写入同一个数据库
+DATABASE_URL_ENV = 'OUTBOX_DATABASE_URL'
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def is_enabled():
+    """当前进程是否把推送写入发件箱（BARK_OUTBOX=0 时直接发送）"""
+    return os.environ.get('BARK_OUTBOX', '1') != '0' and bool(os.environ.get(DATABASE_URL_ENV))
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def _get_engine():
+    """脚本进程中没有 Flask 应用，直接按连接地址创建引擎"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            url = os.environ[DATABASE_URL_ENV]
+            _engine = create_engine(url, **engine_options(url))
+        return _engine
+
+def enqueue(payloads, dedup=True):
+    """写入多条推送（Bark 请求体，见 bark_sender.build_payload）
+
+    dedup 为 True 时跳过与同一脚本最近发往同一设备的推送重复的推送（见 dedup.find_duplicate_push）。
+    Returns:
+        每条推送一个结果：{"queued": True, "id": 通知ID} 或 {"queued": False, "duplicate_of": 重复的通知ID}
+    """
+    now = _utcnow()
+    # 执行引擎为脚本进程（或进程内运行的脚本线程）设置 SCRIPT_ID，推送只与同一脚本之前的推送比较
+    script_id = getenv('SCRIPT_ID')
+    script_id = int(script_id) if script_id and script_id.isdigit() else None
+    results = []
+    with _get_engine().begin() as conn:
+        for payload in payloads:
+            fingerprint = push_fingerprint(payload)
+            duplicate = find_duplicate_push(conn, script_id, payload, fingerprint, now) if dedup else None
+            if duplicate:
+                duplicate_id, match = duplicate
+                metrics.DEDUP_SKIPPED.inc(kind='push', match=match)
+                logger.info(f"跳过重复推送: 与通知ID={duplicate_id} {'相同' if match == 'exact' else '近似'}")
+                results.append({'queued': False, 'duplicate_of': duplicate_id})
+                continue
+            row = {
+                'device_key': payload['device_key'],
+                'group_name': payload.get('group', ''),
+                'payload': json.dumps(payload, ensure_ascii=False),
+                'status': 'pending',
+                'attempts': 0,
+                'next_attempt_at': now + timedelta(seconds=DIGEST_WINDOW),
+                'created_at': now,
+                'script_id': script_id,
+                'content_hash': fingerprint[0],
+                'simhash': fingerprint[1],
+            }
+            notification_id = conn.execute(insert(Notification.__table__).values(row)).inserted_primary_key[0]
+            results.append({'queued': True, 'id': notification_id})
+    return results
+
+def build_digest(payloads):
+    """把同一设备、同一分组的多条推送合并为一个请求体"""
+    if len(payloads) == 1:
+        return payloads[0]
+    digest = {key: value for key, value in payloads[0].items() if key not in ('title', 'body', 'url', 'copy')}
+    titles = {payload.get('title', '') for payload in payloads}
+    if len(titles) == 1:
+        digest['title'] = titles.pop()
+        parts = [payload['body'] for payload in payloads]
+    else:
+        digest['title'] = f"{len(payloads)} 条通知"
+        parts = [f"【{payload['title']}】\n{payload['body']}" if payload.get('title') else payload['body']
+                 for payload in payloads]
+    if not digest['title']:
+        del digest['title']
+    digest['body'] = '\n\n'.join(parts)
+    urls = {payload.get('url') for payload in payloads}
+    if len(urls) == 1 and None not in urls:
+        digest['url'] = urls.pop()
+    return digest
+
+def _chunks(rows):
+    """按条数和正文字数把一组推送拆成若干条摘要"""
+    chunk, chars = [], 0
+    for row, payload in rows:
+        size = len(payload['body'])
+        if chunk and (len(chunk) >= DIGEST_MAX_ITEMS or chars + size > DIGEST_MAX_CHARS):
+            yield chunk
+            chunk, chars = [], 0
+        chunk.append((row, payload))
+        chars += size
+    if chunk:
+        yield chunk
+
+def _retry_delay(attempts):
+    return min(RETRY_BACKOFF * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+def _is_permanent(result):
+    """设备 Key 无效等 4xx 错误重试也不会成功"""
+    code = result.get('code') if isinstance(result, dict) else None
+    return isinstance(code, int) and 400 <= code < 500
+
+class OutboxWorker:
+    def __init__(self, app=None, client=None):
+        self.app = app
+        self.client = client
+        self.identity = None
+        self.thread = None
+
+    def init_app(self, app):
+        self.app = app
+        # 脚本子进程继承环境变量，把推送写入服务使用的数据库
+        os.environ.setdefault(DATABASE_URL_ENV, app.config['SQLALCHEMY_DATABASE_URI'])
+
+    def start(self):
+        """启动投递线程（多个进程可同时运行，通过认领避免重复发送）"""
+        if self.thread is None:
+            self.identity = node_id()
+            # 重试全部交给发件箱（按退避重新投递），客户端每次投递只发送一次请求
+            self.client = self.client or BarkClient(retries=0)
+            self.thread = threading.Thread(target=self._loop, name='notification-outbox', daemon=True)
+            self.thread.start()
+
+    def _loop(self):
+        pruned_at = 0
+        while True:
+            try:
+                if time.monotonic() - pruned_at > PRUNE_INTERVAL:
+                    self.prune()
+                    pruned_at = time.monotonic()
+                if self.deliver_due() == BATCH_SIZE:
+                    continue
+            except Exception as e:
+                logger.error(f"投递推送失败: {e}")
+            time.sleep(POLL_INTERVAL)
+
+    def deliver_due(self):
+        """认领并发送到期的推送，返回本次读取的到期推送数"""
+        claim = f"{self.identity}:{uuid.uuid4().hex[:8]}"
+        now = _utcnow()
+        due = or_(Notification.status == 'pending', Notification.status == 'sending')
+        with self.app.app_context():
+            rows = db.session.execute(
+                select(Notification.id, Notification.device_key, Notification.group_name)
+                .where(due, Notification.next_attempt_at <= now)
+                .order_by(Notification.id)
+                .limit(BATCH_SIZE)
+            ).all()
+            if not rows:
+                return 0
+            ids = {row.id for row in rows}
+            # 同一设备、同一分组中还在合并窗口内的新推送一起发送
+            for device_key, group_name in {(row.device_key, row.group_name) for row in rows}:
+                ids.update(db.session.execute(
+                    select(Notification.id).where(
+                        Notification.device_key == device_key,
+                        Notification.group_name == group_name,
+                        Notification.status == 'pending',
+                        Notification.attempts == 0
+                    )
+                ).scalars())
+
+            # 认领：其他进程已认领且未过期的推送不会被更新
+            db.session.execute(
+                update(Notification)
+                .where(
+                    Notification.id.in_(ids),
+                    or_(Notification.status == 'pending',
+                        and_(Notification.status == 'sending', Notification.next_attempt_at <= now))
+                )
+                .values(status='sending', claim=claim, next_attempt_at=now + timedelta(seconds=CLAIM_TTL))
+            )
+            db.session.commit()
+            claimed = db.session.execute(
+                select(Notification)
+                .where(Notification.claim == claim, Notification.status == 'sending')
+                .order_by(Notification.id)
+            ).scalars().all()
+            db.session.expunge_all()
+
+        groups = {}
+        for row in claimed:
+            groups.setdefault((row.device_key, row.group_name), []).append((row, json.loads(row.payload)))
+        batches = [chunk for group in groups.values() for chunk in _chunks(group)]
+        if batches:
+            with ThreadPoolExecutor(max_workers=min(self.client.pool_size, len(batches))) as pool:
+                list(pool.map(self._deliver, batches))
+        return len(rows)
+
+    def _deliver(self, batch):
+        """发送一条摘要并更新其中每条推送的状态"""
+        success, result = self.client.send_payload(build_digest([payload for _, payload in batch]))
+        now = _utcnow()
+        with self.app.app_context():
+            for row, _ in batch:
+                attempts = (row.attempts or 0) + 1
+                values = {'attempts': attempts, 'claim': None}
+                if success:
+                    values.update(status='sent', sent_at=now, last_error=None)
+                    metrics.NOTIFICATIONS.inc(outcome='sent')
+                    metrics.NOTIFICATION_DELIVERY_LATENCY.observe((now - row.created_at).total_seconds())
+                elif attempts >= MAX_ATTEMPTS or _is_permanent(result):
+                    values.update(status='failed', last_error=json.dumps(result, ensure_ascii=False))
+                    metrics.NOTIFICATIONS.inc(outcome='failed')
+                else:
+                    values.update(status='pending', last_error=json.dumps(result, ensure_ascii=False),
+                                  next_attempt_at=now + timedelta(seconds=_retry_delay(attempts)))
+                    metrics.NOTIFICATIONS.inc(outcome='retry')
+                db.session.execute(update(Notification).where(Notification.id == row.id).values(**values))
+            db.session.commit()
+        if len(batch) > 1:
+            logger.info(f"合并发送 {len(batch)} 条推送: {'成功' if success else '失败'}")
+
+    def prune(self):
+        """删除超过保留天数的已发送和已失败推送"""
+        cutoff = _utcnow() - timedelta(days=KEEP_DAYS)
+        with self.app.app_context():
+            db.session.execute(
+                delete(Notification)
+                .where(Notification.status.in_(('sent', 'failed')), Notification.created_at < cutoff)
+            )
+            db.session.commit()
@@ -0,0 +1,198 @@
+"""
+运行历史的保留、汇总与归档
+
+超出保留策略的 ScriptRun 按脚本、按天（北京时间）汇总到 RunDailyStat（次数、成功率、耗时 P50/P95），
+可选地追加到 gzip 压缩的 JSONL 归档文件，然后从数据库删除，最后对 SQLite 做 VACUUM。
+由 TaskScheduler 作为内置维护任务定时执行。
+"""
+from sqlalchemy import select, delete, or_, and_
+from sqlalchemy.orm import defer
+from datetime import datetime, timedelta, timezone
+import gzip
+import json
+import math
+import os
+import logging
+import pytz
+from models import db, ScriptRun, RunDailyStat
+import dedup
+
+logger = logging.getLogger(__name__)
+
+# 每个脚本保留的最近运行次数（0 表示不按次数保留）
+KEEP_RUNS = int(os.environ.get('RUN_RETENTION_KEEP', '100'))
+# 保留最近多少天内的运行（0 表示不按时间保留）
+KEEP_DAYS = int(os.environ.get('RUN_RETENTION_DAYS', '30'))
+# 维护任务的执行时间
+RETENTION_CRON = os.environ.get('RUN_RETENTION_CRON', '30 3 * * *')
+# 归档目录，为空时不归档
+ARCHIVE_DIR = os.environ.get('RUN_ARCHIVE_DIR', '')
+# 清理后的 VACUUM 方式：incremental, full, off
+VACUUM_MODE = os.environ.get('RUN_VACUUM', 'incremental')
+
+BATCH_SIZE = 500
+BEIJING = pytz.timezone('Asia/Shanghai')
+
+def is_enabled():
+    """是否配置了保留策略"""
+    return KEEP_RUNS > 0 or KEEP_DAYS > 0
+
+def run_retention(app):
+    """执行一次清理，返回删除的运行记录数量"""
+    if not is_enabled():
+        return 0
+
+    with app.app_context():
+        script_ids = db.session.execute(select(ScriptRun.script_id).distinct()).scalars().all()
+        removed = 0
+        for script_id in script_ids:
+            try:
+                removed += compact_script_runs(script_id)
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"清理运行记录失败: 脚本ID={script_id}, 错误={e}")
+
+        if removed:
+            # 删除不再被引用的共享输出
+            dedup.collect_garbage()
+            vacuum(db.engine)
+        logger.info(f"运行记录清理完成: 删除 {removed} 条")
+        return removed
+
+def compact_script_runs(script_id):
+    """汇总、归档并删除单个脚本超出保留策略的运行记录"""
+    conditions = [
+        ScriptRun.script_id == script_id,
+        ScriptRun.status.notin_(('queued', 'running')),
+    ]
+    if KEEP_DAYS > 0:
+        cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=KEEP_DAYS)
+        conditions.append(ScriptRun.created_at < cutoff)
+    if KEEP_RUNS > 0:
+        # 第 KEEP_RUNS 条最近的运行，比它更早的才允许删除
+        boundary = db.session.execute(
+            select(ScriptRun.created_at, ScriptRun.id)
+            .where(ScriptRun.script_id == script_id)
+            .order_by(ScriptRun.created_at.desc(), ScriptRun.id.desc())
+            .offset(KEEP_RUNS - 1)
+            .limit(1)
+        ).first()
+        if boundary is None:
+            return 0
+        conditions.append(or_(
+            ScriptRun.created_at < boundary.created_at,
+            and_(ScriptRun.created_at == boundary.created_at, ScriptRun.id < boundary.id)
+        ))
+
+    query = ScriptRun.query.filter(*conditions).order_by(ScriptRun.id)
+    if not ARCHIVE_DIR:
+        query = query.options(defer(ScriptRun.output), defer(ScriptRun.error))
+
+    removed = 0
+    while True:
+        runs = query.limit(BATCH_SIZE).all()
+        if not runs:
+            break
+        if ARCHIVE_DIR:
+            archive_runs(runs)
+        merge_daily_stats(script_id, runs)
+        db.session.execute(
+            delete(ScriptRun).where(ScriptRun.id.in_([run.id for run in runs])),
+            execution_options={'synchronize_session': False}
+        )
+        db.session.commit()
+        db.session.expunge_all()
+        removed += len(runs)
+
+    if removed:
+        logger.info(f"已清理脚本ID={script_id} 的 {removed} 条运行记录")
+    return removed
+
+def merge_daily_stats(script_id, runs):
+    """把一批运行记录合并进按天汇总的统计"""
+    buckets = {}
+    for run in runs:
+        day = _to_beijing(run.created_at).date()
+        bucket = buckets.setdefault(day, {'total': 0, 'success': 0, 'durations': []})
+        bucket['total'] += 1
+        if run.status == 'success':
+            bucket['success'] += 1
+        duration = _run_duration(run)
+        if duration is not None:
+            bucket['durations'].append(duration)
+
+    for day, bucket in buckets.items():
+        stat = RunDailyStat.query.filter_by(script_id=script_id, day=day).first()
+        if stat is None:
+            stat = RunDailyStat(script_id=script_id, day=day, total=0, success=0, failed=0, duration_count=0)
+            db.session.add(stat)
+
+        durations = sorted(bucket['durations'])
+        # 同一天分多次汇总时，分位数按有耗时的运行数加权合并（近似值）；
+        # 增加 duration_count 字段之前的汇总没有该值，按总次数计
+        counted = stat.duration_count if stat.duration_count is not None else stat.total
+        stat.p50_duration = _weighted(stat.p50_duration, counted, _percentile(durations, 50), len(durations))
+        stat.p95_duration = _weighted(stat.p95_duration, counted, _percentile(durations, 95), len(durations))
+        stat.duration_count = counted + len(durations)
+        stat.total += bucket['total']
+        stat.success += bucket['success']
+        stat.failed += bucket['total'] - bucket['success']
+
+def _run_duration(run):
+    """运行耗时（秒），不含排队等待，与 ScriptRun.duration 一致"""
+    if run.duration is not None:
+        return run.duration
+    if run.started_at and run.completed_at:
+        return (_to_beijing(run.completed_at) - _to_beijing(run.started_at)).total_seconds()
+    return None
+
+def archive_runs(runs):
+    """把运行记录追加到按月分文件的 gzip JSONL 归档"""
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    by_month = {}
+    for run in runs:
+        month = _to_beijing(run.created_at).strftime('%Y-%m')
+        by_month.setdefault(month, []).append(run)
+
+    for month, month_runs in by_month.items():
+        path = os.path.join(ARCHIVE_DIR, f'script_runs-{month}.jsonl.gz')
+        with gzip.open(path, 'at', encoding='utf-8') as f:
+            for run in month_runs:
+                f.write(json.dumps(run.to_dict(), ensure_ascii=False) + '\n')
+
+def vacuum(engine):
+    """回收 SQLite 删除记录后留下的空闲页"""
+    if engine.dialect.name != 'sqlite' or VACUUM_MODE == 'off':
+        return
+
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        if VACUUM_MODE == 'full':
+            conn.exec_driver_sql('VACUUM')
+            return
+        if conn.exec_driver_sql('PRAGMA auto_vacuum').scalar() != 2:
+            # 首次切换到增量模式需要一次完整 VACUUM
+            logger.info("SQLite 切换到增量 VACUUM 模式")
+            conn.exec_driver_sql('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.exec_driver_sql('VACUUM')
+        else:
+            conn.exec_driver_sql('PRAGMA incremental_vacuum').fetchall()
+
+def _to_beijing(value):
+    # SQLite 取回的时间不带时区，按 UTC 处理
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(BEIJING)
+
+def _percentile(values, percent):
+    """最近秩法计算分位数，values 需已排序"""
+    if not values:
+        return None
+    rank = max(math.ceil(percent / 100 * len(values)), 1)
+    return values[rank - 1]
+
+def _weighted(old, old_count, new, new_count):
+    if old is None or not old_count:
+        return new
+    if new is None or not new_count:
+        return old
+    return (old * old_count + new * new_count) / (old_count + new_count)
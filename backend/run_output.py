@@ -0,0 +1,126 @@
+"""
+运行输出的增量持久化
+脚本输出按块追加到 ScriptRun.output / error，由后台线程定期写入数据库；
+单路输出超过大小上限后追加截断标记，之后的输出直接丢弃
+"""
+from flask import current_app
+from sqlalchemy import update, func
+import hashlib
+import os
+import threading
+import logging
+from models import db, ScriptRun
+
+logger = logging.getLogger(__name__)
+
+# 每路输出（stdout/stderr）保存的最大字节数
+MAX_OUTPUT_BYTES = int(os.environ.get('SCRIPT_MAX_OUTPUT_BYTES', str(1024 * 1024)))
+# 写入数据库的间隔（秒）
+FLUSH_INTERVAL = 1.0
+TRUNCATED_MARKER = '\n...[输出超过 {limit} 字节，已截断]\n'
+
+COLUMNS = {'stdout': 'output', 'stderr': 'error'}
+# 保留的错误输出末尾长度，用于判断退出原因（如 MemoryError）
+TAIL_CHARS = 2000
+
+class RunOutputWriter:
+    def __init__(self, run_id, max_bytes=None, flush_interval=FLUSH_INTERVAL, on_truncate=None):
+        """on_truncate: 任一路输出首次被截断时调用（例如停止运行）"""
+        self.run_id = run_id
+        self.max_bytes = MAX_OUTPUT_BYTES if max_bytes is None else max_bytes
+        self.on_truncate = on_truncate
+        self.stderr_tail = ''
+        self.flush_interval = flush_interval
+        self.pending = {stream: [] for stream in COLUMNS}
+        self.written = {stream: 0 for stream in COLUMNS}
+        self.received = {stream: 0 for stream in COLUMNS}  # 脚本实际产生的字节数（含截断丢弃的部分）
+        self.truncated = {stream: False for stream in COLUMNS}
+        self.last_char = {stream: '' for stream in COLUMNS}
+        self.stdout_digest = hashlib.sha256()  # 保存的标准输出的哈希，用于输出去重
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.app = current_app._get_current_object()
+        self.thread = threading.Thread(
+            target=self._flush_loop,
+            name=f'run-output-{run_id}',
+            daemon=True
+        )
+        self.thread.start()
+
+    def write(self, stream, text):
+        """追加一块输出（作为 run_code 的 on_output 回调）"""
+        truncated = False
+        with self.lock:
+            if not text:
+                return
+            data = text.encode('utf-8')
+            self.received[stream] += len(data)
+            if stream == 'stderr':
+                self.stderr_tail = (self.stderr_tail + text)[-TAIL_CHARS:]
+            if self.truncated[stream]:
+                return
+            remaining = self.max_bytes - self.written[stream]
+            if len(data) > remaining:
+                text = data[:remaining].decode('utf-8', errors='ignore')
+                text += TRUNCATED_MARKER.format(limit=self.max_bytes)
+                self.truncated[stream] = True
+                self.written[stream] = self.max_bytes
+                truncated = True
+            else:
+                self.written[stream] += len(data)
+            self.pending[stream].append(text)
+            self.last_char[stream] = text[-1:]
+            if stream == 'stdout':
+                self.stdout_digest.update(text.encode('utf-8'))
+        if truncated and self.on_truncate:
+            self.on_truncate()
+
+    def note(self, message):
+        """在错误输出末尾追加一条说明（如超时）"""
+        with self.lock:
+            prefix = '\n' if self.last_char['stderr'] not in ('', '\n') else ''
+            self.pending['stderr'].append(prefix + message)
+            self.last_char['stderr'] = message[-1:]
+
+    @property
+    def output_hash(self):
+        """保存的标准输出的 SHA-256（没有输出时为 None）"""
+        return self.stdout_digest.hexdigest() if self.written['stdout'] else None
+
+    @property
+    def bytes_out(self):
+        """脚本输出的总字节数"""
+        return sum(self.received.values())
+
+    def close(self):
+        """停止后台线程并写入剩余输出"""
+        self.closed.set()
+        self.thread.join()
+
+    def _flush_loop(self):
+        with self.app.app_context():
+            while not self.closed.wait(self.flush_interval):
+                self._flush()
+            self._flush()
+
+    def _flush(self):
+        with self.lock:
+            chunks = {stream: ''.join(parts) for stream, parts in self.pending.items() if parts}
+            for stream in chunks:
+                self.pending[stream] = []
+        if not chunks:
+            return
+
+        values = {}
+        for stream, chunk in chunks.items():
+            column = getattr(ScriptRun, COLUMNS[stream])
+            values[COLUMNS[stream]] = func.coalesce(column, '') + chunk
+        try:
+            db.session.execute(
+                update(ScriptRun).where(ScriptRun.id == self.run_id).values(**values),
+                execution_options={'synchronize_session': False}
+            )
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"写入运行输出失败: 运行ID={self.run_id}, 错误={e}")
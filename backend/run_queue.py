@@ -0,0 +1,59 @@
+"""
+脚本运行队列
+立即运行的请求先写入 ScriptRun（状态 queued），再交给有界线程池异步执行，
+HTTP 请求线程不再等待脚本结束
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import logging
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class RunQueue:
+    def __init__(self, max_workers=None):
+        # 并发执行的脚本数量上限，可通过环境变量 RUN_WORKERS 调整
+        self.max_workers = max_workers or int(os.environ.get('RUN_WORKERS', '4'))
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix='script-run'
+        )
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.busy = 0
+        metrics.RUN_QUEUE_WORKERS.function = self.utilization
+
+    def submit(self, func, *args):
+        """提交一个运行任务，返回 Future"""
+        with self.lock:
+            self.pending += 1
+        future = self.executor.submit(self._run, func, *args)
+        future.add_done_callback(self._log_exception)
+        return future
+
+    def utilization(self):
+        """线程池使用情况，供 /metrics 采集"""
+        with self.lock:
+            return {('busy',): self.busy, ('capacity',): self.max_workers, ('pending',): self.pending}
+
+    def _run(self, func, *args):
+        with self.lock:
+            self.pending -= 1
+            self.busy += 1
+        try:
+            return func(*args)
+        finally:
+            with self.lock:
+                self.busy -= 1
+
+    def shutdown(self, wait=True):
+        """停止队列"""
+        self.executor.shutdown(wait=wait)
+        logger.info("脚本运行队列已停止")
+
+    @staticmethod
+    def _log_exception(future):
+        exc = future.exception()
+        if exc:
+            logger.error(f"队列任务执行异常: {exc}")
@@ -1,164 +1,495 @@
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.events import EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED
+from apscheduler.schedulers.base import STATE_STOPPED
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from apscheduler.triggers.cron import CronTrigger
-import subprocess
-import sys
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import load_only
+from datetime import datetime
+import json
 import os
-from datetime import datetime, timezone
+import threading
 import logging
+import uuid
+import pytz
+from executor import executor
+from leader import LeaderElector
+from cron import get_trigger, next_fire_time, spread_offset
+from models import db, Script
+import metrics
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 上一次运行尚未结束时的处理策略
+OVERLAP_POLICIES = ('skip', 'queue', 'replace')
+# 调度器运行方式：auto 通过数据库租约选出唯一的主节点运行定时任务，on 总是运行（单进程部署），off 只提供 API
+SCHEDULER_MODES = ('auto', 'on', 'off')
+# 定时任务的保存位置：database 保存在数据库的 apscheduler_jobs 表中（重启后保留下次运行时间），memory 只在内存中
+JOBSTORE = os.environ.get('SCHEDULER_JOBSTORE', 'database')
+JOBS_TABLE = 'apscheduler_jobs'
+# 主节点启动时，停机期间错过的触发在该时间（秒）内的补跑一次，0 表示不补跑
+REPLAY_WINDOW = int(os.environ.get('SCHEDULER_REPLAY_WINDOW', '3600'))
+BEIJING = pytz.timezone('Asia/Shanghai')
+
+# 当前主节点上的调度器，供保存在数据库中的任务按模块路径调用
+_active = None
+
+def run_scheduled(script_id):
+    """定时任务入口"""
+    _active.run_script(script_id)
+
+def run_queued(script_id, slot):
+    """queue 策略下排队的触发：接过上一次运行让出的并发位置执行"""
+    _active.run_script(script_id, slot=slot)
+
 class TaskScheduler:
-    def __init__(self):
-        self.scheduler = BackgroundScheduler(timezone='Asia/Shanghai')  # 设置为北京时间
-        self.jobs = {}
+    def __init__(self, max_workers=None, mode=None):
+        # 全局并发上限：同一时刻最多执行的定时任务数量
+        self.max_workers = max_workers or int(os.environ.get('SCHEDULER_MAX_WORKERS', '10'))
+        self.scheduler = BackgroundScheduler(
+            executors={'default': ThreadPoolExecutor(self.max_workers)},
+            # 脚本的定时任务使用 default（start 中按配置替换为数据库），维护任务和补跑使用 memory
+            jobstores={'memory': MemoryJobStore()},
+            timezone='Asia/Shanghai'  # 设置为北京时间
+        )
+        self.scheduler.add_listener(self._on_job_skipped, EVENT_JOB_MAX_INSTANCES | EVENT_JOB_MISSED)
+        self.mode = mode or os.environ.get('SCHEDULER_MODE', 'auto')
+        if self.mode not in SCHEDULER_MODES:
+            logger.warning(f"未知的调度器运行方式 {self.mode}，使用 auto")
+            self.mode = 'auto'
+        self.app = None
+        self.elector = None
+        self.is_leader = False  # 只有主节点注册和触发定时任务
+        self.jobstore = None
+        self.jobs = {}  # script_id -> 已注册的任务（任务保存在数据库中时只是注册时的快照）
+        self.signatures = {}  # script_id -> 注册任务时的 cron表达式和调度参数（同时保存为任务名），用于与数据库同步
+        self.synced_at = None  # 最近一次与数据库同步完成的时间
+        self.policies = {}  # script_id -> (overlap_policy, max_instances)
+        self.slots = {}  # script_id -> BoundedSemaphore，queue 策略下的并发位置
+        self.pending = {}  # script_id -> queue 策略下排队等待的触发数（不占用调度线程）
+        self.running = {}  # script_id -> 正在运行的实例的取消标志列表
+        self.busy = 0  # 占用调度线程的任务数
+        self.lock = threading.Lock()
+        # 保护 jobs 和 signatures：API 请求线程、选举线程和载入线程都会修改（add_job 内会调用 remove_job，需可重入）
+        self.jobs_lock = threading.RLock()
+        metrics.SCHEDULER_WORKERS.function = self.utilization
+    
+    def init_app(self, app):
+        self.app = app
+    
+    def _init_jobstore(self):
+        """使用当前进程的数据库引擎创建任务存储
+        
+        在 start 中（gunicorn 的 worker fork 之后）创建，不能复用主进程的引擎和其中已打开的连接
+        """
+        if JOBSTORE == 'database' and self.jobstore is None:
+            with self.app.app_context():
+                self.jobstore = SQLAlchemyJobStore(engine=db.engine, tablename=JOBS_TABLE)
+            self.scheduler.add_jobstore(self.jobstore, 'default')
     
     def start(self):
-        """启动调度器"""
-        self.scheduler.start()
-        logger.info("任务调度器已启动（北京时间）")
+        """按运行方式启动调度器：直接成为主节点，或参与选举"""
+        self._init_jobstore()
+        if self.mode == 'off':
+            logger.info("调度器已关闭（SCHEDULER_MODE=off），本进程只提供 API")
+        elif self.mode == 'on':
+            # 在后台恢复定时任务，不阻塞服务启动
+            self._activate(background=True)
+        else:
+            # 载入和同步不在选举线程中阻塞执行，以免大量脚本时续约超过租约有效期
+            self.elector = LeaderElector(self.app, on_elected=lambda: self._activate(background=True),
+                                         on_revoked=self._deactivate, on_tick=lambda: self.sync(blocking=False))
+            self.elector.start()
     
     def stop(self):
         """停止调度器"""
-        self.scheduler.shutdown()
+        if self.elector is not None:
+            self.elector.stop()
+        self.is_leader = False
+        if self.scheduler.state != STATE_STOPPED:
+            self.scheduler.shutdown()
         logger.info("任务调度器已停止")
     
-    def add_job(self, script_id, cron_expression):
+    def _activate(self, background=False):
+        """成为主节点：在暂停状态下批量载入定时任务，全部注册后再开始触发"""
+        global _active
+        _active = self
+        if self.scheduler.state == STATE_STOPPED:
+            self.scheduler.start(paused=True)
+        self.is_leader = True
+        metrics.SCHEDULER_LEADER.set(1)
+        if background:
+            threading.Thread(target=self._load, name='scheduler-load', daemon=True).start()
+        else:
+            self._load()
+    
+    def _load(self):
+        try:
+            with self.jobs_lock:
+                self._restore()
+                self.sync()
+                self._replay_missed()
+        finally:
+            self.scheduler.resume()
+        logger.info(f"任务调度器已启动（北京时间），定时任务 {len(self.jobs)} 个")
+    
+    def _deactivate(self):
+        """失去主节点身份：暂停调度，正在执行的运行会继续到结束
+        
+        任务保存在数据库中时保留给新的主节点，否则从内存中移除
+        """
+        self.is_leader = False
+        metrics.SCHEDULER_LEADER.set(0)
+        self.scheduler.pause()
+        with self.jobs_lock:
+            if self.jobstore is None:
+                for script_id in list(self.jobs):
+                    self.remove_job(script_id, log=False)
+            self.jobs.clear()
+            self.signatures.clear()
+        with self.lock:
+            self.policies.clear()
+            self.slots.clear()
+            self.pending.clear()
+        self.synced_at = None
+        logger.info("任务调度器已暂停")
+    
+    def sync(self, blocking=True):
+        """按数据库中的脚本增删或更新定时任务
+        
+        成为主节点时和每次续约后调用，其他进程通过 API 做的修改由此生效；
+        blocking 为 False 时，如果正在载入或同步则跳过本次
+        """
+        if not self.jobs_lock.acquire(blocking=blocking):
+            return
+        try:
+            self._sync()
+        finally:
+            self.jobs_lock.release()
+    
+    def _sync(self):
+        # 在锁内读取脚本，读到的不会比已经完成的 add_job 更旧
+        with self.app.app_context():
+            scripts = db.session.execute(
+                db.select(Script)
+                .options(load_only(Script.id, Script.cron_expression, Script.max_instances, Script.overlap_policy,
+                                   Script.coalesce, Script.misfire_grace_time, Script.jitter_seconds))
+                .where(Script.is_active == True, Script.cron_expression != '')
+            ).scalars().all()
+            desired = {script.id: (script.cron_expression, script.schedule_options()) for script in scripts}
+        
+        removed = set(self.signatures) - set(desired)
+        for script_id in removed:
+            self.remove_job(script_id, log=False)
+        changed = 0
+        for script_id, (cron_expression, options) in desired.items():
+            if self.signatures.get(script_id) != _signature(cron_expression, options):
+                self.add_job(script_id, cron_expression, log=False, **options)
+                changed += 1
+            elif script_id not in self.policies:
+                # 从数据库恢复、调度参数未变的任务，只需恢复进程内的重叠策略状态
+                self._set_policy(script_id, options['overlap_policy'], options['max_instances'])
+        self.synced_at = datetime.now(BEIJING)
+        if changed or removed:
+            logger.info(f"已同步定时任务: 新增/更新 {changed} 个, 移除 {len(removed)} 个")
+    
+    def status(self):
+        """调度器状态，供健康检查和配置接口使用"""
+        return {
+            'mode': self.mode,
+            'is_leader': self.is_leader,
+            'jobs': len(self.jobs),
+            'synced_at': self.synced_at.strftime('%Y-%m-%d %H:%M:%S') if self.synced_at else None
+        }
+    
+    def add_job(self, script_id, cron_expression, max_instances=1, overlap_policy='skip',
+                coalesce=True, misfire_grace_time=60, jitter_seconds=0, log=True):
         """添加定时任务
         
         Args:
             script_id: 脚本ID
             cron_expression: cron表达式，如 "0 9 * * *" 表示每天9点
+            max_instances: 同一脚本同时运行的最大实例数
+            overlap_policy: 上一次运行未结束时的策略，skip 跳过 / queue 排队 / replace 终止旧的运行
+            coalesce: 错过的多次触发是否合并为一次
+            misfire_grace_time: 错过触发后仍允许补跑的秒数
+            jitter_seconds: 错峰窗口（秒），触发时间固定推迟窗口内由脚本ID决定的偏移量
+            log: 是否逐条记录日志（批量同步时只记录汇总）
+        
+        非主节点上不注册任务，由主节点的 sync 从数据库读取
         """
+        if not self.is_leader:
+            return
+        with self.jobs_lock:
+            self._add_job(script_id, cron_expression, max_instances, overlap_policy,
+                          coalesce, misfire_grace_time, jitter_seconds, log)
+    
+    def _add_job(self, script_id, cron_expression, max_instances, overlap_policy,
+                 coalesce, misfire_grace_time, jitter_seconds, log):
         if script_id in self.jobs:
-            self.remove_job(script_id)
+            self.remove_job(script_id, log=log)
         
         if not cron_expression:
             logger.warning(f"脚本ID={script_id} 没有设置cron表达式")
             return
         
+        # 记录本次注册的参数，表达式无效时也不会在每次同步时重复报错
+        options = {
+            'max_instances': max_instances, 'overlap_policy': overlap_policy,
+            'coalesce': coalesce, 'misfire_grace_time': misfire_grace_time
+        }
+        if jitter_seconds:
+            options['jitter_seconds'] = jitter_seconds
+        self.signatures[script_id] = _signature(cron_expression, options)
+        
         try:
-            # 解析cron表达式
-            cron_parts = cron_expression.strip().split()
-            if len(cron_parts) != 5:
-                logger.error(f"无效的cron表达式: {cron_expression}")
-                return
+            offset = spread_offset(script_id, jitter_seconds)
+            trigger = get_trigger(cron_expression, offset)
+            overlap_policy, max_instances = self._set_policy(script_id, overlap_policy, max_instances)
             
-            minute, hour, day, month, day_of_week = cron_parts
-            
-            # 创建cron触发器
-            trigger = CronTrigger(
-                minute=minute,
-                hour=hour,
-                day=day,
-                month=month,
-                day_of_week=day_of_week,
-                timezone='Asia/Shanghai'  # 使用北京时间
-            )
+            # APScheduler 层面允许的实例数：queue 策略额外允许一个实例登记排队后立即返回，
+            # replace 策略额外允许一个新实例启动并终止最早的运行
+            if overlap_policy in ('queue', 'replace'):
+                job_instances = max_instances + 1
+            else:
+                job_instances = max_instances
             
-            # 添加任务
+            # 添加任务（任务名保存调度参数，重启后据此判断是否需要更新）
             job = self.scheduler.add_job(
-                func=self.run_script,
+                func=run_scheduled,
                 trigger=trigger,
                 args=[script_id],
                 id=str(script_id),
-                replace_existing=True
+                name=self.signatures[script_id],
+                jobstore='default',
+                replace_existing=True,
+                max_instances=job_instances,
+                coalesce=coalesce,
+                misfire_grace_time=misfire_grace_time
             )
             
             self.jobs[script_id] = job
-            logger.info(f"已添加定时任务: 脚本ID={script_id}, Cron={cron_expression}")
-            
-            # 获取下次运行时间
-            next_run = job.next_run_time
-            if next_run:
-                logger.info(f"下次运行时间: {next_run.strftime('%Y-%m-%d %H:%M:%S')} (北京时间)")
+            if log:
+                logger.info(f"已添加定时任务: 脚本ID={script_id}, Cron={cron_expression}, "
+                            f"并发={max_instances}, 策略={overlap_policy}" + (f", 错峰推迟{offset}秒" if offset else ""))
+                
+                # 获取下次运行时间（调度器暂停时尚未计算）
+                next_run = getattr(job, 'next_run_time', None)
+                if next_run:
+                    logger.info(f"下次运行时间: {next_run.strftime('%Y-%m-%d %H:%M:%S')} (北京时间)")
             
         except Exception as e:
             logger.error(f"添加定时任务失败: {e}")
     
-    def remove_job(self, script_id):
+    def _set_policy(self, script_id, overlap_policy, max_instances):
+        """记录脚本的重叠策略和并发数，返回校正后的值"""
+        if overlap_policy not in OVERLAP_POLICIES:
+            logger.warning(f"未知的重叠策略 {overlap_policy}，使用 skip")
+            overlap_policy = 'skip'
+        max_instances = max(int(max_instances or 1), 1)
+        with self.lock:
+            self.policies[script_id] = (overlap_policy, max_instances)
+            self.slots[script_id] = threading.BoundedSemaphore(max_instances)
+        return overlap_policy, max_instances
+    
+    def _restore(self):
+        """载入数据库中保存的任务，与 script 表一致的任务不会重新创建"""
+        self.jobs.clear()
+        self.signatures.clear()
+        if self.jobstore is None:
+            return
+        for job in self.scheduler.get_jobs(jobstore='default'):
+            if job.id.isdigit():
+                self.jobs[int(job.id)] = job
+                self.signatures[int(job.id)] = job.name
+        logger.info(f"已从数据库载入定时任务 {len(self.jobs)} 个")
+    
+    def _replay_missed(self):
+        """补跑停机期间错过的触发：在补跑窗口内的补跑一次，超出的记为错过，然后从当前时间重新计算下次运行时间"""
+        now = datetime.now(BEIJING)
+        for script_id, job in list(self.jobs.items()):
+            next_run = getattr(job, 'next_run_time', None)
+            if next_run is None or next_run > now:
+                continue
+            missed_by = (now - next_run).total_seconds()
+            if missed_by <= REPLAY_WINDOW:
+                self.scheduler.add_job(
+                    func=run_scheduled,
+                    trigger='date',
+                    run_date=now,
+                    args=[script_id],
+                    id=f'replay:{script_id}',
+                    jobstore='memory',
+                    replace_existing=True,
+                    misfire_grace_time=None
+                )
+                logger.info(f"脚本ID={script_id} 补跑停机期间错过的运行（计划时间 {next_run.strftime('%Y-%m-%d %H:%M:%S')}）")
+            else:
+                metrics.SCHEDULER_MISFIRES.inc(script_id=script_id)
+                logger.warning(f"脚本ID={script_id} 错过了计划运行时间 {next_run}，超出补跑窗口")
+            job.modify(next_run_time=job.trigger.get_next_fire_time(None, now))
+    
+    def add_maintenance_job(self, job_id, func, cron_expression):
+        """添加内置维护任务（不对应具体脚本）"""
+        try:
+            trigger = CronTrigger.from_crontab(cron_expression, timezone='Asia/Shanghai')
+        except ValueError as e:
+            logger.error(f"无效的维护任务cron表达式: {cron_expression}, 错误={e}")
+            return
+        
+        self.scheduler.add_job(
+            func=func,
+            trigger=trigger,
+            id=f'maintenance:{job_id}',
+            jobstore='memory',
+            replace_existing=True,
+            coalesce=True,
+            max_instances=1
+        )
+        logger.info(f"已添加维护任务: {job_id}, Cron={cron_expression}")
+    
+    def remove_job(self, script_id, log=True):
         """移除定时任务"""
-        if script_id in self.jobs:
+        with self.jobs_lock:
+            self.signatures.pop(script_id, None)
+            if script_id in self.jobs:
+                try:
+                    self.scheduler.remove_job(str(script_id))
+                    del self.jobs[script_id]
+                    with self.lock:
+                        self.policies.pop(script_id, None)
+                        self.slots.pop(script_id, None)
+                        self.pending.pop(script_id, None)
+                    if log:
+                        logger.info(f"已移除定时任务: 脚本ID={script_id}")
+                except Exception as e:
+                    logger.error(f"移除定时任务失败: {e}")
+    
+    def get_next_run_time(self, script_id, cron_expression=None, offset=0):
+        """获取下次运行时间；没有找到已注册的任务时（如非主节点且任务只在内存中），按 cron_expression 和错峰偏移计算"""
+        return self.get_next_run_times().get(script_id) or next_fire_time(cron_expression, offset)
+    
+    def get_next_run_times(self):
+        """批量获取所有定时任务的下次运行时间，返回 {script_id: 时间字符串}
+        
+        任务保存在数据库中时直接查询任务表（不反序列化任务），所有进程都能取到
+        """
+        if self.jobstore is not None:
+            table = self.jobstore.jobs_t
             try:
-                self.scheduler.remove_job(str(script_id))
-                del self.jobs[script_id]
-                logger.info(f"已移除定时任务: 脚本ID={script_id}")
-            except Exception as e:
-                logger.error(f"移除定时任务失败: {e}")
+                with self.jobstore.engine.connect() as conn:
+                    rows = conn.execute(
+                        select(table.c.id, table.c.next_run_time).where(table.c.next_run_time.isnot(None))
+                    ).all()
+            except SQLAlchemyError:
+                # 任务表在主节点第一次启动时才创建
+                return {}
+            return {
+                int(job_id): datetime.fromtimestamp(timestamp, BEIJING).strftime('%Y-%m-%d %H:%M:%S')
+                for job_id, timestamp in rows
+                if job_id.isdigit()
+            }
+        with self.jobs_lock:
+            jobs = list(self.jobs.items())
+        return {
+            script_id: job.next_run_time.strftime('%Y-%m-%d %H:%M:%S')
+            for script_id, job in jobs
+            if getattr(job, 'next_run_time', None)
+        }
     
-    def get_next_run_time(self, script_id):
-        """获取下次运行时间"""
-        if script_id in self.jobs:
-            job = self.jobs[script_id]
-            if job.next_run_time:
-                return job.next_run_time.strftime('%Y-%m-%d %H:%M:%S')
-        return None
+    def _on_job_skipped(self, event):
+        """记录因并发上限被跳过或错过补跑时间的触发"""
+        if event.code == EVENT_JOB_MAX_INSTANCES:
+            metrics.SCHEDULER_SKIPPED.inc(script_id=event.job_id)
+            logger.warning(f"脚本ID={event.job_id} 上一次运行尚未结束，本次触发已跳过")
+        else:
+            metrics.SCHEDULER_MISFIRES.inc(script_id=event.job_id)
+            logger.warning(f"脚本ID={event.job_id} 错过了计划运行时间 {event.scheduled_run_time}")
     
-    def run_script(self, script_id):
-        """执行脚本"""
-        from app import app
-        from models import db, Script, ScriptRun
+    def utilization(self):
+        """调度线程池使用情况，供 /metrics 采集"""
+        with self.lock:
+            return {('busy',): self.busy, ('capacity',): self.max_workers,
+                    ('queued',): sum(self.pending.values())}
+    
+    def run_script(self, script_id, slot=None):
+        """按重叠策略执行脚本
         
-        with app.app_context():
-            script = Script.query.get(script_id)
-            if not script:
-                logger.error(f"脚本不存在: ID={script_id}")
-                return
-            
-            # 创建运行记录
-            run = ScriptRun(script_id=script_id)
-            db.session.add(run)
-            db.session.commit()
-            
-            logger.info(f"开始执行脚本: {script.name}")
-            
+        queue 策略下没有空闲的并发位置时只登记排队并立即返回，不在调度线程中等待；
+        运行结束时把并发位置直接交给排队的触发（slot 为交接过来的位置）
+        """
+        with self.lock:
+            policy, limit = self.policies.get(script_id, ('skip', 1))
+            if slot is None and policy == 'queue':
+                slot = self.slots.get(script_id)
+                if slot is not None and not slot.acquire(blocking=False):
+                    self._enqueue_fire(script_id, limit)
+                    return
+            self.busy += 1
+        try:
+            self._run_with_policy(script_id, policy, limit)
+        finally:
+            with self.lock:
+                self.busy -= 1
+            if slot is not None:
+                self._release_slot(script_id, slot)
+    
+    def _enqueue_fire(self, script_id, limit):
+        """登记一次排队的触发，最多排队与并发数相同的次数，超出的跳过（调用时已持有 self.lock）"""
+        pending = self.pending.get(script_id, 0)
+        if pending >= limit:
+            metrics.SCHEDULER_SKIPPED.inc(script_id=str(script_id))
+            logger.warning(f"脚本ID={script_id} 排队的触发已达上限，本次触发已跳过")
+            return
+        self.pending[script_id] = pending + 1
+        logger.info(f"脚本ID={script_id} 仍在运行，本次触发排队等待")
+    
+    def _release_slot(self, script_id, slot):
+        """运行结束：有排队的触发时把并发位置交给它（作为一次性任务提交），否则释放"""
+        with self.lock:
+            handoff = self.pending.get(script_id, 0) > 0
+            if handoff:
+                self.pending[script_id] -= 1
+        if handoff:
             try:
-                # 获取当前项目目录
-                current_dir = os.path.dirname(os.path.abspath(__file__))
-                
-                # 构建包含导入路径的脚本
-                script_with_imports = f"""
-import sys
-import os
-
-# 添加项目目录到Python路径
-sys.path.insert(0, r'{current_dir}')
-
-# 设置环境变量（如果脚本中使用了）
-os.environ['GEMINI_API_KEY'] = os.environ.get('GEMINI_API_KEY', '')
-os.environ['BARK_DEVICE_KEY'] = os.environ.get('BARK_DEVICE_KEY', '')
-os.environ['BARK_API_SERVER'] = os.environ.get('BARK_API_SERVER', '')
-
-# 执行用户脚本
-{script.code}
-"""
-                
-                # 执行脚本
-                result = subprocess.run(
-                    [sys.executable, '-c', script_with_imports],
-                    capture_output=True,
-                    text=True,
-                    timeout=300,  # 5分钟超时
-                    env=os.environ.copy()  # 传递环境变量
+                self.scheduler.add_job(
+                    func=run_queued,
+                    trigger='date',
+                    args=[script_id, slot],
+                    id=f'queued:{script_id}:{uuid.uuid4().hex}',
+                    jobstore='memory',
+                    misfire_grace_time=None
                 )
-                
-                run.output = result.stdout
-                run.error = result.stderr
-                run.status = 'success' if result.returncode == 0 else 'failed'
-                run.completed_at = datetime.now(timezone.utc)
-                
-                logger.info(f"脚本执行完成: {script.name}, 状态={run.status}")
-                
-            except subprocess.TimeoutExpired:
-                run.error = "Script execution timeout"
-                run.status = 'failed'
-                run.completed_at = datetime.now(timezone.utc)
-                logger.error(f"脚本执行超时: {script.name}")
+                return
             except Exception as e:
-                run.error = str(e)
-                run.status = 'failed'
-                run.completed_at = datetime.now(timezone.utc)
-                logger.error(f"脚本执行错误: {script.name}, 错误={str(e)}")
-            
-            db.session.commit()
\ No newline at end of file
+                logger.error(f"脚本ID={script_id} 提交排队的运行失败: {e}")
+        slot.release()
+    
+    def _run_with_policy(self, script_id, policy, limit):
+        cancel = threading.Event()
+        with self.lock:
+            running = self.running.setdefault(script_id, [])
+            if policy == 'replace':
+                # 终止最早的运行，为新实例腾出位置
+                while len(running) >= limit:
+                    running.pop(0).set()
+                    logger.info(f"脚本ID={script_id} 的上一次运行将被新的运行替换")
+            running.append(cancel)
+        
+        try:
+            self._execute(script_id, cancel)
+        finally:
+            with self.lock:
+                if cancel in self.running.get(script_id, []):
+                    self.running[script_id].remove(cancel)
+    
+    def _execute(self, script_id, cancel=None):
+        """执行脚本"""
+        executor.run_script(script_id, trigger='schedule', cancel=cancel)
+
+def _signature(cron_expression, options):
+    return json.dumps([cron_expression.strip(), options], sort_keys=True)
@@ -0,0 +1,216 @@
+"""
+AI 搜索结果缓存
+
+缓存键由（模型、归一化后的查询、生成配置）计算得出，条目带 TTL，超出容量时按最近使用时间淘汰。
+默认使用 data 目录下的 SQLite 文件，所有脚本子进程共享；同一查询正在被其他线程或进程请求时，
+会等待其结果而不是重复调用 API。
+
+环境变量:
+    SEARCH_CACHE: sqlite（默认）、memory 或 off
+    SEARCH_CACHE_PATH: SQLite 缓存文件路径
+    SEARCH_CACHE_TTL: 缓存有效期（秒，默认600）
+    SEARCH_CACHE_MAX_ENTRIES: 最大条目数（默认1000）
+"""
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = int(os.environ.get('SEARCH_CACHE_TTL', '600'))
+DEFAULT_MAX_ENTRIES = int(os.environ.get('SEARCH_CACHE_MAX_ENTRIES', '1000'))
+DEFAULT_PATH = os.environ.get('SEARCH_CACHE_PATH') or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'search_cache.db'
+)
+# 等待其他进程完成同一查询的最长时间（秒）
+INFLIGHT_TIMEOUT = 120
+
+def normalize_query(query):
+    """归一化查询：全角转半角、合并空白、忽略大小写"""
+    query = unicodedata.normalize('NFKC', query)
+    return ' '.join(query.split()).casefold()
+
+def make_key(model, query, config=None):
+    """计算缓存键"""
+    raw = json.dumps([model, normalize_query(query), config], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+class SearchCache:
+    """缓存后端接口"""
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def claim(self, key):
+        """声明正在查询 key，返回 False 表示其他进程已在查询"""
+        return True
+
+    def release(self, key):
+        pass
+
+    def wait(self, key, timeout=INFLIGHT_TIMEOUT):
+        """等待其他进程写入 key 的结果，超时或对方放弃时返回 None"""
+        return None
+
+class MemoryCache(SearchCache):
+    """进程内 LRU 缓存"""
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.time() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+class SQLiteCache(SearchCache):
+    """基于 SQLite 文件的缓存，可在多个进程间共享"""
+    # 每写入多少次检查一次容量
+    EVICT_EVERY = 50
+
+    def __init__(self, path=DEFAULT_PATH, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.writes = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=15, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS search_cache ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS search_inflight (key TEXT PRIMARY KEY, expires_at REAL NOT NULL)'
+        )
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT value FROM search_cache WHERE key = ? AND expires_at > ?', (key, now)
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute('UPDATE search_cache SET accessed_at = ? WHERE key = ?', (now, key))
+            return row[0]
+
+    def set(self, key, value):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO search_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+                (key, value, now + self.ttl, now)
+            )
+            self.writes += 1
+            if self.writes % self.EVICT_EVERY == 0:
+                self._evict(now)
+
+    def _evict(self, now):
+        self.conn.execute('DELETE FROM search_cache WHERE expires_at <= ?', (now,))
+        self.conn.execute(
+            'DELETE FROM search_cache WHERE key IN ('
+            'SELECT key FROM search_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,)
+        )
+
+    def claim(self, key):
+        now = time.time()
+        with self.lock:
+            # 清理持有者已崩溃留下的过期声明
+            self.conn.execute('DELETE FROM search_inflight WHERE key = ? AND expires_at <= ?', (key, now))
+            cursor = self.conn.execute(
+                'INSERT OR IGNORE INTO search_inflight (key, expires_at) VALUES (?, ?)',
+                (key, now + INFLIGHT_TIMEOUT)
+            )
+            return cursor.rowcount == 1
+
+    def release(self, key):
+        with self.lock:
+            self.conn.execute('DELETE FROM search_inflight WHERE key = ?', (key,))
+
+    def wait(self, key, timeout=INFLIGHT_TIMEOUT):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            value = self.get(key)
+            if value is not None:
+                return value
+            with self.lock:
+                pending = self.conn.execute(
+                    'SELECT 1 FROM search_inflight WHERE key = ? AND expires_at > ?', (key, time.time())
+                ).fetchone()
+            if pending is None:
+                # 对方已结束：可能刚写入结果，也可能查询失败
+                return self.get(key)
+            time.sleep(0.5)
+        return None
+
+class SingleFlight:
+    """合并同一进程内相同 key 的并发调用，只执行一次"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func):
+        with self.lock:
+            call = self.calls.get(key)
+            owner = call is None
+            if owner:
+                call = self.calls[key] = {'event': threading.Event(), 'result': None}
+        if not owner:
+            call['event'].wait()
+            return call['result']
+        try:
+            call['result'] = func()
+            return call['result']
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['event'].set()
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_default_cache():
+    """按环境变量创建进程内共享的缓存，关闭时返回 None"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            backend = os.environ.get('SEARCH_CACHE', 'sqlite')
+            if backend == 'off':
+                return None
+            if backend == 'memory':
+                _default_cache = MemoryCache()
+            else:
+                try:
+                    _default_cache = SQLiteCache()
+                except sqlite3.Error as e:
+                    logger.warning(f"无法打开搜索缓存文件，改用内存缓存: {e}")
+                    _default_cache = MemoryCache()
+        return _default_cache
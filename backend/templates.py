@@ -9,40 +9,28 @@ def get_templates():
             'name': 'AI搜索并推送',
             'description': '使用Google Gemini搜索信息并通过Bark推送',
             'code': '''import os
-from google import genai
-from google.genai import types
-from bark_sender import send_bark_notification
+from ai_search import AISearcher, search_and_push
 
 # 配置 - 请替换为你的实际密钥
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY', 'YOUR_API_KEY')
 BARK_DEVICE_KEY = os.environ.get('BARK_DEVICE_KEY', 'YOUR_BARK_KEY')
 
-# 配置Gemini客户端
-client = genai.Client(api_key=GEMINI_API_KEY)
-grounding_tool = types.Tool(google_search=types.GoogleSearch())
-config = types.GenerateContentConfig(tools=[grounding_tool])
-
 # 搜索查询
 query = "今天关于人工智能的最新新闻"
 
 try:
-    # 执行搜索
-    response = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=query,
-        config=config,
+    # 流式搜索：生成够 1000 字后立即停止生成并推送，不再等待完整回答
+    success, result, text = search_and_push(
+        query,
+        device_key=BARK_DEVICE_KEY,
+        title=f"AI搜索: {query[:20]}...",
+        group="AI搜索",
+        max_chars=1000,
+        searcher=AISearcher(api_key=GEMINI_API_KEY),
     )
-    
-    # 发送Bark通知
-    if response.text:
-        success, result = send_bark_notification(
-            device_key=BARK_DEVICE_KEY,
-            title=f"AI搜索: {query[:20]}...",
-            body=response.text[:1000],  # 限制长度
-            group="AI搜索"
-        )
+    if text:
         print(f"推送{'成功' if success else '失败'}: {result}")
-        print(f"搜索结果: {response.text[:1000]}...")
+        print(f"搜索结果: {text}")
     else:
         print("没有获取到搜索结果")
 except Exception as e:
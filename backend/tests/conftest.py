@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+from flask import Flask
+
+# 后端模块按顶层模块导入（与 app.py 相同）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import db
+
+@pytest.fixture
+def app(tmp_path):
+    """使用临时 SQLite 数据库的最小应用，测试在应用上下文中运行"""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{tmp_path / "test.db"}'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
@@ -0,0 +1,64 @@
+import pytest
+
+import cron
+
+def test_preview_valid_expression():
+    result = cron.preview('  0  9 * * * ', count=3)
+
+    assert result['valid'] is True
+    assert result['cron_expression'] == '0 9 * * *'
+    assert result['description'] == '每天9点执行'
+    assert result['error'] is None
+    assert len(result['next_runs']) == 3
+    assert all(time.endswith('09:00:00') for time in result['next_runs'])
+
+def test_preview_with_offset():
+    result = cron.preview('0 9 * * *', count=1, offset=30)
+
+    assert result['next_runs'][0].endswith('09:00:30')
+    assert result['description'].endswith('错峰推迟30秒')
+
+@pytest.mark.parametrize('expression, field', [
+    ('0 9 * *', None),
+    ('61 * * * *', 'minute'),
+    ('* * * * 9', 'day_of_week'),
+])
+def test_preview_invalid_expression(expression, field):
+    result = cron.preview(expression)
+
+    assert result['valid'] is False
+    assert result['next_runs'] == []
+    assert result['error']['field'] == field
+    assert result['description'] == result['error']['message']
+
+@pytest.mark.parametrize('expression', ['', '   ', None])
+def test_preview_empty_expression(expression):
+    result = cron.preview(expression)
+
+    assert result == {'cron_expression': '', 'valid': False, 'description': '未设置定时任务',
+                      'next_runs': [], 'error': None}
+
+@pytest.mark.parametrize('expression', [5, ['0 9 * * *'], {'minute': 0}])
+def test_preview_non_string_expression(expression):
+    result = cron.preview(expression)
+
+    assert result['valid'] is False
+    assert result['cron_expression'] == expression
+    assert result['error'] == {'message': 'cron表达式必须是字符串', 'field': None, 'value': expression}
+
+def test_get_trigger_rejects_invalid_expression():
+    with pytest.raises(cron.CronError):
+        cron.get_trigger('not a cron')
+
+def test_spread_offset_disabled():
+    assert cron.spread_offset(7, 0) == 0
+    assert cron.spread_offset(7, None) == 0
+    assert cron.spread_offset(None, 600) == 0
+
+def test_spread_offset_is_stable_and_within_window():
+    offsets = [cron.spread_offset(script_id, 600) for script_id in range(1, 51)]
+
+    assert offsets == [cron.spread_offset(script_id, 600) for script_id in range(1, 51)]
+    assert all(0 <= offset < 600 for offset in offsets)
+    # 相邻的脚本ID在窗口内分散开，不会集中在同一秒
+    assert len(set(offsets)) == len(offsets)
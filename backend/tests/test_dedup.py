@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+import json
+
+import pytest
+
+import dedup
+from inprocess import getenv, run_inprocess
+from models import db, Notification
+
+NOW = datetime(2026, 1, 1, 12)
+BODY = '今日要闻：' + '，'.join(f'第{i}条新闻讲述了人工智能在医疗、教育和交通领域的最新进展' for i in range(1, 6)) + '。'
+
+def payload(body=BODY, title='日报', device_key='device'):
+    return {'device_key': device_key, 'title': title, 'body': body}
+
+def add_push(script_id, push, created_at=NOW, status='pending'):
+    digest, fingerprint_simhash = dedup.push_fingerprint(push)
+    notification = Notification(script_id=script_id, device_key=push['device_key'], payload=json.dumps(push),
+                                 status=status, next_attempt_at=created_at, created_at=created_at,
+                                 content_hash=digest, simhash=fingerprint_simhash)
+    db.session.add(notification)
+    db.session.commit()
+    return notification.id
+
+def find(script_id, push, now=NOW):
+    return dedup.find_duplicate_push(db.session.connection(), script_id, push, dedup.push_fingerprint(push), now)
+
+def test_exact_duplicate(app):
+    notification_id = add_push(1, payload())
+
+    assert find(1, payload()) == (notification_id, 'exact')
+
+def test_near_duplicate(app):
+    notification_id = add_push(1, payload())
+
+    assert find(1, payload(BODY[:-1] + '！')) == (notification_id, 'near')
+
+def test_different_content_is_not_duplicate(app):
+    add_push(1, payload())
+    other = '天气预报：' + '，'.join(f'第{i}个城市明天多云转晴，最高气温二十五度，空气质量良好' for i in range(1, 6))
+
+    assert find(1, payload(other)) is None
+
+def test_short_body_only_matches_exactly(app):
+    add_push(1, payload('服务器告警：CPU 使用率 95%'))
+
+    assert find(1, payload('服务器告警：CPU 使用率 96%')) is None
+    assert find(1, payload('服务器告警：CPU 使用率 95%'))[1] == 'exact'
+
+def test_other_script_is_not_duplicate(app):
+    add_push(1, payload())
+
+    assert find(2, payload()) is None
+    assert find(None, payload()) is None
+
+def test_other_device_is_not_duplicate(app):
+    add_push(1, payload())
+
+    assert find(1, payload(device_key='other')) is None
+
+def test_old_and_failed_pushes_are_ignored(app):
+    add_push(1, payload(), created_at=NOW - timedelta(hours=dedup.PUSH_WINDOW_HOURS + 1))
+    add_push(1, payload(), status='failed')
+
+    assert find(1, payload()) is None
+
+@pytest.mark.parametrize('script_id', ['7', '8'])
+def test_inprocess_run_sees_its_script_id(script_id):
+    # 进程内运行的脚本通过运行上下文取得 SCRIPT_ID，不修改共享的 os.environ（以退出码回传读到的值）
+    code = "import sys\nfrom inprocess import getenv\nsys.exit(int(getenv('SCRIPT_ID')))"
+    result = run_inprocess(code, timeout=10, env={'SCRIPT_ID': script_id})
+
+    assert result.returncode == int(script_id)
+    assert getenv('SCRIPT_ID') is None
@@ -0,0 +1,71 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+from sqlalchemy import update
+
+import retention
+from models import db, Script, ScriptRun, RunDailyStat
+
+# 2026-01-01 04:00 UTC，即北京时间 2026-01-01 12:00
+CREATED = datetime(2026, 1, 1, 4)
+
+@pytest.fixture
+def script(app):
+    script = Script(name='demo', code='')
+    db.session.add(script)
+    db.session.commit()
+    return script
+
+def make_runs(script, count, status='success', duration=None):
+    return [ScriptRun(script_id=script.id, status=status, created_at=CREATED, duration=duration)
+            for _ in range(count)]
+
+def merge(script, runs):
+    retention.merge_daily_stats(script.id, runs)
+    db.session.commit()
+    return RunDailyStat.query.filter_by(script_id=script.id).one()
+
+def test_percentile_uses_nearest_rank():
+    values = list(range(1, 11))
+    assert retention._percentile(values, 50) == 5
+    assert retention._percentile(values, 95) == 10
+    assert retention._percentile([7], 95) == 7
+    assert retention._percentile([], 50) is None
+
+def test_weighted_ignores_missing_side():
+    assert retention._weighted(None, 0, 3.0, 2) == 3.0
+    assert retention._weighted(4.0, 2, None, 0) == 4.0
+    assert retention._weighted(4.0, 0, 3.0, 2) == 3.0
+    assert retention._weighted(10.0, 1, 2.0, 3) == 4.0
+
+def test_merge_two_batches_for_the_same_day(script):
+    # 第一批中 8 次取消的运行没有耗时，不应让合并结果偏向第一批
+    merge(script, make_runs(script, 2, duration=10.0) + make_runs(script, 8, status='cancelled'))
+    stat = merge(script, make_runs(script, 2, duration=2.0))
+
+    assert stat.day == date(2026, 1, 1)
+    assert (stat.total, stat.success, stat.failed) == (12, 4, 8)
+    assert stat.duration_count == 4
+    assert stat.p50_duration == pytest.approx(6.0)
+    assert stat.p95_duration == pytest.approx(6.0)
+
+def test_merge_uses_run_time_not_queue_time(script):
+    run = ScriptRun(script_id=script.id, status='success', created_at=CREATED,
+                    started_at=CREATED + timedelta(seconds=100), completed_at=CREATED + timedelta(seconds=103))
+    stat = merge(script, [run])
+
+    assert stat.p50_duration == pytest.approx(3.0)
+    assert stat.duration_count == 1
+
+def test_merge_into_stat_without_duration_count(script):
+    # 增加 duration_count 之前写入的汇总按总次数加权
+    db.session.add(RunDailyStat(script_id=script.id, day=date(2026, 1, 1), total=2, success=2, failed=0,
+                                p50_duration=10.0, p95_duration=10.0))
+    db.session.commit()
+    # upgrade_schema 补齐的字段在已有记录中为 NULL
+    db.session.execute(update(RunDailyStat).values(duration_count=None))
+    db.session.commit()
+    stat = merge(script, make_runs(script, 2, duration=2.0))
+
+    assert stat.p50_duration == pytest.approx(6.0)
+    assert stat.duration_count == 4
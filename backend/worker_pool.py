@@ -0,0 +1,518 @@
+"""
+预热的脚本执行进程池（fork server）
+
+启动一个常驻的 zygote 进程，预先导入 google.genai、requests、bark_sender 等较重的模块，
+每次运行脚本时由 zygote fork 出独立的子进程执行代码，省去解释器启动和重复导入的开销。
+子进程仍然是独立进程：标准输出/错误通过管道回传，超时后整个进程组会被杀掉，
+对调用方的行为与 subprocess.run(capture_output=True, text=True, timeout=...) 保持一致。
+
+不支持 fork 的平台（或设置 SCRIPT_EXECUTOR=subprocess）时退回到 subprocess。
+"""
+import codecs
+import json
+import locale
+import logging
+import os
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# 在 zygote 中预先导入的模块
+PRELOAD_MODULES = [
+    'requests',
+    'google.genai',
+    'google.genai.types',
+    'bark_sender',
+    'ai_search',
+    'outbox',
+]
+
+# 检查取消标志的间隔（秒）
+CANCEL_POLL_INTERVAL = 0.5
+# 内存上限的最小值（MB）：全新的解释器导入 google.genai 等常用模块需要约100MB地址空间
+MIN_MEMORY_MB = 128
+
+# zygote 预加载模块之前的地址空间（字节），即全新解释器的大小，只在 zygote 及其子进程中有值
+_fresh_address_space = None
+
+# 设置了资源上限时独立进程执行的启动代码：在执行脚本之前设置上限（脚本代码通过 argv 传入），
+# 无法设置时以失败退出；脚本的执行方式和异常输出与 _execute 一致
+_LIMITED_MAIN = """
+import builtins, resource, sys, traceback
+try:
+    for name, value in %r:
+        resource.setrlimit(getattr(resource, name), value)
+except (AttributeError, OSError, ValueError) as e:
+    print(f"无法设置脚本进程的资源上限: {e}", file=sys.stderr)
+    sys.exit(1)
+code = sys.argv.pop(1)
+del name, value
+try:
+    exec(compile(code, '<string>', 'exec'), {'__name__': '__main__', '__builtins__': builtins})
+except SystemExit:
+    raise
+except BaseException as e:
+    traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+    sys.exit(1)
+"""
+
+class RunCancelled(Exception):
+    """运行被调用方主动取消（例如被新的运行替换）"""
+    def __init__(self, output='', stderr=''):
+        super().__init__("Script execution cancelled")
+        self.output = output
+        self.stderr = stderr
+
+def is_supported():
+    """当前平台是否支持 fork server"""
+    return hasattr(os, 'fork') and hasattr(socket, 'send_fds')
+
+class WorkerPool:
+    def __init__(self, preload=None):
+        self.preload = preload if preload is not None else PRELOAD_MODULES
+        self.lock = threading.Lock()
+        self.process = None
+        self.control = None
+
+    def start(self):
+        """启动 zygote 进程"""
+        parent_sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        env = os.environ.copy()
+        env['WORKER_POOL_PRELOAD'] = ','.join(self.preload)
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), str(child_sock.fileno())],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            pass_fds=(child_sock.fileno(),),
+            env=env
+        )
+        child_sock.close()
+        self.control = parent_sock
+        logger.info(f"预热执行进程已启动: PID={self.process.pid}")
+
+    def stop(self):
+        """停止 zygote 进程"""
+        with self.lock:
+            if self.control:
+                self.control.close()
+                self.control = None
+            if self.process:
+                self.process.wait(timeout=5)
+                self.process = None
+
+    def _request(self, fds):
+        """把一次运行请求交给 zygote，zygote 异常退出时自动重启一次"""
+        with self.lock:
+            for attempt in range(2):
+                if self.process is None or self.process.poll() is not None:
+                    if self.process is not None:
+                        logger.warning("预热执行进程已退出，正在重启")
+                    self.start()
+                try:
+                    socket.send_fds(self.control, [b'R'], fds)
+                    return
+                except OSError:
+                    if attempt:
+                        raise
+                    self.process = None
+
+    def run(self, code, timeout=None, env=None, cancel=None, on_output=None, limits=None):
+        """执行一段 Python 代码，返回 subprocess.CompletedProcess
+
+        超时时抛出 subprocess.TimeoutExpired；cancel（threading.Event）被设置时
+        杀掉子进程并抛出 RunCancelled。提供 on_output(stream, text) 时输出按块回调，
+        不在内存中累积，返回值中的 stdout/stderr 为 None。
+        返回值（以及超时、取消时抛出的异常）的 usage 属性为子进程的资源占用，见 _usage，
+        metrics 属性为子进程通过 METRICS_FD 回传的指标；limits 为子进程的资源上限，见 _limit_values
+        """
+        conn, remote_conn = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        metrics_r, metrics_w = os.pipe()
+        try:
+            self._request([remote_conn.fileno(), out_w, err_w, metrics_w])
+        finally:
+            remote_conn.close()
+            os.close(out_w)
+            os.close(err_w)
+            os.close(metrics_w)
+
+        payload = json.dumps({
+            'code': code,
+            'env': dict(env if env is not None else os.environ),
+            'limits': limits or {},
+        })
+        conn.sendall(payload.encode('utf-8'))
+        conn.shutdown(socket.SHUT_WR)
+
+        # 子进程 PID 和退出码由监督进程通过 conn 逐行回报
+        state = {'pid': None, 'returncode': None, 'usage': None, 'killed': False}
+
+        def on_message(message):
+            if 'pid' in message:
+                state['pid'] = message['pid']
+                if state['killed']:
+                    _killpg(state['pid'])
+            if 'returncode' in message:
+                state['returncode'] = message['returncode']
+                state['usage'] = message.get('usage')
+
+        def kill():
+            state['killed'] = True
+            if state['pid']:
+                _killpg(state['pid'])
+
+        readers = {
+            out_r: _OutputReader('stdout', on_output),
+            err_r: _OutputReader('stderr', on_output),
+            metrics_r: _OutputReader('metrics'),
+        }
+        try:
+            reason = _pump(readers, timeout, cancel, kill, control=(conn, on_message))
+        finally:
+            conn.close()
+            os.close(out_r)
+            os.close(err_r)
+            os.close(metrics_r)
+
+        returncode = state['returncode']
+        if returncode is None:
+            returncode = -signal.SIGKILL if reason else 1
+        return _finish(['<worker_pool>'], returncode, reason, timeout, readers[out_r], readers[err_r],
+                       usage=state['usage'], metrics=readers[metrics_r].value())
+
+class _OutputReader:
+    """增量解码一路输出；提供 on_output 时按块回调，否则在内存中累积"""
+    def __init__(self, name, on_output=None):
+        self.name = name
+        self.on_output = on_output
+        self.decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))(errors='replace')
+        self.chunks = []
+
+    def feed(self, data):
+        self._emit(self.decoder.decode(data))
+
+    def close(self):
+        self._emit(self.decoder.decode(b'', final=True))
+
+    def value(self):
+        return None if self.on_output else ''.join(self.chunks)
+
+    def _emit(self, text):
+        if not text:
+            return
+        if self.on_output:
+            self.on_output(self.name, text)
+        else:
+            self.chunks.append(text)
+
+def _killpg(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def _pump(readers, timeout, cancel, kill, control=None):
+    """读取子进程输出直到管道关闭，超时或取消时调用 kill()
+
+    readers: {fd: _OutputReader}；control: 可选的 (socket, on_message)，按行接收 JSON 消息
+    返回结束原因：None、'timeout' 或 'cancelled'
+    """
+    reason = None
+    messages = b''
+    deadline = time.monotonic() + timeout if timeout else None
+
+    selector = selectors.DefaultSelector()
+    for fd in readers:
+        selector.register(fd, selectors.EVENT_READ)
+    if control is not None:
+        selector.register(control[0], selectors.EVENT_READ)
+    try:
+        while selector.get_map():
+            wait = None
+            if reason is None:
+                if deadline is not None:
+                    wait = deadline - time.monotonic()
+                    if wait <= 0:
+                        reason = 'timeout'
+                if cancel is not None:
+                    if cancel.is_set():
+                        reason = 'cancelled'
+                    wait = CANCEL_POLL_INTERVAL if wait is None else min(wait, CANCEL_POLL_INTERVAL)
+                if reason is not None:
+                    wait = None
+                    kill()
+            for key, _ in selector.select(wait):
+                if control is not None and key.fileobj is control[0]:
+                    data = control[0].recv(4096)
+                    if not data:
+                        selector.unregister(control[0])
+                        continue
+                    messages += data
+                    while b'\n' in messages:
+                        line, messages = messages.split(b'\n', 1)
+                        control[1](json.loads(line))
+                else:
+                    data = os.read(key.fd, 65536)
+                    if not data:
+                        selector.unregister(key.fd)
+                        readers[key.fd].close()
+                        continue
+                    readers[key.fd].feed(data)
+    finally:
+        selector.close()
+    return reason
+
+def _limit_values(limits, preloaded=0):
+    """把资源上限转为 [(RLIMIT 名称, (软上限, 硬上限))]
+
+    limits: {'memory_mb': 地址空间上限（RLIMIT_AS）, 'cpu_seconds': CPU 时间上限（RLIMIT_CPU）}，
+    值为空时不限制。超出 CPU 软上限时进程收到 SIGXCPU，1 秒后由硬上限 SIGKILL。
+    preloaded: 进程相对全新解释器多出的地址空间（字节，预热进程池中为预加载的模块），加在内存上限上，
+    同样的 memory_mb 在两种执行方式下可供脚本使用的内存相同
+    """
+    values = []
+    if limits.get('memory_mb'):
+        size = limits['memory_mb'] * 1024 * 1024 + preloaded
+        values.append(('RLIMIT_AS', (size, size)))
+    if limits.get('cpu_seconds'):
+        seconds = limits['cpu_seconds']
+        values.append(('RLIMIT_CPU', (seconds, seconds + 1)))
+    return values
+
+def _apply_limits(limits, preloaded=0):
+    """为当前进程（预热进程池的子进程）设置资源上限，参数见 _limit_values"""
+    import resource
+    for name, value in _limit_values(limits, preloaded):
+        resource.setrlimit(getattr(resource, name), value)
+
+def _address_space():
+    """当前进程的地址空间大小（字节），无法读取时返回 None"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmSize:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def _usage(rusage):
+    """把 wait4 返回的 rusage 转为 {cpu_user, cpu_system, max_rss_kb}"""
+    max_rss = rusage.ru_maxrss
+    if sys.platform == 'darwin':
+        # macOS 的单位是字节
+        max_rss //= 1024
+    return {
+        'cpu_user': round(rusage.ru_utime, 3),
+        'cpu_system': round(rusage.ru_stime, 3),
+        'max_rss_kb': max_rss,
+    }
+
+def _finish(args, returncode, reason, timeout, stdout_reader, stderr_reader, usage=None, metrics=None):
+    """按结束原因返回结果或抛出异常，资源占用和回传的指标附加在 usage、metrics 属性上"""
+    stdout, stderr = stdout_reader.value(), stderr_reader.value()
+    if reason == 'timeout':
+        outcome = subprocess.TimeoutExpired(args, timeout, output=stdout, stderr=stderr)
+    elif reason == 'cancelled':
+        outcome = RunCancelled(output=stdout, stderr=stderr)
+    else:
+        outcome = subprocess.CompletedProcess(args, returncode, stdout, stderr)
+    outcome.usage = usage
+    try:
+        outcome.metrics = json.loads(metrics) if metrics else None
+    except ValueError:
+        outcome.metrics = None
+    if isinstance(outcome, Exception):
+        raise outcome
+    return outcome
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """获取全局进程池（首次使用时启动）"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool()
+        return _pool
+
+def run_code(code, timeout=None, env=None, cancel=None, on_output=None, limits=None):
+    """执行脚本代码，优先使用预热进程池
+
+    参数和返回值见 WorkerPool.run
+    """
+    if os.environ.get('SCRIPT_EXECUTOR', 'pool') == 'pool' and is_supported():
+        if env is None:
+            env = os.environ.copy()
+        return get_pool().run(code, timeout=timeout, env=env, cancel=cancel, on_output=on_output, limits=limits)
+    return run_subprocess(code, timeout=timeout, env=env, cancel=cancel, on_output=on_output, limits=limits)
+
+def run_subprocess(code, timeout=None, env=None, cancel=None, on_output=None, limits=None):
+    """在新启动的 Python 解释器中执行脚本代码，参数和返回值同 run_code"""
+    env = dict(os.environ if env is None else env)
+    command = [sys.executable, '-c', code]
+    values = _limit_values(limits or {})
+    # 多线程的服务进程中不能使用 preexec_fn，由子进程在执行脚本之前自己设置上限
+    args = [sys.executable, '-c', _LIMITED_MAIN % (values,), code] if values else command
+    metrics_r, metrics_w = os.pipe()
+    env['METRICS_FD'] = str(metrics_w)
+    try:
+        process = subprocess.Popen(
+            args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+            start_new_session=True,
+            pass_fds=(metrics_w,)
+        )
+    except BaseException:
+        os.close(metrics_r)
+        raise
+    finally:
+        os.close(metrics_w)
+    with process, open(metrics_r, 'rb') as metrics_pipe:
+        readers = {
+            process.stdout.fileno(): _OutputReader('stdout', on_output),
+            process.stderr.fileno(): _OutputReader('stderr', on_output),
+            metrics_pipe.fileno(): _OutputReader('metrics'),
+        }
+        reason = _pump(readers, timeout, cancel, lambda: _killpg(process.pid))
+        usage = None
+        if hasattr(os, 'wait4'):
+            # 自己回收子进程以取得资源占用
+            _, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            usage = _usage(rusage)
+        returncode = process.wait()
+        stdout_reader, stderr_reader, metrics_reader = readers.values()
+    return _finish(command, returncode, reason, timeout, stdout_reader, stderr_reader,
+                   usage=usage, metrics=metrics_reader.value())
+
+# ---------------------------------------------------------------------------
+# 以下代码运行在 zygote 进程中
+# ---------------------------------------------------------------------------
+
+def _serve(control_fd):
+    """zygote 主循环：接收运行请求并 fork 子进程处理"""
+    global _fresh_address_space
+    control = socket.socket(fileno=control_fd)
+
+    _fresh_address_space = _address_space()
+    for name in os.environ.pop('WORKER_POOL_PRELOAD', '').split(','):
+        if not name:
+            continue
+        try:
+            __import__(name)
+        except Exception as e:
+            print(f"预加载模块失败: {name}: {e}", file=sys.stderr)
+
+    # 监督进程退出后由内核自动回收
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    while True:
+        try:
+            msg, fds, _, _ = socket.recv_fds(control, 16, 4)
+        except InterruptedError:
+            continue
+        if not msg:
+            # 父进程已退出
+            break
+        if len(fds) != 4:
+            for fd in fds:
+                os.close(fd)
+            continue
+        if os.fork() == 0:
+            control.close()
+            try:
+                _supervise(*fds)
+            finally:
+                os._exit(0)
+        for fd in fds:
+            os.close(fd)
+
+def _supervise(conn_fd, out_w, err_w, metrics_w):
+    """监督进程：fork 实际执行脚本的进程并回报其 PID、退出码和资源占用"""
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    conn = socket.socket(fileno=conn_fd)
+    payload = b''
+    while True:
+        data = conn.recv(65536)
+        if not data:
+            break
+        payload += data
+    request = json.loads(payload)
+
+    pid = os.fork()
+    if pid == 0:
+        conn.close()
+        _execute(request, out_w, err_w, metrics_w)
+    os.close(out_w)
+    os.close(err_w)
+    os.close(metrics_w)
+    conn.sendall(json.dumps({'pid': pid}).encode('utf-8') + b'\n')
+    _, status, rusage = os.wait4(pid, 0)
+    message = {'returncode': os.waitstatus_to_exitcode(status), 'usage': _usage(rusage)}
+    conn.sendall(json.dumps(message).encode('utf-8') + b'\n')
+    conn.close()
+
+def _execute(request, out_w, err_w, metrics_w):
+    """在独立进程组中执行用户代码，行为尽量与 python -c 一致"""
+    import builtins
+    import random
+    import traceback
+
+    exit_code = 0
+    try:
+        os.setsid()
+        os.dup2(out_w, 1)
+        os.dup2(err_w, 2)
+        os.close(out_w)
+        os.close(err_w)
+        sys.stdout = open(1, 'w', closefd=False)
+        sys.stderr = open(2, 'w', closefd=False)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        os.environ.clear()
+        os.environ.update(request['env'])
+        os.environ['METRICS_FD'] = str(metrics_w)
+        sys.argv = ['-c']
+        random.seed()
+        current = _address_space()
+        preloaded = max(current - _fresh_address_space, 0) if current and _fresh_address_space else 0
+        _apply_limits(request.get('limits') or {}, preloaded=preloaded)
+
+        code = compile(request['code'], '<string>', 'exec')
+        exec(code, {'__name__': '__main__', '__builtins__': builtins})
+    except SystemExit as e:
+        if e.code is None:
+            exit_code = 0
+        elif isinstance(e.code, int):
+            exit_code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            exit_code = 1
+    except BaseException as e:
+        # 去掉本模块自身的栈帧，与 python -c 的输出保持一致
+        traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+        exit_code = 1
+    finally:
+        try:
+            # os._exit 不会执行 atexit，需手动回传指标
+            metrics = sys.modules.get('metrics')
+            if metrics is not None:
+                metrics.export_to_parent()
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(exit_code)
+
+if __name__ == '__main__':
+    _serve(int(sys.argv[1]))
@@ -11,6 +11,7 @@ let hasUnsavedChanges = false;
 document.addEventListener('DOMContentLoaded', () => {
     loadScripts();
     loadTemplates();
+    subscribeEvents();
     
     // 绑定表单提交事件
     document.getElementById('scriptForm').addEventListener('submit', saveScript);
@@ -58,13 +59,14 @@ async function updateCronDescription() {
         const response = await fetch(`${API_BASE}/cron/parse`, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ cron_expression: cronExpression })
+            body: JSON.stringify({ cron_expression: cronExpression, count: 3 })
         });
         
         const result = await response.json();
         
         if (result.valid) {
-            descriptionDiv.textContent = result.description;
+            const nextRuns = result.next_runs.length ? `下次运行：${result.next_runs.join('、')}` : '不会触发';
+            descriptionDiv.textContent = `${result.description}（${nextRuns}）`;
             descriptionDiv.className = 'cron-description valid';
         } else {
             descriptionDiv.textContent = result.description;
@@ -101,12 +103,114 @@ async function loadScripts() {
         const response = await fetch(`${API_BASE}/scripts`);
         scripts = await response.json();
         renderScripts();
+        loadUpcomingRuns();
     } catch (error) {
         console.error('加载脚本失败:', error);
         alert('加载脚本失败，请刷新页面重试');
     }
 }
 
+// 启用的脚本接下来的几次运行时间（按脚本ID，含错峰偏移），一次请求批量解析
+let upcomingRuns = {};
+
+async function loadUpcomingRuns() {
+    const scheduled = scripts.filter(s => s.is_active && s.cron_expression);
+    if (scheduled.length === 0) {
+        return;
+    }
+    try {
+        const response = await fetch(`${API_BASE}/cron/parse?count=3`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(scheduled.map(s => ({
+                cron_expression: s.cron_expression,
+                offset: s.schedule_offset || 0
+            })))
+        });
+        const results = await response.json();
+        upcomingRuns = Object.fromEntries(scheduled.map((s, i) => [s.id, results[i].next_runs]));
+        renderScripts();
+    } catch (error) {
+        console.error('获取后续运行时间失败:', error);
+    }
+}
+
+// 订阅运行和脚本变更事件，收到后只更新变化的部分
+let eventsDisconnected = false;
+const runWaiters = {};
+
+function subscribeEvents() {
+    const source = new EventSource(`${API_BASE}/events`);
+    source.addEventListener('run', event => applyRunEvent(JSON.parse(event.data)));
+    source.addEventListener('script', event => applyScriptEvent(JSON.parse(event.data)));
+    source.onopen = () => {
+        // 断线期间的事件可能已经过期，重连后重新加载一次列表
+        if (eventsDisconnected) {
+            eventsDisconnected = false;
+            loadScripts();
+        }
+    };
+    source.onerror = () => {
+        eventsDisconnected = true;
+        // 服务端连接数已满（503）时浏览器不会自动重连，稍后重新订阅
+        if (source.readyState === EventSource.CLOSED) {
+            setTimeout(subscribeEvents, 10000);
+        }
+    };
+}
+
+function applyRunEvent(event) {
+    const run = event.run;
+    const script = scripts.find(s => s.id === run.script_id);
+    if (script && (!script.last_run || run.id >= script.last_run.id)) {
+        script.last_run = {
+            id: run.id,
+            status: run.status,
+            created_at: run.created_at,
+            completed_at: run.completed_at
+        };
+        renderScripts();
+    }
+    
+    // 正在查看该脚本的运行历史时，新的运行插入到最前面并实时显示输出
+    if (event.event === 'queued' && historyScriptId === run.script_id &&
+        document.getElementById('historyModal').style.display === 'block' &&
+        !document.getElementById(`history-run-${run.id}`)) {
+        const historyList = document.getElementById('historyList');
+        historyList.querySelector('.empty-state')?.remove();
+        historyList.insertAdjacentHTML('afterbegin', renderHistoryItem(run));
+        tailRun(run);
+    }
+    
+    if (event.event === 'finished' && runWaiters[run.id]) {
+        runWaiters[run.id]();
+    }
+}
+
+function applyScriptEvent(event) {
+    if (event.event === 'deleted') {
+        scripts = scripts.filter(s => s.id !== event.script_id);
+    } else {
+        upsertScript(event.script);
+    }
+    renderScripts();
+    if (event.script && event.script.is_active && event.script.cron_expression) {
+        loadUpcomingRuns();
+    }
+}
+
+// 更新或加入单个脚本（保留列表中已有的最近运行信息）
+function upsertScript(data) {
+    const index = scripts.findIndex(s => s.id === data.id);
+    const { code, ...summary } = data;
+    if (index === -1) {
+        scripts.push({ last_run: null, ...summary });
+        scripts.sort((a, b) => a.id - b.id);
+    } else {
+        scripts[index] = { ...scripts[index], next_run_time: null, ...summary };
+    }
+}
+
 // 加载模板列表
 async function loadTemplates() {
     try {
@@ -132,10 +236,19 @@ function renderScripts() {
             scheduleInfo = `Cron: ${script.cron_expression}`;
             if (script.next_run_time) {
                 scheduleInfo += `<br><small>下次运行: ${script.next_run_time}</small>`;
+                const later = (upcomingRuns[script.id] || [])
+                    .filter(time => time > script.next_run_time)
+                    .slice(0, 2);
+                if (later.length) {
+                    scheduleInfo += `<br><small>之后: ${later.join('、')}</small>`;
+                }
             }
         } else {
             scheduleInfo = '手动运行';
         }
+        if (script.last_run) {
+            scheduleInfo += `<br><small>上次运行: ${toBeijingTime(script.last_run.created_at)} ${getStatusText(script.last_run.status)}</small>`;
+        }
         
         return `
             <div class="script-card">
@@ -168,15 +281,31 @@ function showCreateScriptModal() {
     document.getElementById('scriptForm').reset();
     document.getElementById('scriptId').value = '';
     document.getElementById('cronExpression').value = '';
+    document.getElementById('maxInstances').value = 1;
+    document.getElementById('overlapPolicy').value = 'skip';
+    document.getElementById('coalesceRuns').checked = true;
+    document.getElementById('jitterSeconds').value = '';
+    document.getElementById('executionMode').value = 'subprocess';
+    document.getElementById('timeoutSeconds').value = 300;
     document.getElementById('cronDescription').textContent = '请输入cron表达式';
     document.getElementById('cronDescription').className = 'cron-description';
     document.getElementById('scriptModal').style.display = 'block';
 }
 
-// 编辑脚本
-function editScript(id) {
-    const script = scripts.find(s => s.id === id);
-    if (!script) return;
+// 编辑脚本（列表不含代码，编辑时单独获取）
+async function editScript(id) {
+    let script;
+    try {
+        const response = await fetch(`${API_BASE}/scripts/${id}`);
+        if (!response.ok) {
+            throw new Error('获取脚本失败');
+        }
+        script = await response.json();
+    } catch (error) {
+        console.error('获取脚本失败:', error);
+        alert('获取脚本失败，请重试');
+        return;
+    }
     
     currentScriptId = id;
     hasUnsavedChanges = false;
@@ -186,6 +315,15 @@ function editScript(id) {
     document.getElementById('scriptDescription').value = script.description || '';
     document.getElementById('cronExpression').value = script.cron_expression || '';
     document.getElementById('scriptActive').checked = script.is_active;
+    document.getElementById('maxInstances').value = script.max_instances || 1;
+    document.getElementById('overlapPolicy').value = script.overlap_policy || 'skip';
+    document.getElementById('coalesceRuns').checked = script.coalesce !== false;
+    document.getElementById('jitterSeconds').value = script.jitter_seconds ?? '';
+    document.getElementById('executionMode').value = script.execution_mode || 'subprocess';
+    document.getElementById('timeoutSeconds').value = script.timeout_seconds || 300;
+    document.getElementById('memoryLimitMb').value = script.memory_limit_mb || '';
+    document.getElementById('cpuLimitSeconds').value = script.cpu_limit_seconds || '';
+    document.getElementById('maxOutputKb').value = script.max_output_bytes ? Math.ceil(script.max_output_bytes / 1024) : '';
     document.getElementById('scriptCode').value = script.code;
     
     // 更新cron描述
@@ -203,7 +341,16 @@ async function saveScript(event) {
         description: document.getElementById('scriptDescription').value.trim(),
         code: document.getElementById('scriptCode').value,
         cron_expression: document.getElementById('cronExpression').value.trim(),
-        is_active: document.getElementById('scriptActive').checked
+        is_active: document.getElementById('scriptActive').checked,
+        max_instances: parseInt(document.getElementById('maxInstances').value, 10) || 1,
+        overlap_policy: document.getElementById('overlapPolicy').value,
+        coalesce: document.getElementById('coalesceRuns').checked,
+        jitter_seconds: optionalNonNegativeInt('jitterSeconds'),
+        execution_mode: document.getElementById('executionMode').value,
+        timeout_seconds: optionalInt('timeoutSeconds') || 300,
+        memory_limit_mb: optionalInt('memoryLimitMb'),
+        cpu_limit_seconds: optionalInt('cpuLimitSeconds'),
+        max_output_bytes: optionalInt('maxOutputKb') && optionalInt('maxOutputKb') * 1024
     };
     
     // 验证必填字段
@@ -238,8 +385,9 @@ async function saveScript(event) {
         if (response.ok) {
             hasUnsavedChanges = false;
             const successMessage = isUpdating ? '脚本更新成功！' : '脚本创建成功！';
+            upsertScript(await response.json());
+            renderScripts();
             closeScriptModal();
-            loadScripts();
             alert(successMessage);
         } else {
             const errorData = await response.json().catch(() => null);
@@ -261,8 +409,11 @@ async function runScript(id) {
         });
         
         if (response.ok) {
-            const result = await response.json();
-            if (result.status === 'success') {
+            const queued = await response.json();
+            const result = await waitForRun(queued.id);
+            if (isRunActive(result)) {
+                alert('脚本仍在运行，请稍后在运行历史中查看结果');
+            } else if (result.status === 'success') {
                 alert('脚本运行成功！\n输出：' + (result.output || '无输出').substring(0, 200));
             } else {
                 alert('脚本运行失败！\n错误：' + (result.error || '未知错误'));
@@ -276,6 +427,30 @@ async function runScript(id) {
     }
 }
 
+// 等待运行结束：收到 finished 事件后获取结果，事件推送断开时按 interval 兜底查询；
+// 超过 maxWait 仍未结束时返回当前状态
+async function waitForRun(runId, interval = 10000, maxWait = 3600000) {
+    const deadline = Date.now() + maxWait;
+    try {
+        while (true) {
+            const response = await fetch(`${API_BASE}/runs/${runId}`);
+            if (!response.ok) {
+                throw new Error('获取运行状态失败');
+            }
+            const run = await response.json();
+            if (!isRunActive(run) || Date.now() >= deadline) {
+                return run;
+            }
+            await new Promise(resolve => {
+                runWaiters[runId] = resolve;
+                setTimeout(resolve, interval);
+            });
+        }
+    } finally {
+        delete runWaiters[runId];
+    }
+}
+
 // 删除脚本
 async function deleteScript(id) {
     if (!confirm('确定要删除这个脚本吗？此操作不可恢复。')) return;
@@ -286,7 +461,8 @@ async function deleteScript(id) {
         });
         
         if (response.ok) {
-            loadScripts();
+            scripts = scripts.filter(s => s.id !== id);
+            renderScripts();
             alert('脚本删除成功！');
         } else {
             throw new Error('删除失败');
@@ -298,28 +474,17 @@ async function deleteScript(id) {
 }
 
 // 显示运行历史
+let historyScriptId = null;
+let historyNextBefore = null;
+
 async function showHistory(scriptId) {
+    historyScriptId = scriptId;
+    historyNextBefore = null;
+    closeHistoryStreams();
+    document.getElementById('historyList').innerHTML = '';
+    
     try {
-        const response = await fetch(`${API_BASE}/scripts/${scriptId}/runs`);
-        const runs = await response.json();
-        
-        const historyList = document.getElementById('historyList');
-        
-        if (runs.length === 0) {
-            historyList.innerHTML = '<div class="empty-state">暂无运行记录</div>';
-        } else {
-            historyList.innerHTML = runs.map(run => `
-                <div class="history-item ${run.status}">
-                    <div class="history-header">
-                        <span class="history-time">${toBeijingTime(run.created_at)}</span>
-                        <span class="history-status">${getStatusText(run.status)}</span>
-                    </div>
-                    ${run.output ? `<pre class="history-output">${escapeHtml(run.output)}</pre>` : ''}
-                    ${run.error ? `<pre class="history-error">${escapeHtml(run.error)}</pre>` : ''}
-                </div>
-            `).join('');
-        }
-        
+        await loadHistoryPage();
         document.getElementById('historyModal').style.display = 'block';
     } catch (error) {
         console.error('加载运行历史失败:', error);
@@ -327,6 +492,130 @@ async function showHistory(scriptId) {
     }
 }
 
+// 加载一页运行历史（列表不含输出内容，展开时再单独获取）
+async function loadHistoryPage() {
+    const params = new URLSearchParams({ limit: 20 });
+    if (historyNextBefore) {
+        params.set('before', historyNextBefore);
+    }
+    const response = await fetch(`${API_BASE}/scripts/${historyScriptId}/runs?${params}`);
+    if (!response.ok) {
+        throw new Error('加载运行历史失败');
+    }
+    const page = await response.json();
+    
+    const historyList = document.getElementById('historyList');
+    historyList.querySelector('.history-more')?.remove();
+    
+    if (page.runs.length === 0 && !historyNextBefore) {
+        historyList.innerHTML = '<div class="empty-state">暂无运行记录</div>';
+        return;
+    }
+    
+    historyList.insertAdjacentHTML('beforeend', page.runs.map(renderHistoryItem).join(''));
+    // 运行中的记录由 SSE 从头推送输出
+    page.runs.filter(isRunActive).forEach(tailRun);
+    
+    historyNextBefore = page.next_before;
+    if (historyNextBefore) {
+        historyList.insertAdjacentHTML('beforeend',
+            '<button class="btn btn-sm history-more" onclick="loadMoreHistory()">加载更多</button>');
+    }
+}
+
+function renderHistoryItem(run) {
+    return `
+        <div class="history-item ${run.status}" id="history-run-${run.id}">
+            <div class="history-header">
+                <span class="history-time">${toBeijingTime(run.created_at)}</span>
+                <span class="history-status">${getStatusText(run.status)}</span>
+            </div>
+            ${isRunActive(run) ? '' : `<button class="btn btn-sm history-toggle" onclick="toggleRunOutput(${run.id})">查看输出</button>`}
+            <pre class="history-output"></pre>
+            <pre class="history-error"></pre>
+        </div>
+    `;
+}
+
+async function loadMoreHistory() {
+    try {
+        await loadHistoryPage();
+    } catch (error) {
+        console.error('加载运行历史失败:', error);
+        alert('加载运行历史失败，请重试');
+    }
+}
+
+// 展开/收起单条运行的输出
+async function toggleRunOutput(runId) {
+    const item = document.getElementById(`history-run-${runId}`);
+    const button = item.querySelector('.history-toggle');
+    
+    if (item.classList.contains('expanded')) {
+        item.classList.remove('expanded');
+        button.textContent = '查看输出';
+        return;
+    }
+    
+    if (!item.dataset.loaded) {
+        try {
+            const response = await fetch(`${API_BASE}/runs/${runId}`);
+            const run = await response.json();
+            item.querySelector('.history-output').textContent = run.output || '';
+            item.querySelector('.history-error').textContent = run.error || '';
+            item.dataset.loaded = '1';
+            if (!run.output && !run.error) {
+                button.textContent = '无输出';
+                button.disabled = true;
+                return;
+            }
+        } catch (error) {
+            console.error('加载运行输出失败:', error);
+            alert('加载运行输出失败，请重试');
+            return;
+        }
+    }
+    item.classList.add('expanded');
+    button.textContent = '收起输出';
+}
+
+function isRunActive(run) {
+    return run.status === 'queued' || run.status === 'running';
+}
+
+// 通过 SSE 实时追加运行中的输出
+let historyStreams = [];
+
+function tailRun(run) {
+    const item = document.getElementById(`history-run-${run.id}`);
+    const source = new EventSource(`${API_BASE}/runs/${run.id}/stream`);
+    
+    const append = (selector, event) => {
+        item.querySelector(selector).textContent += JSON.parse(event.data).text;
+        const status = item.querySelector('.history-status');
+        if (item.classList.contains('queued')) {
+            item.className = 'history-item running';
+            status.textContent = getStatusText('running');
+        }
+    };
+    source.addEventListener('stdout', event => append('.history-output', event));
+    source.addEventListener('stderr', event => append('.history-error', event));
+    source.addEventListener('end', event => {
+        const { status } = JSON.parse(event.data);
+        item.className = `history-item ${status}`;
+        item.querySelector('.history-status').textContent = getStatusText(status);
+        source.close();
+    });
+    source.onerror = () => source.close();
+    
+    historyStreams.push(source);
+}
+
+function closeHistoryStreams() {
+    historyStreams.forEach(source => source.close());
+    historyStreams = [];
+}
+
 // 显示模板选择模态框
 function showTemplatesModal() {
     const grid = document.getElementById('templatesGrid');
@@ -371,6 +660,7 @@ function closeTemplatesModal() {
 }
 
 function closeHistoryModal() {
+    closeHistoryStreams();
     document.getElementById('historyModal').style.display = 'none';
 }
 
@@ -391,11 +681,28 @@ function escapeHtml(text) {
     return div.innerHTML;
 }
 
+// 读取可选的正整数输入，留空时返回 null
+function optionalInt(id) {
+    const value = parseInt(document.getElementById(id).value, 10);
+    return value > 0 ? value : null;
+}
+
+// 留空返回 null（使用默认值），0 表示不启用
+function optionalNonNegativeInt(id) {
+    const value = parseInt(document.getElementById(id).value, 10);
+    return value >= 0 ? value : null;
+}
+
 function getStatusText(status) {
     const statusMap = {
+        'queued': '排队中',
         'running': '运行中',
         'success': '成功',
-        'failed': '失败'
+        'failed': '失败',
+        'cancelled': '已取消',
+        'killed_oom': '内存超限',
+        'killed_timeout': '超时终止',
+        'truncated': '输出超限'
     };
     return statusMap[status] || status;
 }
@@ -409,6 +716,9 @@ window.onclick = function(event) {
             }
         }
         event.target.style.display = 'none';
+        if (event.target.id === 'historyModal') {
+            closeHistoryStreams();
+        }
         if (event.target.id === 'scriptModal') {
             currentScriptId = null;
             hasUnsavedChanges = false;